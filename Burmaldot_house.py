@@ -5,14 +5,29 @@ import random
 import asyncio
 import time
 import os
+import sys
 import hashlib
 import json
+import gzip
+import functools
+import contextlib
+import weakref
 import math
+import heapq
 import re
+import threading
+import queue
+import shutil
+import tempfile
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 import requests
 from PIL import Image
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
+from telegram.error import BadRequest, Forbidden, RetryAfter
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
@@ -28,25 +43,237 @@ DEBUG_ADMIN_ID = 1836467497
 
 logging.basicConfig(level=logging.INFO)
 
-conn = sqlite3.connect("game.db", check_same_thread=False)
-cursor = conn.cursor()
+DB_PATH = "game.db"
+DB_CACHE_SIZE_KB = 16384
+DB_MMAP_SIZE = 64 * 1024 * 1024
+DB_BUSY_TIMEOUT_MS = 5000
+DB_READ_POOL_SIZE = 4
+
+def configure_connection(db, readonly: bool = False):
+    db.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    db.execute(f"PRAGMA cache_size={-DB_CACHE_SIZE_KB}")
+    db.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    if not readonly:
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+# the writer for handlers; readers come from db_read_pool and the db thread has
+# its own writer (see ASYNC DB). only the thread that opened it may use it.
+# there is no shared cursor: every statement gets its own through the db_* helpers.
+# opened by open_db() from main() or a command, so importing the module or
+# migrating another file never creates game.db in the working directory
+conn = None
+conn_thread = None
+
+def open_db(path: str = None):
+    global conn, conn_thread, DB_PATH
+    if path:
+        DB_PATH = path
+    conn = configure_connection(sqlite3.connect(DB_PATH, check_same_thread=False))
+    conn_thread = threading.get_ident()
+    return conn
 
 # ---------------- DB HELPERS ----------------
 
-def ensure_table():
-    cursor.execute("""
+# unit of work: handlers open one transaction() around a multi-step change and
+# helpers call db_commit(), which is a no-op while a transaction is open.
+# keep awaits out of the block - other updates share this connection.
+db_tx_depth = 0
+db_tx_rollback_only = False
+
+@contextlib.contextmanager
+def transaction():
+    global db_tx_depth, db_tx_rollback_only
+    db_tx_depth += 1
+    try:
+        yield conn
+    except BaseException:
+        db_tx_rollback_only = True
+        raise
+    finally:
+        db_tx_depth -= 1
+        if db_tx_depth == 0:
+            if db_tx_rollback_only:
+                db_tx_rollback_only = False
+                conn.rollback()
+            else:
+                conn.commit()
+
+def in_transaction() -> bool:
+    return db_tx_depth > 0
+
+def mark_rollback_only():
+    # the open transaction rolls back when it ends instead of committing
+    global db_tx_rollback_only
+    db_tx_rollback_only = True
+
+db_read_pool = queue.LifoQueue(maxsize=DB_READ_POOL_SIZE)
+
+def open_read_connection():
+    db = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, check_same_thread=False)
+    return configure_connection(db, readonly=True)
+
+@contextlib.contextmanager
+def read_connection():
+    # uncommitted writes are only visible on the writer, so reads inside a
+    # transaction stay there. other threads never see them and use the pool
+    if threading.get_ident() == conn_thread and (in_transaction() or conn.in_transaction):
+        yield conn
+        return
+    try:
+        db = db_read_pool.get_nowait()
+    except queue.Empty:
+        db = open_read_connection()
+    try:
+        yield db
+    finally:
+        try:
+            db_read_pool.put_nowait(db)
+        except queue.Full:
+            db.close()
+
+def db_read_all(sql: str, params=()):
+    with read_connection() as db:
+        return db.execute(sql, params).fetchall()
+
+def db_read_one(sql: str, params=()):
+    with read_connection() as db:
+        return db.execute(sql, params).fetchone()
+
+# ---------------- ASYNC DB ----------------
+
+# sql from handlers runs on one dedicated thread so a slow scan or commit
+# never stalls the event loop. writes queued while a batch is running are
+# committed together in the next batch. the thread writes through its own
+# connection, so a batch never picks up or commits a handler's open transaction.
+# that makes two writers on one WAL file: a loop-side commit that meets a
+# running batch waits for it (up to busy_timeout), so batches are kept small
+# enough to commit in a few milliseconds.
+DB_WRITE_BATCH_MAX = 32
+db_executor = None
+db_thread_conn = None
+db_write_queue = []
+db_write_queue_lock = threading.Lock()
+
+def get_db_executor():
+    global db_executor
+    if db_executor is None:
+        db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="game-db")
+    return db_executor
+
+def db_thread_writer():
+    global db_thread_conn
+    if db_thread_conn is None:
+        db_thread_conn = configure_connection(sqlite3.connect(DB_PATH, check_same_thread=False))
+    return db_thread_conn
+
+async def run_db(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_db_executor(), func, *args)
+
+async def fetchone_async(sql: str, params=()):
+    return await run_db(db_read_one, sql, params)
+
+async def fetchall_async(sql: str, params=()):
+    return await run_db(db_read_all, sql, params)
+
+def resolve_db_future(fut, result=None, error=None):
+    if fut.done():
+        return
+    if error is not None:
+        fut.set_exception(error)
+    else:
+        fut.set_result(result)
+
+def flush_db_writes(loop):
+    with db_write_queue_lock:
+        batch = db_write_queue[:DB_WRITE_BATCH_MAX]
+        del db_write_queue[:DB_WRITE_BATCH_MAX]
+        if db_write_queue:
+            get_db_executor().submit(flush_db_writes, loop)
+    writer = db_thread_writer()
+    results = []
+    try:
+        for sql, params, fut in batch:
+            try:
+                cur = writer.execute(sql, params)
+                results.append((fut, {"rowcount": cur.rowcount, "lastrowid": cur.lastrowid}, None))
+            except sqlite3.Error as e:
+                # a failed statement is undone on its own, the rest of the batch still commits
+                results.append((fut, None, e))
+        writer.commit()
+    except Exception as e:
+        try:
+            writer.rollback()
+        except Exception:
+            pass
+        results = [(fut, None, e) for _, _, fut in batch]
+    for fut, result, error in results:
+        loop.call_soon_threadsafe(resolve_db_future, fut, result, error)
+
+async def execute_async(sql: str, params=()) -> dict:
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+    with db_write_queue_lock:
+        db_write_queue.append((sql, params, fut))
+        start_flush = len(db_write_queue) == 1
+    if start_flush:
+        get_db_executor().submit(flush_db_writes, loop)
+    return await fut
+
+def shutdown_db_executor():
+    global db_executor
+    if db_executor is not None:
+        db_executor.shutdown(wait=True)
+        db_executor = None
+
+def close_db_connections():
+    global db_thread_conn
+    shutdown_db_executor()
+    if db_thread_conn is not None:
+        db_thread_conn.close()
+        db_thread_conn = None
+    while True:
+        try:
+            db_read_pool.get_nowait().close()
+        except queue.Empty:
+            break
+    try:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    except Exception:
+        pass
+
+def db_commit():
+    if db_tx_depth == 0:
+        conn.commit()
+
+def db_execute(sql: str, params=()):
+    return conn.execute(sql, params)
+
+def db_executemany(sql: str, rows):
+    return conn.executemany(sql, rows)
+
+def db_fetchone(sql: str, params=()):
+    return conn.execute(sql, params).fetchone()
+
+def db_fetchall(sql: str, params=()):
+    return conn.execute(sql, params).fetchall()
+
+def migrate_base_schema(cur):
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS players(
         user_id INTEGER PRIMARY KEY,
         money INTEGER
     )
     """)
-    cursor.execute("""
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS dealership(
         car TEXT PRIMARY KEY,
         stock INTEGER
     )
     """)
-    cursor.execute("""
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS garage(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         owner INTEGER,
@@ -54,7 +281,7 @@ def ensure_table():
         speed REAL
     )
     """)
-    cursor.execute("""
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS car_market(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         car TEXT,
@@ -63,13 +290,13 @@ def ensure_table():
         speed REAL
     )
     """)
-    cursor.execute("""
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS mine_rewards(
         user_id INTEGER PRIMARY KEY,
         sharpening_stones INTEGER DEFAULT 0
     )
     """)
-    cursor.execute("""
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS player_items(
         user_id INTEGER,
         item_key TEXT,
@@ -77,7 +304,7 @@ def ensure_table():
         PRIMARY KEY(user_id, item_key)
     )
     """)
-    cursor.execute("""
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS bank_operations(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         account_number TEXT,
@@ -92,7 +319,7 @@ def ensure_table():
     """)
 
 
-    cursor.execute("""
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS gpu_factories(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         city TEXT UNIQUE,
@@ -118,7 +345,7 @@ def ensure_table():
         ad_bumped_at INTEGER DEFAULT 0
     )
     """)
-    cursor.execute("""
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS gpu_factory_orders(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         city TEXT,
@@ -135,7 +362,7 @@ def ensure_table():
         delivered_at INTEGER DEFAULT 0
     )
     """)
-    cursor.execute("""
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS gpu_factory_employees(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         factory_id INTEGER,
@@ -146,7 +373,7 @@ def ensure_table():
         created_at INTEGER
     )
     """)
-    cursor.execute("""
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS gpu_factory_applications(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         factory_id INTEGER,
@@ -156,7 +383,7 @@ def ensure_table():
         created_at INTEGER
     )
     """)
-    cursor.execute("""
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS gpu_factory_history(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         factory_id INTEGER,
@@ -172,7 +399,7 @@ def ensure_table():
     """)
 
 
-    cursor.execute("""
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS gpu_shops(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         city TEXT UNIQUE,
@@ -183,7 +410,7 @@ def ensure_table():
         supplier_factory_city TEXT DEFAULT ''
     )
     """)
-    cursor.execute("""
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS gpu_shop_inventory(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         shop_id INTEGER,
@@ -193,7 +420,7 @@ def ensure_table():
         UNIQUE(shop_id, gpu_key)
     )
     """)
-    cursor.execute("""
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS gpu_shop_sales(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         shop_id INTEGER,
@@ -203,7 +430,7 @@ def ensure_table():
         buyer_name TEXT DEFAULT ''
     )
     """)
-    cursor.execute("""
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS gpu_factory_shipments(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         factory_id INTEGER,
@@ -216,7 +443,7 @@ def ensure_table():
     )
     """)
 
-    cursor.execute("""
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS houses(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         owner_id INTEGER UNIQUE,
@@ -230,7 +457,7 @@ def ensure_table():
         created_at INTEGER DEFAULT 0
     )
     """)
-    cursor.execute("""
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS house_storage(
         house_id INTEGER,
         item_key TEXT,
@@ -238,7 +465,7 @@ def ensure_table():
         PRIMARY KEY(house_id, item_key)
     )
     """)
-    cursor.execute("""
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS house_gpus(
         house_id INTEGER,
         slot_index INTEGER,
@@ -246,14 +473,14 @@ def ensure_table():
         PRIMARY KEY(house_id, slot_index)
     )
     """)
-    cursor.execute("""
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS house_guests(
         house_id INTEGER,
         guest_user_id INTEGER UNIQUE,
         joined_at INTEGER DEFAULT 0
     )
     """)
-    cursor.execute("""
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS friend_requests(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         from_user_id INTEGER,
@@ -263,7 +490,7 @@ def ensure_table():
         created_at INTEGER DEFAULT 0
     )
     """)
-    cursor.execute("""
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS friends(
         user_id INTEGER,
         friend_user_id INTEGER,
@@ -271,7 +498,7 @@ def ensure_table():
         PRIMARY KEY(user_id, friend_user_id)
     )
     """)
-    cursor.execute("""
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS house_invites(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         house_id INTEGER,
@@ -282,7 +509,7 @@ def ensure_table():
         created_at INTEGER DEFAULT 0
     )
     """)
-    cursor.execute("""
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS house_chat_messages(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         house_id INTEGER,
@@ -292,7 +519,7 @@ def ensure_table():
         created_at INTEGER DEFAULT 0
     )
     """)
-    cursor.execute("""
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS trade_sessions(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         house_id INTEGER,
@@ -306,7 +533,7 @@ def ensure_table():
         created_at INTEGER DEFAULT 0
     )
     """)
-    cursor.execute("""
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS trade_offers(
         session_id INTEGER,
         user_id INTEGER,
@@ -316,7 +543,7 @@ def ensure_table():
         PRIMARY KEY(session_id, user_id, slot_index)
     )
     """)
-    cursor.execute("""
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS trade_money(
         session_id INTEGER,
         user_id INTEGER,
@@ -324,66 +551,285 @@ def ensure_table():
         PRIMARY KEY(session_id, user_id)
     )
     """)
-    conn.commit()
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS telegram_file_ids(
+        source TEXT PRIMARY KEY,
+        content_hash TEXT,
+        file_id TEXT,
+        updated_at INTEGER DEFAULT 0
+    )
+    """)
 
-def get_columns(table_name: str):
-    cursor.execute(f"PRAGMA table_info({table_name})")
-    return [row[1] for row in cursor.fetchall()]
+def get_columns(cur, table_name: str):
+    cur.execute(f"PRAGMA table_info({table_name})")
+    return [row[1] for row in cur.fetchall()]
 
-def ensure_column(table_name: str, column_sql: str):
+def ensure_column(cur, table_name: str, column_sql: str):
     col_name = column_sql.split()[0]
-    if col_name not in get_columns(table_name):
-        cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_sql}")
-        conn.commit()
+    if col_name not in get_columns(cur, table_name):
+        cur.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_sql}")
+
+def migrate_legacy_columns(cur):
+    ensure_column(cur, "players", "city TEXT DEFAULT 'Новоград'")
+    ensure_column(cur, "players", "taxi_level INTEGER DEFAULT 1")
+    ensure_column(cur, "players", "taxi_rides INTEGER DEFAULT 0")
+    ensure_column(cur, "players", "char_created INTEGER DEFAULT 0")
+    ensure_column(cur, "players", "char_top TEXT DEFAULT ''")
+    ensure_column(cur, "players", "char_bottom TEXT DEFAULT ''")
+    ensure_column(cur, "players", "char_hair TEXT DEFAULT ''")
+    ensure_column(cur, "players", "bank_balance INTEGER DEFAULT 90000000")
+    ensure_column(cur, "players", "bank_btc REAL DEFAULT 0")
+    ensure_column(cur, "players", "account_number TEXT DEFAULT ''")
+    ensure_column(cur, "car_market", "seller_name TEXT DEFAULT ''")
+    ensure_column(cur, "players", "current_house_id INTEGER DEFAULT 0")
+    # --- Logistics additions ---
+    ensure_column(cur, "players", "logistics_level INTEGER DEFAULT 1")
+    ensure_column(cur, "players", "logistics_done INTEGER DEFAULT 0")
+    ensure_column(cur, "players", "logistics_rent_truck TEXT DEFAULT ''")
+    ensure_column(cur, "players", "logistics_rent_remaining INTEGER DEFAULT 0")
+
+    ensure_column(cur, "garage", "vehicle_type TEXT DEFAULT 'car'")
+    ensure_column(cur, "garage", "truck_level INTEGER DEFAULT 0")
+    ensure_column(cur, "garage", "cargo_capacity INTEGER DEFAULT 0")
+    ensure_column(cur, "garage", "speed_bonus_percent INTEGER DEFAULT 0")
+    ensure_column(cur, "garage", "capacity_bonus_percent INTEGER DEFAULT 0")
+
+    ensure_column(cur, "car_market", "vehicle_type TEXT DEFAULT 'car'")
+    ensure_column(cur, "car_market", "truck_level INTEGER DEFAULT 0")
+    ensure_column(cur, "car_market", "cargo_capacity INTEGER DEFAULT 0")
+    ensure_column(cur, "car_market", "speed_bonus_percent INTEGER DEFAULT 0")
+    ensure_column(cur, "car_market", "capacity_bonus_percent INTEGER DEFAULT 0")
+
+    ensure_column(cur, "gpu_factory_orders", "owner_name TEXT DEFAULT ''")
+    ensure_column(cur, "gpu_factory_orders", "driver_id INTEGER DEFAULT 0")
+    ensure_column(cur, "gpu_factory_orders", "driver_name TEXT DEFAULT ''")
+    ensure_column(cur, "gpu_factory_orders", "driver_type TEXT DEFAULT ''")
+    ensure_column(cur, "gpu_factory_orders", "vehicle_name TEXT DEFAULT ''")
+    ensure_column(cur, "gpu_factory_orders", "vehicle_type TEXT DEFAULT ''")
+    ensure_column(cur, "gpu_factory_orders", "vehicle_speed REAL DEFAULT 0")
+    ensure_column(cur, "gpu_factory_orders", "vehicle_capacity INTEGER DEFAULT 0")
+    ensure_column(cur, "gpu_factory_orders", "cargo_weight INTEGER DEFAULT 0")
+    ensure_column(cur, "gpu_factory_orders", "delivery_started_at INTEGER DEFAULT 0")
+    ensure_column(cur, "gpu_factory_orders", "delivery_eta_seconds INTEGER DEFAULT 0")
+    ensure_column(cur, "gpu_factory_orders", "reward_amount INTEGER DEFAULT 0")
+    ensure_column(cur, "gpu_factory_orders", "start_notice_chat_id INTEGER DEFAULT 0")
+    ensure_column(cur, "gpu_factory_orders", "start_notice_message_id INTEGER DEFAULT 0")
+    ensure_column(cur, "gpu_factory_orders", "tip_amount INTEGER DEFAULT 0")
+    ensure_column(cur, "gpu_factory_orders", "tip_message TEXT DEFAULT ''")
+    ensure_column(cur, "gpu_factory_orders", "tip_created_at INTEGER DEFAULT 0")
+
+def migrate_hot_lookup_indexes(cur):
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_gpu_orders_pending ON gpu_factory_orders(id) WHERE status='pending'")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_gpu_orders_pending_city ON gpu_factory_orders(city) WHERE status='pending'")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_gpu_orders_in_delivery ON gpu_factory_orders(driver_id) WHERE status='in_delivery'")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_garage_owner ON garage(owner)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_bank_operations_account ON bank_operations(account_number)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_players_account ON players(account_number)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_gpu_shipments_available ON gpu_factory_shipments(factory_id) WHERE remaining_qty>0")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_house_chat_house ON house_chat_messages(house_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_gpu_employees_factory ON gpu_factory_employees(factory_id, employee_type)")
+
+def sync_catalog_rows(cur):
+    # also runs on every start, so a car or city added to the catalog later gets its rows
+    for car in CARS:
+        cur.execute("INSERT OR IGNORE INTO dealership(car, stock) VALUES(?, ?)", (car, 500))
+    for city in ["Новоград", "Инд-Сити", "Форс-Сити", "Вегаспорт"]:
+        cur.execute("INSERT OR IGNORE INTO gpu_factories(city) VALUES(?)", (city,))
+        cur.execute("INSERT OR IGNORE INTO gpu_shops(city) VALUES(?)", (city,))
 
-ensure_table()
-ensure_column("players", "city TEXT DEFAULT 'Новоград'")
-ensure_column("players", "taxi_level INTEGER DEFAULT 1")
-ensure_column("players", "taxi_rides INTEGER DEFAULT 0")
-ensure_column("players", "char_created INTEGER DEFAULT 0")
-ensure_column("players", "char_top TEXT DEFAULT ''")
-ensure_column("players", "char_bottom TEXT DEFAULT ''")
-ensure_column("players", "char_hair TEXT DEFAULT ''")
-ensure_column("players", "bank_balance INTEGER DEFAULT 90000000")
-ensure_column("players", "bank_btc REAL DEFAULT 0")
-ensure_column("players", "account_number TEXT DEFAULT ''")
-ensure_column("car_market", "seller_name TEXT DEFAULT ''")
-ensure_column("players", "current_house_id INTEGER DEFAULT 0")
-# --- Logistics additions ---
-ensure_column("players", "logistics_level INTEGER DEFAULT 1")
-ensure_column("players", "logistics_done INTEGER DEFAULT 0")
-ensure_column("players", "logistics_rent_truck TEXT DEFAULT ''")
-ensure_column("players", "logistics_rent_remaining INTEGER DEFAULT 0")
-
-ensure_column("garage", "vehicle_type TEXT DEFAULT 'car'")
-ensure_column("garage", "truck_level INTEGER DEFAULT 0")
-ensure_column("garage", "cargo_capacity INTEGER DEFAULT 0")
-ensure_column("garage", "speed_bonus_percent INTEGER DEFAULT 0")
-ensure_column("garage", "capacity_bonus_percent INTEGER DEFAULT 0")
-
-ensure_column("car_market", "vehicle_type TEXT DEFAULT 'car'")
-ensure_column("car_market", "truck_level INTEGER DEFAULT 0")
-ensure_column("car_market", "cargo_capacity INTEGER DEFAULT 0")
-ensure_column("car_market", "speed_bonus_percent INTEGER DEFAULT 0")
-ensure_column("car_market", "capacity_bonus_percent INTEGER DEFAULT 0")
-
-ensure_column("gpu_factory_orders", "owner_name TEXT DEFAULT ''")
-ensure_column("gpu_factory_orders", "driver_id INTEGER DEFAULT 0")
-ensure_column("gpu_factory_orders", "driver_name TEXT DEFAULT ''")
-ensure_column("gpu_factory_orders", "driver_type TEXT DEFAULT ''")
-ensure_column("gpu_factory_orders", "vehicle_name TEXT DEFAULT ''")
-ensure_column("gpu_factory_orders", "vehicle_type TEXT DEFAULT ''")
-ensure_column("gpu_factory_orders", "vehicle_speed REAL DEFAULT 0")
-ensure_column("gpu_factory_orders", "vehicle_capacity INTEGER DEFAULT 0")
-ensure_column("gpu_factory_orders", "cargo_weight INTEGER DEFAULT 0")
-ensure_column("gpu_factory_orders", "delivery_started_at INTEGER DEFAULT 0")
-ensure_column("gpu_factory_orders", "delivery_eta_seconds INTEGER DEFAULT 0")
-ensure_column("gpu_factory_orders", "reward_amount INTEGER DEFAULT 0")
-ensure_column("gpu_factory_orders", "start_notice_chat_id INTEGER DEFAULT 0")
-ensure_column("gpu_factory_orders", "start_notice_message_id INTEGER DEFAULT 0")
-ensure_column("gpu_factory_orders", "tip_amount INTEGER DEFAULT 0")
-ensure_column("gpu_factory_orders", "tip_message TEXT DEFAULT ''")
-ensure_column("gpu_factory_orders", "tip_created_at INTEGER DEFAULT 0")
+def migrate_durable_timers(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS taxi_orders(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        passenger_id INTEGER,
+        passenger_name TEXT DEFAULT '',
+        origin TEXT,
+        destination TEXT,
+        distance INTEGER DEFAULT 0,
+        payment INTEGER DEFAULT 0,
+        status TEXT DEFAULT 'waiting',
+        driver_type TEXT,
+        driver_id INTEGER,
+        driver_name TEXT,
+        vehicle_name TEXT,
+        vehicle_speed REAL,
+        rental_cost INTEGER DEFAULT 0,
+        created_at REAL,
+        end_time REAL
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_taxi_orders_waiting ON taxi_orders(origin) WHERE status='waiting'")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_taxi_orders_driving ON taxi_orders(driver_id) WHERE status='in_progress'")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS scheduled_jobs(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        ref_id INTEGER NOT NULL,
+        run_at REAL NOT NULL,
+        attempts INTEGER DEFAULT 0,
+        created_at INTEGER,
+        UNIQUE(kind, ref_id)
+    )
+    """)
+
+def migrate_logistics_order_jobs(cur):
+    # orders created while the 15 s polling loop drove them get their timers once
+    now = int(time.time())
+    cur.execute("""
+        INSERT OR IGNORE INTO scheduled_jobs(kind, ref_id, run_at, attempts, created_at)
+        SELECT 'logistics_npc_takeover', id, created_at + ?, 0, ? FROM gpu_factory_orders WHERE status='pending'
+    """, (LOGISTICS_NPC_WAIT_SECONDS, now))
+    cur.execute("""
+        INSERT OR IGNORE INTO scheduled_jobs(kind, ref_id, run_at, attempts, created_at)
+        SELECT 'logistics_finish', id, COALESCE(delivery_started_at, 0) + COALESCE(delivery_eta_seconds, 0), 0, ?
+        FROM gpu_factory_orders WHERE status='in_delivery'
+    """, (now,))
+
+def migrate_outbox(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS outbox(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER NOT NULL,
+        method TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        attempts INTEGER DEFAULT 0,
+        next_at REAL NOT NULL,
+        created_at INTEGER
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_outbox_chat ON outbox(chat_id, id)")
+
+def migrate_house_chat_ring(cur):
+    ensure_column(cur, "houses", "chat_seq INTEGER DEFAULT 0")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS house_chat_ring(
+        house_id INTEGER NOT NULL,
+        slot INTEGER NOT NULL,
+        seq INTEGER NOT NULL,
+        sender_id INTEGER,
+        sender_name TEXT DEFAULT '',
+        message TEXT DEFAULT '',
+        created_at INTEGER DEFAULT 0,
+        PRIMARY KEY(house_id, slot)
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_house_chat_ring_seq ON house_chat_ring(house_id, seq)")
+    # the old log already kept at most 100 messages per house; number them 1..n
+    cur.execute("""
+        INSERT OR REPLACE INTO house_chat_ring(house_id, slot, seq, sender_id, sender_name, message, created_at)
+        SELECT house_id, rn % ?, rn, sender_id, sender_name, message, created_at FROM (
+            SELECT *, ROW_NUMBER() OVER (PARTITION BY house_id ORDER BY id) AS rn,
+                   COUNT(*) OVER (PARTITION BY house_id) AS total
+            FROM house_chat_messages
+        ) WHERE rn > total - ?
+    """, (HOUSE_CHAT_SIZE, HOUSE_CHAT_SIZE))
+    cur.execute("""
+        UPDATE houses SET chat_seq = COALESCE((SELECT MAX(seq) FROM house_chat_ring WHERE house_chat_ring.house_id = houses.id), 0)
+    """)
+    cur.execute("DROP TABLE IF EXISTS house_chat_messages")
+
+def migrate_house_chat_exports(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS house_chat_exports(
+        user_id INTEGER NOT NULL,
+        house_id INTEGER NOT NULL,
+        last_seq INTEGER DEFAULT 0,
+        exported_at INTEGER DEFAULT 0,
+        PRIMARY KEY(user_id, house_id)
+    )
+    """)
+
+def migrate_market_filter_indexes(cur):
+    # older listings stored trucks as plain cars; the type filter relies on the column
+    trucks = [name for name, data in CARS.items() if data.get("type") == "truck"]
+    marks = ",".join("?" * len(trucks))
+    cur.execute(f"UPDATE car_market SET vehicle_type='truck' WHERE car IN ({marks})", trucks)
+    cur.execute("UPDATE car_market SET vehicle_type='car' WHERE vehicle_type IS NULL OR vehicle_type=''")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_car_market_type ON car_market(vehicle_type, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_car_market_truck_level ON car_market(vehicle_type, truck_level, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_car_market_price ON car_market(price, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_car_market_type_price ON car_market(vehicle_type, price, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_car_market_truck_level_price ON car_market(vehicle_type, truck_level, price, id)")
+
+def migrate_baseline(cur):
+    migrate_base_schema(cur)
+    migrate_legacy_columns(cur)
+
+# (version, name, migration(cursor)); append new steps, never renumber applied ones.
+# Version 0 is the schema the bot used to build at import time; databases that
+# already recorded version 1 have it, every other database gets it (idempotently).
+SCHEMA_MIGRATIONS = [
+    (0, "baseline schema", migrate_baseline),
+    (1, "hot lookup indexes", migrate_hot_lookup_indexes),
+    (2, "catalog rows", sync_catalog_rows),
+    (3, "taxi orders and scheduled jobs", migrate_durable_timers),
+    (4, "logistics order timers", migrate_logistics_order_jobs),
+    (5, "outbound message queue", migrate_outbox),
+    (6, "house chat ring buffer", migrate_house_chat_ring),
+    (7, "house chat export marks", migrate_house_chat_exports),
+    (8, "market filter indexes", migrate_market_filter_indexes),
+]
+
+def schema_version(db) -> int:
+    try:
+        return db.execute("SELECT COALESCE(MAX(version), -1) FROM schema_version").fetchone()[0]
+    except sqlite3.OperationalError:
+        db.execute("CREATE TABLE IF NOT EXISTS schema_version(version INTEGER PRIMARY KEY, name TEXT, applied_at INTEGER)")
+        db.commit()
+        return -1
+
+def run_migrations(db=None) -> int:
+    db = db or conn
+    current = schema_version(db)
+    for version, name, migration in SCHEMA_MIGRATIONS:
+        if version <= current:
+            continue
+        logging.info(f"Applying schema migration {version}: {name}")
+        cur = db.cursor()
+        cur.execute("BEGIN")
+        try:
+            migration(cur)
+            cur.execute("INSERT INTO schema_version(version, name, applied_at) VALUES(?,?,?)", (version, name, int(time.time())))
+        except Exception:
+            db.rollback()
+            raise
+        db.commit()
+        current = version
+    return current
+
+# every hot lookup with the index its plan must use
+HOT_QUERY_PLANS = [
+    ("SELECT id, order_code, city, factory_id FROM gpu_factory_orders WHERE status='pending' ORDER BY id DESC", (), "idx_gpu_orders_pending"),
+    ("SELECT COUNT(*) FROM gpu_factory_orders WHERE city=? AND status='pending'", ("Новоград",), "idx_gpu_orders_pending_city"),
+    ("SELECT id FROM gpu_factory_orders WHERE status='in_delivery' AND driver_id=? ORDER BY id DESC LIMIT 1", (1,), "idx_gpu_orders_in_delivery"),
+    ("SELECT id, car, speed FROM garage WHERE owner=?", (1,), "idx_garage_owner"),
+    ("SELECT id, city, level FROM houses WHERE owner_id=?", (1,), "sqlite_autoindex_houses_1"),
+    ("SELECT op_type, amount, fee, note, created_at FROM bank_operations WHERE account_number=? ORDER BY id DESC LIMIT 10", ("",), "idx_bank_operations_account"),
+    ("SELECT user_id FROM players WHERE account_number=?", ("",), "idx_players_account"),
+    ("SELECT id, gpu_key, remaining_qty, unit_price FROM gpu_factory_shipments WHERE factory_id=? AND remaining_qty>0 ORDER BY id DESC", (1,), "idx_gpu_shipments_available"),
+    ("SELECT sender_name, message FROM house_chat_ring WHERE house_id=? ORDER BY seq DESC LIMIT 10", (1,), "idx_house_chat_ring_seq"),
+    ("SELECT COUNT(*) FROM gpu_factory_employees WHERE factory_id=? AND employee_type='npc'", (1,), "idx_gpu_employees_factory"),
+    ("SELECT id FROM taxi_orders WHERE status='waiting' AND origin=? ORDER BY id", ("Новоград",), "idx_taxi_orders_waiting"),
+    ("SELECT id FROM taxi_orders WHERE status='in_progress' AND driver_type='player' AND driver_id=? LIMIT 1", (1,), "idx_taxi_orders_driving"),
+    ("SELECT MIN(id) AS id FROM outbox GROUP BY chat_id", (), "idx_outbox_chat"),
+    ("SELECT id FROM car_market WHERE vehicle_type=? AND id>? ORDER BY id LIMIT 1", ("car", 0), "idx_car_market_type"),
+    ("SELECT id FROM car_market WHERE vehicle_type=? AND truck_level=? AND id>? ORDER BY id LIMIT 1", ("truck", 1, 0), "idx_car_market_truck_level"),
+    ("SELECT id FROM car_market WHERE price BETWEEN ? AND ? AND price>? ORDER BY price, id LIMIT 1", (0, 100, 0), "idx_car_market_price"),
+    ("SELECT id FROM car_market WHERE vehicle_type=? AND price BETWEEN ? AND ? AND price>? ORDER BY price, id LIMIT 1", ("car", 0, 100, 50), "idx_car_market_type_price"),
+]
+
+def check_hot_query_plans(db=None) -> list:
+    db = db or conn
+    failures = []
+    for sql, params, index_name in HOT_QUERY_PLANS:
+        plan = " | ".join(row[-1] for row in db.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall())
+        if index_name not in plan:
+            failures.append(f"{sql} -> {plan}")
+    return failures
+
+def assert_hot_query_plans(db=None):
+    failures = check_hot_query_plans(db)
+    assert not failures, "Hot queries are not using their indexes:\n" + "\n".join(failures)
 
 # ---------------- DATA ----------------
 
@@ -521,26 +967,6 @@ GPU_FACTORY_BASE_SLOTS = 5
 GPU_FACTORY_WAREHOUSE_BASE = 5000
 GPU_FACTORY_BUMP_PRICE = 35000
 
-STATE_PREFIXES = {
-    "factory_buy_name": "factory_buy_name:",
-    "factory_order_units": "factory_order_units:",
-    "factory_post_slots": "factory_post_slots:",
-    "factory_post_salary": "factory_post_salary:",
-    "factory_post_desc": "factory_post_desc:",
-    "shop_buy_name": "shop_buy_name:",
-    "shop_markup": "shop_markup:",
-    "friend_add_manual": "friend_add_manual",
-    "house_invite_id": "house_invite_id:",
-    "house_chat": "house_chat:",
-    "house_store_move": "house_store_move:",
-    "house_store_take": "house_store_take:",
-    "trade_money": "trade_money:",
-    "trade_add_item": "trade_add_item:",
-    "trade_add_item_amount": "trade_add_item_amount:",
-    "logistics_tip": "logistics_tip:",
-}
-
-
 HOUSE_IMAGES = {
     "Новоград": "https://files.catbox.moe/xh5xi9.jpg",
     "Инд-Сити": "https://files.catbox.moe/bewlc5.jpg",
@@ -553,6 +979,9 @@ HOUSE_PRICES = {
     "Форс-Сити": 2200000,
     "Вегаспорт": 3500000,
 }
+HOUSE_CHAT_SIZE = 100
+HOUSE_CHAT_EXPORT_MAX_BYTES = 512 * 1024
+HOUSE_CHAT_EXPORT_GZIP_BYTES = 16 * 1024
 HOUSE_STREET_WORDS = ["Элджеевка", "Мурино", "Друновка", "Габелло", "Жмуркино", "Рофлянская", "Базарная", "Шишкарево"]
 HOUSE_STOREABLE_ITEMS = [
     "sharpening_stones", "zatocka", "super_zatocka", "garage_upgrade", "warehouse_upgrade",
@@ -676,14 +1105,8 @@ STARTER_ITEMS = [
     "truck_capacity_module_s",
 ]
 
-for car in CARS:
-    cursor.execute("INSERT OR IGNORE INTO dealership(car, stock) VALUES(?, ?)", (car, 500))
-conn.commit()
-
 mine_sessions = {}
 factory_sessions = {}
-taxi_orders = {}
-next_taxi_order_id = 1
 
 # ---------------- IMAGE BUILDERS ----------------
 
@@ -692,10 +1115,13 @@ GENERATED_DIR = "generated_chars"
 os.makedirs(CACHE_DIR, exist_ok=True)
 os.makedirs(GENERATED_DIR, exist_ok=True)
 
-def cached_download(url: str) -> str:
+def cached_download_path(url: str) -> str:
     ext = os.path.splitext(url.split("?")[0])[1] or ".img"
     name = hashlib.md5(url.encode("utf-8")).hexdigest() + ext
-    path = os.path.join(CACHE_DIR, name)
+    return os.path.join(CACHE_DIR, name)
+
+def cached_download(url: str) -> str:
+    path = cached_download_path(url)
 
     if os.path.exists(path):
         return path
@@ -709,8 +1135,10 @@ def cached_download(url: str) -> str:
             response = requests.get(url, timeout=20, headers=headers)
             response.raise_for_status()
 
-            with open(path, "wb") as f:
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
                 f.write(response.content)
+            os.replace(tmp_path, path)
 
             return path
 
@@ -720,13 +1148,18 @@ def cached_download(url: str) -> str:
 
     raise Exception(f"Failed to download image: {url}")
 
-def open_rgba(url: str) -> Image.Image:
-    try:
-        path = cached_download(url)
-        return Image.open(path).convert("RGBA")
-    except Exception as e:
-        logging.error(f"Image load failed: {url} {e}")
-        return Image.new("RGBA", (512,512), (0,0,0,0))
+LAYER_CACHE_SIZE = 32
+
+@functools.lru_cache(maxsize=LAYER_CACHE_SIZE)
+def load_layer(url: str, size=None) -> Image.Image:
+    # cached images are shared, callers must copy before drawing on them
+    if size is not None:
+        layer = load_layer(url)
+        return layer if layer.size == size else layer.resize(size)
+    path = cached_download(url)
+    with Image.open(path) as img:
+        return img.convert("RGBA")
+
 def get_top_meta(key: str):
     for item in CHAR_TOPS:
         if item["key"] == key:
@@ -745,15 +1178,17 @@ def get_hair_meta(key: str):
             return item
     return None
 
-def build_layered_character(top_key: str = "", bottom_key: str = "", hair_key: str = "") -> str:
+def character_image_path(top_key: str = "", bottom_key: str = "", hair_key: str = "") -> str:
+    top = get_top_meta(top_key) if top_key else None
+    key = f"{top_key}_{bottom_key}_{hair_key}_{'noarms' if top and top['hide_arms'] else 'arms'}"
+    return os.path.join(GENERATED_DIR, hashlib.md5(key.encode("utf-8")).hexdigest() + ".png")
+
+def character_layer_urls(top_key: str = "", bottom_key: str = "", hair_key: str = "") -> list:
     top = get_top_meta(top_key) if top_key else None
     bottom = get_bottom_meta(bottom_key) if bottom_key else None
     hair = get_hair_meta(hair_key) if hair_key else None
 
-    base_url = LAYER_BASE_NO_ARMS if top and top["hide_arms"] else LAYER_BASE_WITH_ARMS
-    base = open_rgba(base_url)
-
-    layers = []
+    layers = [LAYER_BASE_NO_ARMS if top and top["hide_arms"] else LAYER_BASE_WITH_ARMS]
     if top and top["special_bottom"]:
         layers.append(top["layer"])
         if bottom:
@@ -765,17 +1200,266 @@ def build_layered_character(top_key: str = "", bottom_key: str = "", hair_key: s
             layers.append(top["layer"])
     if hair:
         layers.append(hair["layer"])
+    return layers
+
+def build_layered_character(top_key: str = "", bottom_key: str = "", hair_key: str = "", force: bool = False) -> str:
+    out_path = character_image_path(top_key, bottom_key, hair_key)
+    if not force and os.path.exists(out_path):
+        return out_path
+
+    base_url, *layers = character_layer_urls(top_key, bottom_key, hair_key)
+    complete = True
+    try:
+        base = load_layer(base_url).copy()
+    except Exception as e:
+        logging.error(f"Image load failed: {base_url} {e}")
+        base = Image.new("RGBA", (512,512), (0,0,0,0))
+        complete = False
 
     for layer_url in layers:
-        layer = open_rgba(layer_url)
-        if layer.size != base.size:
-            layer = layer.resize(base.size)
+        try:
+            layer = load_layer(layer_url, base.size)
+        except Exception as e:
+            logging.error(f"Image load failed: {layer_url} {e}")
+            complete = False
+            continue
         base.alpha_composite(layer)
 
-    key = f"{top_key}_{bottom_key}_{hair_key}_{'noarms' if top and top['hide_arms'] else 'arms'}"
-    out_path = os.path.join(GENERATED_DIR, hashlib.md5(key.encode("utf-8")).hexdigest() + ".png")
-    base.save(out_path)
-    return out_path
+    # a picture with missing layers is still shown, but never reused from disk:
+    # it goes to one scratch file per outfit, removed once the outfit renders fully
+    partial_path = out_path[:-4] + "_partial.png"
+    target_path = out_path if complete else partial_path
+    tmp_path = f"{target_path}.{os.getpid()}.tmp"
+    base.save(tmp_path, format="PNG")
+    os.replace(tmp_path, target_path)
+    if complete:
+        try:
+            os.remove(partial_path)
+        except OSError:
+            pass
+    return target_path
+
+def remove_partial_renders():
+    # partial renders left by the previous run; called before handlers start
+    for name in os.listdir(GENERATED_DIR):
+        if name.endswith("_partial.png"):
+            try:
+                os.remove(os.path.join(GENERATED_DIR, name))
+            except OSError:
+                pass
+
+# Downloads run on threads, compositing on worker processes; the event loop only awaits.
+IMAGE_DOWNLOAD_WORKERS = 8
+IMAGE_RENDER_WORKERS = 2
+image_download_executor = None
+image_render_executor = None
+image_jobs = {}
+
+def get_image_download_executor():
+    global image_download_executor
+    if image_download_executor is None:
+        image_download_executor = ThreadPoolExecutor(max_workers=IMAGE_DOWNLOAD_WORKERS, thread_name_prefix="image-download")
+    return image_download_executor
+
+def character_layer_catalog() -> list:
+    urls = [LAYER_BASE_WITH_ARMS, LAYER_BASE_NO_ARMS]
+    for item in CHAR_TOPS + CHAR_BOTTOMS + CHAR_HAIRS:
+        urls.append(item["layer"])
+    return list(dict.fromkeys(urls))
+
+def catalog_image_urls() -> list:
+    urls = character_layer_catalog()
+    urls += list(HOUSE_IMAGES.values()) + list(BANK_IMAGES.values())
+    urls += [FACTORY_IMAGE, FACTORY_MANAGEMENT_IMAGE, FACTORY_STORAGE_IMAGE, GPU_SHOP_IMAGE]
+    urls += [car["img"] for car in CARS.values() if car.get("img")]
+    urls += [car["img"] for car in TAXI_RENTALS if car.get("img")]
+    return list(dict.fromkeys(urls))
+
+def predecode_character_layers():
+    # runs in every render worker so the first composite does not pay for PNG decoding
+    for url in character_layer_catalog():
+        if os.path.exists(cached_download_path(url)):
+            try:
+                load_layer(url)
+            except Exception as e:
+                logging.warning(f"Layer predecode failed {url}: {e}")
+
+def get_image_render_executor():
+    global image_render_executor
+    if image_render_executor is None:
+        image_render_executor = ProcessPoolExecutor(max_workers=IMAGE_RENDER_WORKERS, initializer=predecode_character_layers)
+    return image_render_executor
+
+def shutdown_image_executors():
+    global image_download_executor, image_render_executor
+    if image_download_executor is not None:
+        image_download_executor.shutdown(wait=False, cancel_futures=True)
+        image_download_executor = None
+    if image_render_executor is not None:
+        image_render_executor.shutdown(wait=False, cancel_futures=True)
+        image_render_executor = None
+
+async def run_image_job(job_key, executor, func, *args):
+    # concurrent callers asking for the same key share one executor job
+    job = image_jobs.get(job_key)
+    if job is None:
+        job = asyncio.get_running_loop().run_in_executor(executor, func, *args)
+        image_jobs[job_key] = job
+        job.add_done_callback(lambda _: image_jobs.pop(job_key, None))
+    return await asyncio.shield(job)
+
+async def cached_download_async(url: str) -> str:
+    path = cached_download_path(url)
+    if os.path.exists(path):
+        return path
+    return await run_image_job(("download", url), get_image_download_executor(), cached_download, url)
+
+IMAGE_WARMUP_CONCURRENCY = 6
+
+def verify_cached_image(url: str) -> bool:
+    path = cached_download_path(url)
+    try:
+        with Image.open(path) as img:
+            img.verify()
+        return True
+    except Exception as e:
+        logging.warning(f"Cached image is broken, dropping {url}: {e}")
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return False
+
+def fetch_verified_image(url: str) -> str:
+    path = cached_download(url)
+    if verify_cached_image(url):
+        return path
+    path = cached_download(url)
+    if not verify_cached_image(url):
+        raise Exception(f"Downloaded image is not readable: {url}")
+    return path
+
+async def warm_up_images():
+    global image_render_executor
+    urls = catalog_image_urls()
+    total = len(urls)
+    semaphore = asyncio.Semaphore(IMAGE_WARMUP_CONCURRENCY)
+    loop = asyncio.get_running_loop()
+    done = 0
+    failed = []
+    started = time.time()
+
+    async def fetch(url):
+        nonlocal done
+        async with semaphore:
+            try:
+                # own key: a plain cached_download job for the same url skips verification
+                await run_image_job(("download_verified", url), get_image_download_executor(), fetch_verified_image, url)
+            except Exception as e:
+                failed.append(url)
+                logging.error(f"Image warm-up failed {url}: {e}")
+        done += 1
+        if done % 10 == 0 or done == total:
+            logging.info(f"Image warm-up: {done}/{total} assets")
+
+    await asyncio.gather(*(fetch(url) for url in urls))
+    # render workers predecode in the pool initializer. a pool started by an early
+    # render had no layers on disk yet, so it is replaced, then every worker is
+    # started now instead of on the first user render
+    if image_render_executor is not None:
+        image_render_executor.shutdown(wait=False)
+        image_render_executor = None
+    executor = get_image_render_executor()
+    results = await asyncio.gather(*(loop.run_in_executor(executor, os.getpid) for _ in range(IMAGE_RENDER_WORKERS)), return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logging.error(f"Render worker start failed: {result}")
+    logging.info(f"Image subsystem ready in {time.time() - started:.1f}s, {total - len(failed)}/{total} assets cached")
+
+ATLAS_MANIFEST_PATH = os.path.join(GENERATED_DIR, "atlas_manifest.json")
+
+def outfit_combinations() -> list:
+    tops = [""] + [item["key"] for item in CHAR_TOPS]
+    bottoms = [""] + [item["key"] for item in CHAR_BOTTOMS]
+    hairs = [""] + [item["key"] for item in CHAR_HAIRS]
+    return [(top, bottom, hair) for top in tops for bottom in bottoms for hair in hairs]
+
+def outfit_signature(top_key: str, bottom_key: str, hair_key: str) -> str:
+    return hashlib.md5("|".join(character_layer_urls(top_key, bottom_key, hair_key)).encode("utf-8")).hexdigest()
+
+def load_atlas_manifest() -> dict:
+    try:
+        with open(ATLAS_MANIFEST_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_atlas_manifest(manifest: dict):
+    tmp_path = ATLAS_MANIFEST_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(tmp_path, ATLAS_MANIFEST_PATH)
+
+async def build_outfit_atlas() -> dict:
+    # renders only combinations that are new or whose layer urls changed since the last run
+    manifest = load_atlas_manifest()
+    pending = []
+    for top_key, bottom_key, hair_key in outfit_combinations():
+        combo = f"{top_key}|{bottom_key}|{hair_key}"
+        signature = outfit_signature(top_key, bottom_key, hair_key)
+        entry = manifest.get(combo)
+        if entry and entry["signature"] == signature and os.path.exists(os.path.join(GENERATED_DIR, entry["file"])):
+            continue
+        pending.append((combo, signature, top_key, bottom_key, hair_key, bool(entry)))
+    if not pending:
+        return manifest
+
+    logging.info(f"Outfit atlas: rendering {len(pending)} combinations")
+    await asyncio.gather(*(cached_download_async(url) for url in character_layer_catalog()), return_exceptions=True)
+    loop = asyncio.get_running_loop()
+    executor = get_image_render_executor()
+    results = await asyncio.gather(
+        *(loop.run_in_executor(executor, build_layered_character, top_key, bottom_key, hair_key, stale)
+          for _, _, top_key, bottom_key, hair_key, stale in pending),
+        return_exceptions=True,
+    )
+    for (combo, signature, *_), path in zip(pending, results):
+        if isinstance(path, Exception):
+            logging.error(f"Outfit atlas render failed {combo}: {path}")
+            continue
+        if path.endswith("_partial.png"):
+            continue
+        manifest[combo] = {"file": os.path.basename(path), "signature": signature}
+    save_atlas_manifest(manifest)
+    logging.info(f"Outfit atlas: {len(manifest)}/{len(outfit_combinations())} combinations ready")
+    return manifest
+
+async def warm_up_image_subsystem():
+    await warm_up_images()
+    try:
+        await build_outfit_atlas()
+    except Exception:
+        logging.exception("Outfit atlas build failed")
+
+async def build_layered_character_async(top_key: str = "", bottom_key: str = "", hair_key: str = "", force: bool = False) -> str:
+    global image_render_executor
+    out_path = character_image_path(top_key, bottom_key, hair_key)
+    if not force and os.path.exists(out_path):
+        return out_path
+    results = await asyncio.gather(
+        *(cached_download_async(url) for url in character_layer_urls(top_key, bottom_key, hair_key)),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logging.error(f"Image download failed: {result}")
+    try:
+        return await run_image_job(
+            ("character", out_path, force), get_image_render_executor(), build_layered_character, top_key, bottom_key, hair_key, force
+        )
+    except BrokenProcessPool:
+        image_render_executor = None
+        raise
 
 # ---------------- PLAYER HELPERS ----------------
 
@@ -784,16 +1468,15 @@ def generate_account_number() -> str:
         digits = "".join(random.choice("0123456789") for _ in range(4))
         letters = "".join(random.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ") for _ in range(4))
         acc = digits + letters
-        cursor.execute("SELECT 1 FROM players WHERE account_number=? LIMIT 1", (acc,))
-        if cursor.fetchone() is None:
+        if db_fetchone("SELECT 1 FROM players WHERE account_number=? LIMIT 1", (acc,)) is None:
             return acc
 
 def log_bank_operation(account_number: str, user_id: int, city: str, op_type: str, amount: float, fee: float = 0, note: str = ""):
-    cursor.execute(
+    db_execute(
         "INSERT INTO bank_operations(account_number, user_id, city, op_type, amount, fee, note, created_at) VALUES(?,?,?,?,?,?,?,?)",
         (account_number, user_id, city, op_type, float(amount), float(fee), note, int(time.time())),
     )
-    conn.commit()
+    db_commit()
 
 def format_money(amount: float) -> str:
     amount = round(float(amount), 2)
@@ -801,59 +1484,23 @@ def format_money(amount: float) -> str:
         return f"{int(amount)}$"
     return f"{amount:.2f}$"
 
-def ensure_player_items(uid: int):
-    for item_key in STARTER_ITEMS:
-        cursor.execute(
-            "INSERT OR IGNORE INTO player_items(user_id, item_key, amount) VALUES(?,?,0)",
-            (uid, item_key),
-        )
-    conn.commit()
-
-def get_player(uid: int):
-    cursor.execute("""
-        SELECT user_id, city, money, taxi_level, taxi_rides, char_created, char_top, char_bottom, char_hair, bank_balance, bank_btc, account_number, current_house_id,
-               logistics_level, logistics_done, logistics_rent_truck, logistics_rent_remaining
-        FROM players WHERE user_id=?
-    """, (uid,))
-    row = cursor.fetchone()
-    if not row:
-        account_number = generate_account_number()
-        cursor.execute(
-            "INSERT INTO players(user_id, city, money, taxi_level, taxi_rides, char_created, char_top, char_bottom, char_hair, bank_balance, bank_btc, account_number) VALUES(?,?,?,?,?,?,?,?,?,?,?,?)",
-            (uid, "Новоград", 100000, 1, 0, 0, "", "", "", 0, 0, account_number),
-        )
-        cursor.execute("INSERT OR IGNORE INTO mine_rewards(user_id, sharpening_stones) VALUES(?, ?)", (uid, 0))
-        conn.commit()
-        ensure_player_items(uid)
-        return {
-            "city": "Новоград",
-            "money": 100000,
-            "taxi_level": 1,
-            "taxi_rides": 0,
-            "char_created": 0,
-            "char_top": "",
-            "char_bottom": "",
-            "char_hair": "",
-            "bank_balance": 0,
-            "bank_btc": 0.0,
-            "account_number": account_number,
-            "current_house_id": 0,
-            "logistics_level": 1,
-            "logistics_done": 0,
-            "logistics_rent_truck": "",
-            "logistics_rent_remaining": 0,
-        }
+provisioned_players = set()
 
-    if not row[11]:
-        account_number = generate_account_number()
-        cursor.execute("UPDATE players SET account_number=? WHERE user_id=?", (account_number, uid))
-        conn.commit()
-        row = list(row)
-        row[11] = account_number
+def ensure_player_items(uid: int):
+    db_executemany(
+        "INSERT OR IGNORE INTO player_items(user_id, item_key, amount) VALUES(?,?,0)",
+        [(uid, item_key) for item_key in STARTER_ITEMS],
+    )
+    db_commit()
 
-    cursor.execute("INSERT OR IGNORE INTO mine_rewards(user_id, sharpening_stones) VALUES(?, ?)", (uid, 0))
-    conn.commit()
+def provision_player(uid: int):
+    if uid in provisioned_players:
+        return
+    db_execute("INSERT OR IGNORE INTO mine_rewards(user_id, sharpening_stones) VALUES(?, ?)", (uid, 0))
     ensure_player_items(uid)
+    provisioned_players.add(uid)
+
+def player_from_row(row) -> dict:
     return {
         "city": row[1],
         "money": row[2],
@@ -866,62 +1513,117 @@ def get_player(uid: int):
         "bank_balance": row[9] or 0,
         "bank_btc": float(row[10] or 0),
         "account_number": row[11] or "",
-        "current_house_id": row[12] if len(row) > 12 else 0,
-        "logistics_level": row[13] if len(row) > 13 and row[13] else 1,
-        "logistics_done": row[14] if len(row) > 14 and row[14] else 0,
-        "logistics_rent_truck": row[15] if len(row) > 15 and row[15] else "",
-        "logistics_rent_remaining": row[16] if len(row) > 16 and row[16] else 0,
+        "current_house_id": row[12] or 0,
+        "logistics_level": row[13] or 1,
+        "logistics_done": row[14] or 0,
+        "logistics_rent_truck": row[15] or "",
+        "logistics_rent_remaining": row[16] or 0,
     }
 
+def register_player(uid: int) -> dict:
+    account_number = generate_account_number()
+    db_execute(
+        "INSERT INTO players(user_id, city, money, taxi_level, taxi_rides, char_created, char_top, char_bottom, char_hair, bank_balance, bank_btc, account_number) VALUES(?,?,?,?,?,?,?,?,?,?,?,?)",
+        (uid, "Новоград", 100000, 1, 0, 0, "", "", "", 0, 0, account_number),
+    )
+    provisioned_players.discard(uid)
+    provision_player(uid)
+    return player_from_row((uid, "Новоград", 100000, 1, 0, 0, "", "", "", 0, 0, account_number, 0, 1, 0, "", 0))
+
+PLAYER_SELECT_SQL = """
+    SELECT user_id, city, money, taxi_level, taxi_rides, char_created, char_top, char_bottom, char_hair, bank_balance, bank_btc, account_number, current_house_id,
+           logistics_level, logistics_done, logistics_rent_truck, logistics_rent_remaining
+    FROM players WHERE user_id=?
+"""
+
+def get_player(uid: int):
+    row = db_fetchone(PLAYER_SELECT_SQL, (uid,))
+    if not row:
+        return register_player(uid)
+
+    # only legacy rows without an account number and the first call after a restart write anything
+    if not row[11]:
+        account_number = generate_account_number()
+        db_execute("UPDATE players SET account_number=? WHERE user_id=?", (account_number, uid))
+        db_commit()
+        row = list(row)
+        row[11] = account_number
+
+    if uid not in provisioned_players:
+        provision_player(uid)
+    return player_from_row(row)
+
+async def get_player_async(uid: int):
+    row = await fetchone_async(PLAYER_SELECT_SQL, (uid,))
+    if not row or not row[11] or uid not in provisioned_players:
+        # registration and the one-off backfills stay on the sync path
+        return get_player(uid)
+    return player_from_row(row)
+
 def get_money(uid: int) -> int:
-    return get_player(uid)["money"]
+    row = db_fetchone("SELECT money FROM players WHERE user_id=?", (uid,))
+    if row is None:
+        return get_player(uid)["money"]
+    return row[0]
 
 def add_money(uid: int, amount: int):
-    cursor.execute("UPDATE players SET money = money + ? WHERE user_id=?", (amount, uid))
-    conn.commit()
+    db_execute("UPDATE players SET money = money + ? WHERE user_id=?", (amount, uid))
+    db_commit()
+
+async def add_money_async(uid: int, amount: int):
+    await execute_async("UPDATE players SET money=money+? WHERE user_id=?", (amount, uid))
+
+def debit_money(uid: int, amount: int) -> bool:
+    # guarded debit for purchases: False (and nothing written) when the balance is short
+    cur = db_execute("UPDATE players SET money=money-? WHERE user_id=? AND money>=?", (amount, uid, amount))
+    db_commit()
+    return cur.rowcount == 1
 
 def set_city(uid: int, city: str):
-    cursor.execute("UPDATE players SET city=? WHERE user_id=?", (city, uid))
-    conn.commit()
+    db_execute("UPDATE players SET city=? WHERE user_id=?", (city, uid))
+    db_commit()
 
 def set_bank_balance(uid: int, amount: float):
-    cursor.execute("UPDATE players SET bank_balance=? WHERE user_id=?", (int(round(amount)), uid))
-    conn.commit()
+    db_execute("UPDATE players SET bank_balance=? WHERE user_id=?", (int(round(amount)), uid))
+    db_commit()
 
 def add_bank_balance(uid: int, amount: float):
-    cursor.execute("UPDATE players SET bank_balance = bank_balance + ? WHERE user_id=?", (int(round(amount)), uid))
-    conn.commit()
+    db_execute("UPDATE players SET bank_balance = bank_balance + ? WHERE user_id=?", (int(round(amount)), uid))
+    db_commit()
 
 def add_bank_btc(uid: int, amount: float):
-    cursor.execute("UPDATE players SET bank_btc = bank_btc + ? WHERE user_id=?", (float(amount), uid))
-    conn.commit()
+    db_execute("UPDATE players SET bank_btc = bank_btc + ? WHERE user_id=?", (float(amount), uid))
+    db_commit()
 
 def set_bank_btc(uid: int, amount: float):
-    cursor.execute("UPDATE players SET bank_btc=? WHERE user_id=?", (float(amount), uid))
-    conn.commit()
+    db_execute("UPDATE players SET bank_btc=? WHERE user_id=?", (float(amount), uid))
+    db_commit()
 
 def find_player_by_account(account_number: str):
-    cursor.execute("SELECT user_id FROM players WHERE account_number=?", (account_number.upper(),))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT user_id FROM players WHERE account_number=?", (account_number.upper(),))
     return row[0] if row else None
 
 def add_sharpening_stone(uid: int, amount: int = 1):
-    cursor.execute("INSERT OR IGNORE INTO mine_rewards(user_id, sharpening_stones) VALUES(?, ?)", (uid, 0))
-    cursor.execute("UPDATE mine_rewards SET sharpening_stones = sharpening_stones + ? WHERE user_id=?", (amount, uid))
-    cursor.execute("UPDATE player_items SET amount = amount + ? WHERE user_id=? AND item_key='sharpening_stones'", (amount, uid))
-    conn.commit()
+    db_execute("INSERT OR IGNORE INTO mine_rewards(user_id, sharpening_stones) VALUES(?, ?)", (uid, 0))
+    db_execute("UPDATE mine_rewards SET sharpening_stones = sharpening_stones + ? WHERE user_id=?", (amount, uid))
+    db_execute("INSERT OR IGNORE INTO player_items(user_id, item_key, amount) VALUES(?,?,0)", (uid, "sharpening_stones"))
+    db_execute("UPDATE player_items SET amount = amount + ? WHERE user_id=? AND item_key='sharpening_stones'", (amount, uid))
+    db_commit()
 
 def get_item_amount(uid: int, item_key: str) -> int:
-    ensure_player_items(uid)
-    cursor.execute("SELECT amount FROM player_items WHERE user_id=? AND item_key=?", (uid, item_key))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT amount FROM player_items WHERE user_id=? AND item_key=?", (uid, item_key))
     return row[0] if row else 0
 
+def get_inventory(uid: int) -> dict:
+    inventory = {item_key: 0 for item_key in STARTER_ITEMS}
+    for item_key, amount in db_fetchall("SELECT item_key, amount FROM player_items WHERE user_id=?", (uid,)):
+        inventory[item_key] = amount
+    return inventory
+
 def add_taxi_ride(uid: int):
-    cursor.execute("UPDATE players SET taxi_rides = taxi_rides + 1 WHERE user_id=?", (uid,))
-    conn.commit()
-    cursor.execute("SELECT taxi_rides, taxi_level FROM players WHERE user_id=?", (uid,))
-    rides, level = cursor.fetchone()
+    db_execute("UPDATE players SET taxi_rides = taxi_rides + 1 WHERE user_id=?", (uid,))
+    db_commit()
+    rides, level = db_fetchone("SELECT taxi_rides, taxi_level FROM players WHERE user_id=?", (uid,))
     new_level = level
     if rides >= 40:
         new_level = 5
@@ -932,25 +1634,25 @@ def add_taxi_ride(uid: int):
     elif rides >= 5:
         new_level = 2
     if new_level != level:
-        cursor.execute("UPDATE players SET taxi_level=? WHERE user_id=?", (new_level, uid))
-        conn.commit()
+        db_execute("UPDATE players SET taxi_level=? WHERE user_id=?", (new_level, uid))
+        db_commit()
         return new_level
     return None
 
 def set_char_part(uid: int, field_name: str, value: str):
-    cursor.execute(f"UPDATE players SET {field_name}=? WHERE user_id=?", (value, uid))
-    conn.commit()
+    db_execute(f"UPDATE players SET {field_name}=? WHERE user_id=?", (value, uid))
+    db_commit()
 
 def set_char_created(uid: int, created: int):
-    cursor.execute("UPDATE players SET char_created=? WHERE user_id=?", (created, uid))
-    conn.commit()
+    db_execute("UPDATE players SET char_created=? WHERE user_id=?", (created, uid))
+    db_commit()
 
 def reset_character(uid: int):
-    cursor.execute(
+    db_execute(
         "UPDATE players SET char_created=0, char_top='', char_bottom='', char_hair='' WHERE user_id=?",
         (uid,),
     )
-    conn.commit()
+    db_commit()
 
 def character_summary_text(player: dict):
     top = get_top_meta(player["char_top"])
@@ -963,31 +1665,14 @@ def character_summary_text(player: dict):
     )
 
 def has_any_car(uid: int) -> bool:
-    cursor.execute("SELECT 1 FROM garage WHERE owner=? LIMIT 1", (uid,))
-    return cursor.fetchone() is not None
+    return db_fetchone("SELECT 1 FROM garage WHERE owner=? LIMIT 1", (uid,)) is not None
 
 
 
 # ---------------- GPU FACTORY HELPERS ----------------
 
-def ensure_gpu_factory_rows():
-    for city in ["Новоград", "Инд-Сити", "Форс-Сити", "Вегаспорт"]:
-        cursor.execute("INSERT OR IGNORE INTO gpu_factories(city) VALUES(?)", (city,))
-    conn.commit()
-
-ensure_gpu_factory_rows()
-
-def ensure_gpu_shop_rows():
-    for city in ["Новоград", "Инд-Сити", "Форс-Сити", "Вегаспорт"]:
-        cursor.execute("INSERT OR IGNORE INTO gpu_shops(city) VALUES(?)", (city,))
-    conn.commit()
-
-ensure_gpu_shop_rows()
-
 def gpu_shop_row(city: str):
-    ensure_gpu_shop_rows()
-    cursor.execute("SELECT id, city, owner_id, name, markup_percent, pending_profit, supplier_factory_city FROM gpu_shops WHERE city=?", (city,))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT id, city, owner_id, name, markup_percent, pending_profit, supplier_factory_city FROM gpu_shops WHERE city=?", (city,))
     return {
         "id": row[0], "city": row[1], "owner_id": row[2], "name": row[3] or "",
         "markup_percent": row[4] or 18, "pending_profit": row[5] or 0,
@@ -998,44 +1683,30 @@ def gpu_shop_display_name(shop: dict) -> str:
     return shop["name"] if shop["name"] else f"Магазин видеокарт | {shop['city']}"
 
 def get_shop_inventory(shop_id: int):
-    cursor.execute("SELECT gpu_key, qty, base_price FROM gpu_shop_inventory WHERE shop_id=? ORDER BY gpu_key", (shop_id,))
-    return cursor.fetchall()
+    return db_fetchall("SELECT gpu_key, qty, base_price FROM gpu_shop_inventory WHERE shop_id=? ORDER BY gpu_key", (shop_id,))
 
 def upsert_shop_inventory(shop_id: int, gpu_key: str, qty_add: int, base_price: int):
-    cursor.execute("SELECT qty, base_price FROM gpu_shop_inventory WHERE shop_id=? AND gpu_key=?", (shop_id, gpu_key))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT qty, base_price FROM gpu_shop_inventory WHERE shop_id=? AND gpu_key=?", (shop_id, gpu_key))
     if row:
         qty, old_base = row
         new_qty = qty + qty_add
         avg_base = base_price if qty == 0 else int(round(((qty * old_base) + (qty_add * base_price)) / max(1, new_qty)))
-        cursor.execute("UPDATE gpu_shop_inventory SET qty=?, base_price=? WHERE shop_id=? AND gpu_key=?", (new_qty, avg_base, shop_id, gpu_key))
+        db_execute("UPDATE gpu_shop_inventory SET qty=?, base_price=? WHERE shop_id=? AND gpu_key=?", (new_qty, avg_base, shop_id, gpu_key))
     else:
-        cursor.execute("INSERT INTO gpu_shop_inventory(shop_id, gpu_key, qty, base_price) VALUES(?,?,?,?)", (shop_id, gpu_key, qty_add, base_price))
-    conn.commit()
+        db_execute("INSERT INTO gpu_shop_inventory(shop_id, gpu_key, qty, base_price) VALUES(?,?,?,?)", (shop_id, gpu_key, qty_add, base_price))
+    db_commit()
 
 def add_player_gpu(uid: int, gpu_key: str, qty: int = 1):
     item_key = GPU_KEY_TO_ITEM[gpu_key]
-    cursor.execute("INSERT OR IGNORE INTO player_items(user_id, item_key, amount) VALUES(?,?,0)", (uid, item_key))
-    cursor.execute("UPDATE player_items SET amount = amount + ? WHERE user_id=? AND item_key=?", (qty, uid, item_key))
-    conn.commit()
+    db_execute("INSERT OR IGNORE INTO player_items(user_id, item_key, amount) VALUES(?,?,0)", (uid, item_key))
+    db_execute("UPDATE player_items SET amount = amount + ? WHERE user_id=? AND item_key=?", (qty, uid, item_key))
+    db_commit()
 
 def shop_sell_price(base_price: int, markup_percent: int):
     return int(round(base_price * (1 + markup_percent / 100.0)))
 
-def gpu_factory_row(city: str):
-    ensure_gpu_factory_rows()
-
-def ensure_gpu_shop_rows():
-    for city in ["Новоград", "Инд-Сити", "Форс-Сити", "Вегаспорт"]:
-        cursor.execute("INSERT OR IGNORE INTO gpu_shops(city) VALUES(?)", (city,))
-    conn.commit()
-
-ensure_gpu_shop_rows()
-
 def gpu_shop_row(city: str):
-    ensure_gpu_shop_rows()
-    cursor.execute("SELECT id, city, owner_id, name, markup_percent, pending_profit, supplier_factory_city FROM gpu_shops WHERE city=?", (city,))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT id, city, owner_id, name, markup_percent, pending_profit, supplier_factory_city FROM gpu_shops WHERE city=?", (city,))
     return {
         "id": row[0], "city": row[1], "owner_id": row[2], "name": row[3] or "",
         "markup_percent": row[4] or 18, "pending_profit": row[5] or 0,
@@ -1046,30 +1717,28 @@ def gpu_shop_display_name(shop: dict) -> str:
     return shop["name"] if shop["name"] else f"Магазин видеокарт | {shop['city']}"
 
 def get_shop_inventory(shop_id: int):
-    cursor.execute("SELECT gpu_key, qty, base_price FROM gpu_shop_inventory WHERE shop_id=? ORDER BY gpu_key", (shop_id,))
-    return cursor.fetchall()
+    return db_fetchall("SELECT gpu_key, qty, base_price FROM gpu_shop_inventory WHERE shop_id=? ORDER BY gpu_key", (shop_id,))
 
 def upsert_shop_inventory(shop_id: int, gpu_key: str, qty_add: int, base_price: int):
-    cursor.execute("SELECT qty, base_price FROM gpu_shop_inventory WHERE shop_id=? AND gpu_key=?", (shop_id, gpu_key))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT qty, base_price FROM gpu_shop_inventory WHERE shop_id=? AND gpu_key=?", (shop_id, gpu_key))
     if row:
         qty, old_base = row
         new_qty = qty + qty_add
         avg_base = base_price if qty == 0 else int(round(((qty * old_base) + (qty_add * base_price)) / max(1, new_qty)))
-        cursor.execute("UPDATE gpu_shop_inventory SET qty=?, base_price=? WHERE shop_id=? AND gpu_key=?", (new_qty, avg_base, shop_id, gpu_key))
+        db_execute("UPDATE gpu_shop_inventory SET qty=?, base_price=? WHERE shop_id=? AND gpu_key=?", (new_qty, avg_base, shop_id, gpu_key))
     else:
-        cursor.execute("INSERT INTO gpu_shop_inventory(shop_id, gpu_key, qty, base_price) VALUES(?,?,?,?)", (shop_id, gpu_key, qty_add, base_price))
-    conn.commit()
+        db_execute("INSERT INTO gpu_shop_inventory(shop_id, gpu_key, qty, base_price) VALUES(?,?,?,?)", (shop_id, gpu_key, qty_add, base_price))
+    db_commit()
 
 def add_player_gpu(uid: int, gpu_key: str, qty: int = 1):
     item_key = GPU_KEY_TO_ITEM[gpu_key]
-    cursor.execute("INSERT OR IGNORE INTO player_items(user_id, item_key, amount) VALUES(?,?,0)", (uid, item_key))
-    cursor.execute("UPDATE player_items SET amount = amount + ? WHERE user_id=? AND item_key=?", (qty, uid, item_key))
-    conn.commit()
+    db_execute("INSERT OR IGNORE INTO player_items(user_id, item_key, amount) VALUES(?,?,0)", (uid, item_key))
+    db_execute("UPDATE player_items SET amount = amount + ? WHERE user_id=? AND item_key=?", (qty, uid, item_key))
+    db_commit()
 
 def shop_sell_price(base_price: int, markup_percent: int):
     return int(round(base_price * (1 + markup_percent / 100.0)))
-    cursor.execute("""
+    row = db_fetchone("""
         SELECT id, city, owner_id, name, level, processed_total,
                stored_1060, stored_1660, stored_2060, stored_3060, stored_4060, stored_5060,
                warehouse_bonus_percent, pending_profit, is_processing, processing_started_at,
@@ -1077,7 +1746,6 @@ def shop_sell_price(base_price: int, markup_percent: int):
                ad_description, ad_bumped_at
         FROM gpu_factories WHERE city=?
     """, (city,))
-    row = cursor.fetchone()
     if not row:
         raise ValueError("Factory row missing")
     return {
@@ -1119,16 +1787,13 @@ def generate_deli_code():
     return f"{prefix}{letters}{digits}"
 
 def get_factory_employee_count(factory_id: int):
-    cursor.execute("SELECT COUNT(*) FROM gpu_factory_employees WHERE factory_id=?", (factory_id,))
-    return cursor.fetchone()[0]
+    return db_fetchone("SELECT COUNT(*) FROM gpu_factory_employees WHERE factory_id=?", (factory_id,))[0]
 
 def get_factory_player_employees(factory_id: int):
-    cursor.execute("SELECT COUNT(*) FROM gpu_factory_employees WHERE factory_id=? AND employee_type='player'", (factory_id,))
-    return cursor.fetchone()[0]
+    return db_fetchone("SELECT COUNT(*) FROM gpu_factory_employees WHERE factory_id=? AND employee_type='player'", (factory_id,))[0]
 
 def get_factory_npc_employees(factory_id: int):
-    cursor.execute("SELECT COUNT(*) FROM gpu_factory_employees WHERE factory_id=? AND employee_type='npc'", (factory_id,))
-    return cursor.fetchone()[0]
+    return db_fetchone("SELECT COUNT(*) FROM gpu_factory_employees WHERE factory_id=? AND employee_type='npc'", (factory_id,))[0]
 
 def factory_speed_multiplier(factory_id: int):
     count = get_factory_employee_count(factory_id)
@@ -1152,86 +1817,85 @@ def finalize_factory_production(city: str):
     if time.time() < factory["processing_started_at"] + factory["processing_duration"]:
         return factory
 
-    produced = {}
-    total_profit = 0
-    processed_delta = 0
-    for key, meta in GPU_RAW_DATA.items():
-        suffix = key.split('_')[1]
-        stored_key = f"stored_{suffix}"
-        units = factory[stored_key]
-        cards = units // meta["units_per_card"]
-        remain = units % meta["units_per_card"]
-        produced[suffix] = cards
-        processed_delta += units - remain
-        total_profit += cards * meta["sell_price"]
-        cursor.execute(f"UPDATE gpu_factories SET {stored_key}=? WHERE city=?", (remain, city))
-
-    bonus_mult = 1.0
-    if get_factory_player_employees(factory["id"]) > 0:
-        bonus_mult = 2.0
-    elif get_factory_npc_employees(factory["id"]) > 0:
-        bonus_mult = 1.5
-    total_profit = int(total_profit * bonus_mult)
-
-    cursor.execute("""
-        UPDATE gpu_factories
-        SET is_processing=0,
-            processing_started_at=0,
-            processing_duration=0,
-            processing_amount=0,
-            processed_total=processed_total + ?,
-            pending_profit=pending_profit + ?
-        WHERE city=?
-    """, (processed_delta, total_profit, city))
-
-    sent_prices_json = json.dumps({
-        "GTX 1060": GPU_RAW_DATA["raw_1060"]["sell_price"],
-        "GTX 1660": GPU_RAW_DATA["raw_1660"]["sell_price"],
-        "RTX 2060": GPU_RAW_DATA["raw_2060"]["sell_price"],
-        "RTX 3060": GPU_RAW_DATA["raw_3060"]["sell_price"],
-        "RTX 4060": GPU_RAW_DATA["raw_4060"]["sell_price"],
-        "RTX 5060": GPU_RAW_DATA["raw_5060"]["sell_price"],
-    }, ensure_ascii=False)
-
-    for suffix, qty in produced.items():
-        if qty > 0:
-            cursor.execute(
-                "INSERT INTO gpu_factory_shipments(factory_id, city, created_at, gpu_key, qty, remaining_qty, unit_price) VALUES(?,?,?,?,?,?,?)",
-                (factory["id"], city, int(time.time()), suffix, qty, qty, GPU_RAW_DATA[f"raw_{suffix}"]["sell_price"])
-            )
-
-    cursor.execute("""
-        INSERT INTO gpu_factory_history(
-            factory_id, created_at, produced_1060, produced_1660, produced_2060,
-            produced_3060, produced_4060, produced_5060, sent_prices_json
-        ) VALUES(?,?,?,?,?,?,?,?,?)
-    """, (
-        factory["id"], int(time.time()), produced["1060"], produced["1660"], produced["2060"],
-        produced["3060"], produced["4060"], produced["5060"], sent_prices_json
-    ))
-    conn.commit()
+    # one commit for the whole production cycle
+    with transaction():
+        produced = {}
+        total_profit = 0
+        processed_delta = 0
+        for key, meta in GPU_RAW_DATA.items():
+            suffix = key.split('_')[1]
+            stored_key = f"stored_{suffix}"
+            units = factory[stored_key]
+            cards = units // meta["units_per_card"]
+            remain = units % meta["units_per_card"]
+            produced[suffix] = cards
+            processed_delta += units - remain
+            total_profit += cards * meta["sell_price"]
+            db_execute(f"UPDATE gpu_factories SET {stored_key}=? WHERE city=?", (remain, city))
+
+        bonus_mult = 1.0
+        if get_factory_player_employees(factory["id"]) > 0:
+            bonus_mult = 2.0
+        elif get_factory_npc_employees(factory["id"]) > 0:
+            bonus_mult = 1.5
+        total_profit = int(total_profit * bonus_mult)
+
+        db_execute("""
+            UPDATE gpu_factories
+            SET is_processing=0,
+                processing_started_at=0,
+                processing_duration=0,
+                processing_amount=0,
+                processed_total=processed_total + ?,
+                pending_profit=pending_profit + ?
+            WHERE city=?
+        """, (processed_delta, total_profit, city))
+
+        sent_prices_json = json.dumps({
+            "GTX 1060": GPU_RAW_DATA["raw_1060"]["sell_price"],
+            "GTX 1660": GPU_RAW_DATA["raw_1660"]["sell_price"],
+            "RTX 2060": GPU_RAW_DATA["raw_2060"]["sell_price"],
+            "RTX 3060": GPU_RAW_DATA["raw_3060"]["sell_price"],
+            "RTX 4060": GPU_RAW_DATA["raw_4060"]["sell_price"],
+            "RTX 5060": GPU_RAW_DATA["raw_5060"]["sell_price"],
+        }, ensure_ascii=False)
+
+        for suffix, qty in produced.items():
+            if qty > 0:
+                db_execute(
+                    "INSERT INTO gpu_factory_shipments(factory_id, city, created_at, gpu_key, qty, remaining_qty, unit_price) VALUES(?,?,?,?,?,?,?)",
+                    (factory["id"], city, int(time.time()), suffix, qty, qty, GPU_RAW_DATA[f"raw_{suffix}"]["sell_price"])
+                )
 
-    # chance for warehouse bonus item
-    if random.random() < 0.007 and factory["owner_id"]:
-        cursor.execute(
-            "INSERT OR IGNORE INTO player_items(user_id, item_key, amount) VALUES(?,?,0)",
-            (factory["owner_id"], "warehouse_upgrade")
-        )
-        cursor.execute(
-            "UPDATE player_items SET amount = amount + 1 WHERE user_id=? AND item_key='warehouse_upgrade'",
-            (factory["owner_id"],)
-        )
-        conn.commit()
+        db_execute("""
+            INSERT INTO gpu_factory_history(
+                factory_id, created_at, produced_1060, produced_1660, produced_2060,
+                produced_3060, produced_4060, produced_5060, sent_prices_json
+            ) VALUES(?,?,?,?,?,?,?,?,?)
+        """, (
+            factory["id"], int(time.time()), produced["1060"], produced["1660"], produced["2060"],
+            produced["3060"], produced["4060"], produced["5060"], sent_prices_json
+        ))
+
+        # chance for warehouse bonus item
+        if random.random() < 0.007 and factory["owner_id"]:
+            db_execute(
+                "INSERT OR IGNORE INTO player_items(user_id, item_key, amount) VALUES(?,?,0)",
+                (factory["owner_id"], "warehouse_upgrade")
+            )
+            db_execute(
+                "UPDATE player_items SET amount = amount + 1 WHERE user_id=? AND item_key='warehouse_upgrade'",
+                (factory["owner_id"],)
+            )
 
-    # auto level upgrades
-    updated = gpu_factory_row(city)
-    while updated["level"] < 3:
-        rem = next_factory_level_remaining(updated)
-        if rem is None or rem > 0:
-            break
-        cursor.execute("UPDATE gpu_factories SET level=level+1 WHERE city=?", (city,))
-        conn.commit()
+        # auto level upgrades
         updated = gpu_factory_row(city)
+        while updated["level"] < 3:
+            rem = next_factory_level_remaining(updated)
+            if rem is None or rem > 0:
+                break
+            db_execute("UPDATE gpu_factories SET level=level+1 WHERE city=?", (city,))
+            updated = gpu_factory_row(city)
 
     return gpu_factory_row(city)
 
@@ -1241,28 +1905,32 @@ def seconds_until_factory_done(factory: dict):
     return max(0, int(factory["processing_started_at"] + factory["processing_duration"] - time.time()))
 
 def factory_ad_count(factory_id: int):
-    cursor.execute("SELECT COUNT(*) FROM gpu_factory_applications WHERE factory_id=? AND status='pending'", (factory_id,))
-    return cursor.fetchone()[0]
+    return db_fetchone("SELECT COUNT(*) FROM gpu_factory_applications WHERE factory_id=? AND status='pending'", (factory_id,))[0]
 
 def user_player_name(uid: int) -> str:
-    cursor.execute("SELECT user_id FROM players WHERE user_id=?", (uid,))
+    db_execute("SELECT user_id FROM players WHERE user_id=?", (uid,))
     return str(uid)
 
 
 
 # ---------------- FIXED FACTORY/SHOP HELPERS + HOUSE HELPERS ----------------
 
+GPU_FACTORY_SELECT_SQL = """
+    SELECT id, city, owner_id, name, level, processed_total,
+           stored_1060, stored_1660, stored_2060, stored_3060, stored_4060, stored_5060,
+           warehouse_bonus_percent, pending_profit, is_processing, processing_started_at,
+           processing_duration, processing_amount, ad_salary_percent, ad_slots_target,
+           ad_description, ad_bumped_at
+    FROM gpu_factories WHERE city=?
+"""
+
 def gpu_factory_row(city: str):
-    ensure_gpu_factory_rows()
-    cursor.execute("""
-        SELECT id, city, owner_id, name, level, processed_total,
-               stored_1060, stored_1660, stored_2060, stored_3060, stored_4060, stored_5060,
-               warehouse_bonus_percent, pending_profit, is_processing, processing_started_at,
-               processing_duration, processing_amount, ad_salary_percent, ad_slots_target,
-               ad_description, ad_bumped_at
-        FROM gpu_factories WHERE city=?
-    """, (city,))
-    row = cursor.fetchone()
+    return gpu_factory_from_row(db_fetchone(GPU_FACTORY_SELECT_SQL, (city,)))
+
+async def gpu_factory_row_async(city: str):
+    return gpu_factory_from_row(await fetchone_async(GPU_FACTORY_SELECT_SQL, (city,)))
+
+def gpu_factory_from_row(row) -> dict:
     if not row:
         raise ValueError("Factory row missing")
     return {
@@ -1277,15 +1945,8 @@ def gpu_factory_row(city: str):
         "ad_description": row[20] or "", "ad_bumped_at": row[21] or 0,
     }
 
-def ensure_gpu_shop_rows():
-    for city in ["Новоград", "Инд-Сити", "Форс-Сити", "Вегаспорт"]:
-        cursor.execute("INSERT OR IGNORE INTO gpu_shops(city) VALUES(?)", (city,))
-    conn.commit()
-
 def gpu_shop_row(city: str):
-    ensure_gpu_shop_rows()
-    cursor.execute("SELECT id, city, owner_id, name, markup_percent, pending_profit, supplier_factory_city FROM gpu_shops WHERE city=?", (city,))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT id, city, owner_id, name, markup_percent, pending_profit, supplier_factory_city FROM gpu_shops WHERE city=?", (city,))
     return {
         "id": row[0], "city": row[1], "owner_id": row[2], "name": row[3] or "",
         "markup_percent": row[4] or 18, "pending_profit": row[5] or 0,
@@ -1296,26 +1957,24 @@ def gpu_shop_display_name(shop: dict) -> str:
     return shop["name"] if shop["name"] else f"Магазин видеокарт | {shop['city']}"
 
 def get_shop_inventory(shop_id: int):
-    cursor.execute("SELECT gpu_key, qty, base_price FROM gpu_shop_inventory WHERE shop_id=? ORDER BY gpu_key", (shop_id,))
-    return cursor.fetchall()
+    return db_fetchall("SELECT gpu_key, qty, base_price FROM gpu_shop_inventory WHERE shop_id=? ORDER BY gpu_key", (shop_id,))
 
 def upsert_shop_inventory(shop_id: int, gpu_key: str, qty_add: int, base_price: int):
-    cursor.execute("SELECT qty, base_price FROM gpu_shop_inventory WHERE shop_id=? AND gpu_key=?", (shop_id, gpu_key))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT qty, base_price FROM gpu_shop_inventory WHERE shop_id=? AND gpu_key=?", (shop_id, gpu_key))
     if row:
         qty, old_base = row
         new_qty = qty + qty_add
         avg_base = base_price if qty == 0 else int(round(((qty * old_base) + (qty_add * base_price)) / max(1, new_qty)))
-        cursor.execute("UPDATE gpu_shop_inventory SET qty=?, base_price=? WHERE shop_id=? AND gpu_key=?", (new_qty, avg_base, shop_id, gpu_key))
+        db_execute("UPDATE gpu_shop_inventory SET qty=?, base_price=? WHERE shop_id=? AND gpu_key=?", (new_qty, avg_base, shop_id, gpu_key))
     else:
-        cursor.execute("INSERT INTO gpu_shop_inventory(shop_id, gpu_key, qty, base_price) VALUES(?,?,?,?)", (shop_id, gpu_key, qty_add, base_price))
-    conn.commit()
+        db_execute("INSERT INTO gpu_shop_inventory(shop_id, gpu_key, qty, base_price) VALUES(?,?,?,?)", (shop_id, gpu_key, qty_add, base_price))
+    db_commit()
 
 def add_player_gpu(uid: int, gpu_key: str, qty: int = 1):
     item_key = GPU_KEY_TO_ITEM[gpu_key]
-    cursor.execute("INSERT OR IGNORE INTO player_items(user_id, item_key, amount) VALUES(?,?,0)", (uid, item_key))
-    cursor.execute("UPDATE player_items SET amount = amount + ? WHERE user_id=? AND item_key=?", (qty, uid, item_key))
-    conn.commit()
+    db_execute("INSERT OR IGNORE INTO player_items(user_id, item_key, amount) VALUES(?,?,0)", (uid, item_key))
+    db_execute("UPDATE player_items SET amount = amount + ? WHERE user_id=? AND item_key=?", (qty, uid, item_key))
+    db_commit()
 
 def shop_sell_price(base_price: int, markup_percent: int):
     return int(round(base_price * (1 + markup_percent / 100.0)))
@@ -1341,8 +2000,7 @@ def house_upgrade_cost(base_price: int, next_level: int) -> int:
     return int(base_price * (next_level * 0.10))
 
 def get_owned_house(uid: int):
-    cursor.execute("SELECT id, owner_id, city, level, base_price, house_code, street, mining_progress_btc, last_mining_update, created_at FROM houses WHERE owner_id=?", (uid,))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT id, owner_id, city, level, base_price, house_code, street, mining_progress_btc, last_mining_update, created_at FROM houses WHERE owner_id=?", (uid,))
     if not row:
         return None
     return {
@@ -1351,9 +2009,15 @@ def get_owned_house(uid: int):
         "last_mining_update": row[8] or 0, "created_at": row[9] or 0
     }
 
+HOUSE_SELECT_SQL = "SELECT id, owner_id, city, level, base_price, house_code, street, mining_progress_btc, last_mining_update, created_at FROM houses WHERE id=?"
+
 def get_house_by_id(house_id: int):
-    cursor.execute("SELECT id, owner_id, city, level, base_price, house_code, street, mining_progress_btc, last_mining_update, created_at FROM houses WHERE id=?", (house_id,))
-    row = cursor.fetchone()
+    return house_from_row(db_fetchone(HOUSE_SELECT_SQL, (house_id,)))
+
+async def get_house_by_id_async(house_id: int):
+    return house_from_row(await fetchone_async(HOUSE_SELECT_SQL, (house_id,)))
+
+def house_from_row(row):
     if not row:
         return None
     return {
@@ -1371,19 +2035,53 @@ def active_house_for_user(uid: int):
     return get_owned_house(uid)
 
 def set_current_house(uid: int, house_id: int):
-    cursor.execute("UPDATE players SET current_house_id=? WHERE user_id=?", (house_id, uid))
-    conn.commit()
+    db_execute("UPDATE players SET current_house_id=? WHERE user_id=?", (house_id, uid))
+    db_commit()
 
 def clear_guest_presence(uid: int):
-    cursor.execute("DELETE FROM house_guests WHERE guest_user_id=?", (uid,))
-    cursor.execute("UPDATE players SET current_house_id=0 WHERE user_id=?", (uid,))
-    conn.commit()
+    db_execute("DELETE FROM house_guests WHERE guest_user_id=?", (uid,))
+    db_execute("UPDATE players SET current_house_id=0 WHERE user_id=?", (uid,))
+    db_commit()
 
 def get_house_guests(house_id: int):
-    cursor.execute("SELECT guest_user_id FROM house_guests WHERE house_id=? ORDER BY joined_at ASC", (house_id,))
-    ids = [r[0] for r in cursor.fetchall()]
+    ids = [r[0] for r in db_fetchall("SELECT guest_user_id FROM house_guests WHERE house_id=? ORDER BY joined_at ASC", (house_id,))]
     return ids
 
+def post_house_chat_message(house_id: int, sender_id: int, sender_name: str, message: str) -> int:
+    # each house owns HOUSE_CHAT_SIZE slots; message n overwrites slot n % size in place
+    with transaction():
+        db_execute("UPDATE houses SET chat_seq=chat_seq+1 WHERE id=?", (house_id,))
+        seq = db_fetchone("SELECT chat_seq FROM houses WHERE id=?", (house_id,))[0]
+        db_execute("""
+            INSERT INTO house_chat_ring(house_id, slot, seq, sender_id, sender_name, message, created_at) VALUES(?,?,?,?,?,?,?)
+            ON CONFLICT(house_id, slot) DO UPDATE SET
+                seq=excluded.seq, sender_id=excluded.sender_id, sender_name=excluded.sender_name,
+                message=excluded.message, created_at=excluded.created_at
+        """, (house_id, seq % HOUSE_CHAT_SIZE, seq, sender_id, sender_name, message, int(time.time())))
+    return seq
+
+def render_house_chat_export(house_id: int):
+    # runs on the db thread. rows stream newest-first so the size cap drops
+    # the oldest lines; returns (data, extension, last_seq) or None
+    lines = []
+    size = 0
+    last_seq = 0
+    with read_connection() as db:
+        rows = db.execute("SELECT seq, sender_name, message, created_at FROM house_chat_ring WHERE house_id=? ORDER BY seq DESC", (house_id,))
+        for seq, sender_name, message, created_at in rows:
+            line = f"[{time.strftime('%d.%m.%Y %H:%M:%S', time.localtime(created_at))}] {sender_name}: {message}\n".encode("utf-8")
+            if size + len(line) > HOUSE_CHAT_EXPORT_MAX_BYTES:
+                break
+            last_seq = max(last_seq, seq)
+            lines.append(line)
+            size += len(line)
+    if not lines:
+        return None
+    data = b"".join(reversed(lines))
+    if len(data) > HOUSE_CHAT_EXPORT_GZIP_BYTES:
+        return gzip.compress(data), ".txt.gz", last_seq
+    return data, ".txt", last_seq
+
 def get_house_guest_names(house_id: int):
     names = []
     for uid in get_house_guests(house_id):
@@ -1392,16 +2090,15 @@ def get_house_guest_names(house_id: int):
 
 def add_house_guest(house_id: int, guest_user_id: int):
     clear_guest_presence(guest_user_id)
-    cursor.execute("INSERT OR REPLACE INTO house_guests(house_id, guest_user_id, joined_at) VALUES(?,?,?)", (house_id, guest_user_id, int(time.time())))
+    db_execute("INSERT OR REPLACE INTO house_guests(house_id, guest_user_id, joined_at) VALUES(?,?,?)", (house_id, guest_user_id, int(time.time())))
     set_current_house(guest_user_id, house_id)
-    conn.commit()
+    db_commit()
 
 def house_owner_name(house: dict):
     return str(house["owner_id"])
 
 def house_gpu_rows(house_id: int):
-    cursor.execute("SELECT slot_index, gpu_key FROM house_gpus WHERE house_id=? ORDER BY slot_index", (house_id,))
-    return cursor.fetchall()
+    return db_fetchall("SELECT slot_index, gpu_key FROM house_gpus WHERE house_id=? ORDER BY slot_index", (house_id,))
 
 def house_gpu_rate(house_id: int) -> float:
     total = 0.0
@@ -1422,8 +2119,8 @@ def sync_house_mining(house_id: int):
     remainder = total_btc - whole
     if whole > 0:
         add_bank_btc(house["owner_id"], whole)
-    cursor.execute("UPDATE houses SET mining_progress_btc=?, last_mining_update=? WHERE id=?", (remainder, now, house_id))
-    conn.commit()
+    db_execute("UPDATE houses SET mining_progress_btc=?, last_mining_update=? WHERE id=?", (remainder, now, house_id))
+    db_commit()
     house = get_house_by_id(house_id)
     return house
 
@@ -1437,51 +2134,45 @@ def next_btc_time_text(house_id: int):
     return format_seconds(seconds)
 
 def get_house_storage_amount(house_id: int, item_key: str) -> int:
-    cursor.execute("SELECT amount FROM house_storage WHERE house_id=? AND item_key=?", (house_id, item_key))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT amount FROM house_storage WHERE house_id=? AND item_key=?", (house_id, item_key))
     return row[0] if row else 0
 
 def get_house_storage_total(house_id: int) -> int:
-    cursor.execute("SELECT COALESCE(SUM(amount),0) FROM house_storage WHERE house_id=?", (house_id,))
-    return cursor.fetchone()[0] or 0
+    return db_fetchone("SELECT COALESCE(SUM(amount),0) FROM house_storage WHERE house_id=?", (house_id,))[0] or 0
 
 def add_house_storage(house_id: int, item_key: str, amount: int):
-    cursor.execute("INSERT OR IGNORE INTO house_storage(house_id, item_key, amount) VALUES(?,?,0)", (house_id, item_key))
-    cursor.execute("UPDATE house_storage SET amount=amount+? WHERE house_id=? AND item_key=?", (amount, house_id, item_key))
-    conn.commit()
+    db_execute("INSERT OR IGNORE INTO house_storage(house_id, item_key, amount) VALUES(?,?,0)", (house_id, item_key))
+    db_execute("UPDATE house_storage SET amount=amount+? WHERE house_id=? AND item_key=?", (amount, house_id, item_key))
+    db_commit()
 
 def remove_house_storage(house_id: int, item_key: str, amount: int):
-    cur = get_house_storage_amount(house_id, item_key)
-    if cur < amount:
+    if db_execute("UPDATE house_storage SET amount=amount-? WHERE house_id=? AND item_key=? AND amount>=?", (amount, house_id, item_key, amount)).rowcount != 1:
+        db_commit()
         return False
-    cursor.execute("UPDATE house_storage SET amount=amount-? WHERE house_id=? AND item_key=?", (amount, house_id, item_key))
-    cursor.execute("DELETE FROM house_storage WHERE house_id=? AND item_key=? AND amount<=0", (house_id, item_key))
-    conn.commit()
+    db_execute("DELETE FROM house_storage WHERE house_id=? AND item_key=? AND amount<=0", (house_id, item_key))
+    db_commit()
     return True
 
 def friend_exists(uid: int, friend_id: int) -> bool:
-    cursor.execute("SELECT 1 FROM friends WHERE user_id=? AND friend_user_id=?", (uid, friend_id))
-    return cursor.fetchone() is not None
+    return db_fetchone("SELECT 1 FROM friends WHERE user_id=? AND friend_user_id=?", (uid, friend_id)) is not None
 
 def create_friendship(a: int, b: int):
     if a == b:
         return
-    cursor.execute("INSERT OR IGNORE INTO friends(user_id, friend_user_id, created_at) VALUES(?,?,?)", (a, b, int(time.time())))
-    cursor.execute("INSERT OR IGNORE INTO friends(user_id, friend_user_id, created_at) VALUES(?,?,?)", (b, a, int(time.time())))
-    conn.commit()
+    db_execute("INSERT OR IGNORE INTO friends(user_id, friend_user_id, created_at) VALUES(?,?,?)", (a, b, int(time.time())))
+    db_execute("INSERT OR IGNORE INTO friends(user_id, friend_user_id, created_at) VALUES(?,?,?)", (b, a, int(time.time())))
+    db_commit()
 
 def get_friend_ids(uid: int):
-    cursor.execute("SELECT friend_user_id FROM friends WHERE user_id=? ORDER BY friend_user_id", (uid,))
-    return [r[0] for r in cursor.fetchall()]
+    return [r[0] for r in db_fetchall("SELECT friend_user_id FROM friends WHERE user_id=? ORDER BY friend_user_id", (uid,))]
 
 def get_active_trade_for_user(uid: int):
-    cursor.execute("""
+    row = db_fetchone("""
         SELECT id, house_id, user1_id, user2_id, status, user1_ready, user2_ready, user1_confirmed, user2_confirmed
         FROM trade_sessions
         WHERE status IN ('pending','active','locked') AND (user1_id=? OR user2_id=?)
         ORDER BY id DESC LIMIT 1
     """, (uid, uid))
-    row = cursor.fetchone()
     if not row:
         return None
     return {
@@ -1493,21 +2184,24 @@ def trade_partner(session: dict, uid: int) -> int:
     return session["user2_id"] if session["user1_id"] == uid else session["user1_id"]
 
 def get_trade_offers(session_id: int, user_id: int):
-    cursor.execute("SELECT slot_index, item_key, amount FROM trade_offers WHERE session_id=? AND user_id=? ORDER BY slot_index", (session_id, user_id))
-    return cursor.fetchall()
+    return db_fetchall("SELECT slot_index, item_key, amount FROM trade_offers WHERE session_id=? AND user_id=? ORDER BY slot_index", (session_id, user_id))
 
 def get_trade_money(session_id: int, user_id: int) -> int:
-    cursor.execute("SELECT amount FROM trade_money WHERE session_id=? AND user_id=?", (session_id, user_id))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT amount FROM trade_money WHERE session_id=? AND user_id=?", (session_id, user_id))
     return row[0] if row else 0
 
-def set_trade_money(session_id: int, user_id: int, amount: int):
-    cursor.execute("INSERT OR REPLACE INTO trade_money(session_id, user_id, amount) VALUES(?,?,?)", (session_id, user_id, amount))
-    conn.commit()
+def set_trade_money(session_id: int, user_id: int, amount: int) -> bool:
+    # stored only while the player's cash covers the offer
+    cur = db_execute("""
+        INSERT OR REPLACE INTO trade_money(session_id, user_id, amount)
+        SELECT ?, ?, ? FROM players WHERE user_id=? AND money>=?
+    """, (session_id, user_id, amount, user_id, amount))
+    db_commit()
+    return cur.rowcount == 1
 
 def reset_trade_ready(session_id: int):
-    cursor.execute("UPDATE trade_sessions SET user1_ready=0, user2_ready=0, user1_confirmed=0, user2_confirmed=0, status='active' WHERE id=?", (session_id,))
-    conn.commit()
+    db_execute("UPDATE trade_sessions SET user1_ready=0, user2_ready=0, user1_confirmed=0, user2_confirmed=0, status='active' WHERE id=?", (session_id,))
+    db_commit()
 
 def next_trade_slot(session_id: int, user_id: int):
     taken = {slot for slot, _, _ in get_trade_offers(session_id, user_id)}
@@ -1547,14 +2241,46 @@ def trade_user_status(session: dict, uid: int):
 def set_trade_ready(session_id: int, uid: int, value: int):
     session = get_active_trade_for_user(uid)
     col = "user1_ready" if session and session["user1_id"] == uid else "user2_ready"
-    cursor.execute(f"UPDATE trade_sessions SET {col}=? WHERE id=?", (value, session_id))
-    conn.commit()
+    db_execute(f"UPDATE trade_sessions SET {col}=? WHERE id=?", (value, session_id))
+    db_commit()
 
 def set_trade_confirm(session_id: int, uid: int, value: int):
     session = get_active_trade_for_user(uid)
     col = "user1_confirmed" if session and session["user1_id"] == uid else "user2_confirmed"
-    cursor.execute(f"UPDATE trade_sessions SET {col}=? WHERE id=?", (value, session_id))
-    conn.commit()
+    db_execute(f"UPDATE trade_sessions SET {col}=? WHERE id=?", (value, session_id))
+    db_commit()
+
+def complete_trade(session_id: int) -> str:
+    # the session is claimed first, so only one of two simultaneous confirms runs
+    # the exchange; money and items move with guarded updates in the same
+    # transaction, so a balance spent elsewhere meanwhile rolls everything back.
+    # status: "ok", "taken" (not both confirmed / already done), "no_money" or "no_items"
+    with transaction():
+        if db_execute("""
+            UPDATE trade_sessions SET status='completed'
+            WHERE id=? AND status='locked' AND user1_confirmed=1 AND user2_confirmed=1
+        """, (session_id,)).rowcount == 0:
+            return "taken"
+        u1, u2 = db_fetchone("SELECT user1_id, user2_id FROM trade_sessions WHERE id=?", (session_id,))
+        money1 = get_trade_money(session_id, u1)
+        money2 = get_trade_money(session_id, u2)
+        if not debit_money(u1, money1) or not debit_money(u2, money2):
+            mark_rollback_only()
+            return "no_money"
+        add_money(u1, money2)
+        add_money(u2, money1)
+        for giver, taker in ((u1, u2), (u2, u1)):
+            offered = {}
+            for _, item_key, amount in get_trade_offers(session_id, giver):
+                offered[item_key] = offered.get(item_key, 0) + amount
+            for item_key, amount in offered.items():
+                if db_execute("UPDATE player_items SET amount=amount-? WHERE user_id=? AND item_key=? AND amount>=?", (amount, giver, item_key, amount)).rowcount == 0:
+                    mark_rollback_only()
+                    return "no_items"
+                db_execute("INSERT OR IGNORE INTO player_items(user_id, item_key, amount) VALUES(?,?,0)", (taker, item_key))
+                db_execute("UPDATE player_items SET amount=amount+? WHERE user_id=? AND item_key=?", (amount, taker, item_key))
+        db_execute("DELETE FROM player_items WHERE amount<=0")
+    return "ok"
 
 # ---------------- RENDER HELPERS ----------------
 
@@ -1570,25 +2296,89 @@ async def render_text(target_message, text: str, reply_markup=None):
         return await target_message.get_bot().send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
     return target_message
 
-async def render_photo(target_message, photo_url_or_path: str, caption: str, reply_markup=None):
-    media_source = photo_url_or_path
+file_hash_memo = {}
+
+def photo_cache_key(photo_url_or_path: str):
+    # catbox links never change content, so for URLs the link itself is the hash
+    if not os.path.exists(photo_url_or_path):
+        return photo_url_or_path, "url"
+    stat = os.stat(photo_url_or_path)
+    memo_key = (photo_url_or_path, stat.st_mtime_ns, stat.st_size)
+    content_hash = file_hash_memo.get(memo_key)
+    if content_hash is None:
+        with open(photo_url_or_path, "rb") as f:
+            content_hash = hashlib.md5(f.read()).hexdigest()
+        file_hash_memo[memo_key] = content_hash
+    return photo_url_or_path, content_hash
+
+def get_cached_file_id(source: str, content_hash: str):
+    row = db_fetchone("SELECT content_hash, file_id FROM telegram_file_ids WHERE source=?", (source,))
+    if not row or row[0] != content_hash:
+        return None
+    return row[1]
+
+def remember_file_id(source: str, content_hash: str, message):
+    photo = getattr(message, "photo", None)
+    if not photo:
+        return
+    db_execute(
+        "INSERT OR REPLACE INTO telegram_file_ids(source, content_hash, file_id, updated_at) VALUES(?,?,?,?)",
+        (source, content_hash, photo[-1].file_id, int(time.time())),
+    )
+    db_commit()
+
+def forget_file_id(source: str):
+    db_execute("DELETE FROM telegram_file_ids WHERE source=?", (source,))
+    db_commit()
+
+def local_photo_path(photo_url_or_path: str):
     if os.path.exists(photo_url_or_path):
-        media_source = open(photo_url_or_path, "rb")
+        return photo_url_or_path
+    if photo_url_or_path.startswith("http"):
+        path = cached_download_path(photo_url_or_path)
+        if os.path.exists(path):
+            return path
+    return None
+
+async def send_cached_photo(bot, chat_id: int, photo_url_or_path: str, caption: str, reply_markup=None):
+    source, content_hash = photo_cache_key(photo_url_or_path)
+    file_id = get_cached_file_id(source, content_hash)
+    if file_id:
+        try:
+            return await bot.send_photo(chat_id=chat_id, photo=file_id, caption=caption, reply_markup=reply_markup)
+        except BadRequest as e:
+            logging.warning(f"Cached file_id rejected for {source}: {e}")
+            forget_file_id(source)
+    local_path = local_photo_path(photo_url_or_path)
+    if local_path:
+        with open(local_path, "rb") as f:
+            sent = await bot.send_photo(chat_id=chat_id, photo=f, caption=caption, reply_markup=reply_markup)
+    else:
+        sent = await bot.send_photo(chat_id=chat_id, photo=photo_url_or_path, caption=caption, reply_markup=reply_markup)
+    remember_file_id(source, content_hash, sent)
+    return sent
+
+async def render_photo(target_message, photo_url_or_path: str, caption: str, reply_markup=None):
+    source, content_hash = photo_cache_key(photo_url_or_path)
+    file_id = get_cached_file_id(source, content_hash)
+    media_source = file_id or photo_url_or_path
+    local_path = None if file_id else local_photo_path(photo_url_or_path)
+    if local_path:
+        media_source = open(local_path, "rb")
     try:
-        await target_message.edit_media(
+        edited = await target_message.edit_media(
             media=InputMediaPhoto(media=media_source, caption=caption),
             reply_markup=reply_markup
         )
+        if not file_id:
+            remember_file_id(source, content_hash, edited)
     except Exception:
         chat_id = target_message.chat_id
         try:
             await target_message.delete()
         except Exception:
             pass
-        if os.path.exists(photo_url_or_path):
-            with open(photo_url_or_path, "rb") as f:
-                return await target_message.get_bot().send_photo(chat_id=chat_id, photo=f, caption=caption, reply_markup=reply_markup)
-        return await target_message.get_bot().send_photo(chat_id=chat_id, photo=photo_url_or_path, caption=caption, reply_markup=reply_markup)
+        return await send_cached_photo(target_message.get_bot(), chat_id, photo_url_or_path, caption, reply_markup=reply_markup)
     finally:
         if hasattr(media_source, "close"):
             media_source.close()
@@ -1609,7 +2399,7 @@ async def render_intro_message(target_message):
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    player = get_player(uid)
+    player = await get_player_async(uid)
     if not player["char_created"]:
         await update.message.reply_text(
             "Приветствую тебя в MetroLife! В мире где все может измениться в любую секунду!\n"
@@ -1623,8 +2413,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def character_hub(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    player = get_player(query.from_user.id)
-    image = build_layered_character(player["char_top"], player["char_bottom"], player["char_hair"])
+    player = await get_player_async(query.from_user.id)
+    image = await build_layered_character_async(player["char_top"], player["char_bottom"], player["char_hair"])
 
     if player["char_top"] and player["char_bottom"] and player["char_hair"]:
         text = f"{character_summary_text(player)}\n\nНравится ли тебе?"
@@ -1654,7 +2444,7 @@ async def char_begin(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def char_confirm_yes(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    player = get_player(query.from_user.id)
+    player = await get_player_async(query.from_user.id)
     if not (player["char_top"] and player["char_bottom"] and player["char_hair"]):
         await query.answer("Сначала выбери все элементы")
         return
@@ -1670,10 +2460,10 @@ async def char_confirm_no(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def char_pick_top(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    player = get_player(query.from_user.id)
+    player = await get_player_async(query.from_user.id)
     idx = context.user_data.get("char_top_idx", 0) % len(CHAR_TOPS)
     item = CHAR_TOPS[idx]
-    preview = build_layered_character(item["key"], player["char_bottom"], player["char_hair"])
+    preview = await build_layered_character_async(item["key"], player["char_bottom"], player["char_hair"])
     text = f"{item['name']}\n\n{item['desc']}\n\nНажми подтвердить что бы выбрать данную кофту"
     kb = [[InlineKeyboardButton("⬅️", callback_data="char_top_prev"),
            InlineKeyboardButton("Подтвердить", callback_data=f"char_set_top_{item['key']}"),
@@ -1702,10 +2492,10 @@ async def char_set_top(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def char_pick_bottom(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    player = get_player(query.from_user.id)
+    player = await get_player_async(query.from_user.id)
     idx = context.user_data.get("char_bottom_idx", 0) % len(CHAR_BOTTOMS)
     item = CHAR_BOTTOMS[idx]
-    preview = build_layered_character(player["char_top"], item["key"], player["char_hair"])
+    preview = await build_layered_character_async(player["char_top"], item["key"], player["char_hair"])
     text = f"{item['name']}\n\n{item['desc']}\n\nНажми подтвердить что бы выбрать данный элемент"
     kb = [[InlineKeyboardButton("⬅️", callback_data="char_bottom_prev"),
            InlineKeyboardButton("Подтвердить", callback_data=f"char_set_bottom_{item['key']}"),
@@ -1734,10 +2524,10 @@ async def char_set_bottom(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def char_pick_hair(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    player = get_player(query.from_user.id)
+    player = await get_player_async(query.from_user.id)
     idx = context.user_data.get("char_hair_idx", 0) % len(CHAR_HAIRS)
     item = CHAR_HAIRS[idx]
-    preview = build_layered_character(player["char_top"], player["char_bottom"], item["key"])
+    preview = await build_layered_character_async(player["char_top"], player["char_bottom"], item["key"])
     text = f"{item['name']}\n\n{item['desc']}\n\nНажми подтвердить что бы выбрать данную прическу"
     kb = [[InlineKeyboardButton("⬅️", callback_data="char_hair_prev"),
            InlineKeyboardButton("Подтвердить", callback_data=f"char_set_hair_{item['key']}"),
@@ -1781,26 +2571,25 @@ def main_menu_keyboard(uid: int):
     return InlineKeyboardMarkup(rows)
 
 async def send_main_menu_message(message, user, player: dict):
-    image = build_layered_character(player["char_top"], player["char_bottom"], player["char_hair"])
+    image = await build_layered_character_async(player["char_top"], player["char_bottom"], player["char_hair"])
     text = (
         f"Привет {user.first_name}! Ты сейчас находишся в городе {player['city']}\n"
         f"На счету у тебя: {player['money']}$\n\n"
         f"Для более полной информации нажми кнопку профиль"
     )
-    with open(image, "rb") as f:
-        await message.reply_photo(photo=f, caption=text, reply_markup=main_menu_keyboard(user.id))
+    await send_cached_photo(message.get_bot(), message.chat_id, image, text, reply_markup=main_menu_keyboard(user.id))
 
 async def main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     uid = query.from_user.id
-    player = get_player(uid)
+    player = await get_player_async(uid)
 
     if not player["char_created"]:
         await render_intro_message(query.message)
         return
 
-    image = build_layered_character(player["char_top"], player["char_bottom"], player["char_hair"])
+    image = await build_layered_character_async(player["char_top"], player["char_bottom"], player["char_hair"])
     text = (
         f"Привет {query.from_user.first_name}! Ты сейчас находишся в городе {player['city']}\n"
         f"На счету у тебя: {player['money']}$\n\n"
@@ -1812,7 +2601,7 @@ async def profile_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     uid = query.from_user.id
-    player = get_player(uid)
+    player = await get_player_async(uid)
     text = (
         f"👤 Профиль\n\n"
         f"Имя: {query.from_user.first_name}\n"
@@ -1828,26 +2617,27 @@ async def inventory_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     uid = query.from_user.id
+    inv = get_inventory(uid)
     text = (
         "🎒 Инвентарь :\n\n"
-        f"Точильные камни: {get_item_amount(uid, 'sharpening_stones')}\n"
-        f"Заточка: {get_item_amount(uid, 'zatocka')}\n"
-        f"Супер заточка: {get_item_amount(uid, 'super_zatocka')}\n"
-        f"Дополнение гаража: {get_item_amount(uid, 'garage_upgrade')}\n"
-        f"Дополнение склада: {get_item_amount(uid, 'warehouse_upgrade')}\n"
-        f"Видеокарты: {get_item_amount(uid, 'gpu_cards')}\n"
-        f"GTX 1060: {get_item_amount(uid, 'gpu_1060')}\n"
-        f"GTX 1660: {get_item_amount(uid, 'gpu_1660')}\n"
-        f"RTX 2060: {get_item_amount(uid, 'gpu_2060')}\n"
-        f"RTX 3060: {get_item_amount(uid, 'gpu_3060')}\n"
-        f"RTX 4060: {get_item_amount(uid, 'gpu_4060')}\n"
-        f"RTX 5060: {get_item_amount(uid, 'gpu_5060')}\n"
-        f"Чертеж скорости B: {get_item_amount(uid, 'truck_speed_blueprint_b')}\n"
-        f"Чертеж скорости A: {get_item_amount(uid, 'truck_speed_blueprint_a')}\n"
-        f"Чертеж скорости S: {get_item_amount(uid, 'truck_speed_blueprint_s')}\n"
-        f"Модуль грузоподъемности B: {get_item_amount(uid, 'truck_capacity_module_b')}\n"
-        f"Модуль грузоподъемности A: {get_item_amount(uid, 'truck_capacity_module_a')}\n"
-        f"Модуль грузоподъемности S: {get_item_amount(uid, 'truck_capacity_module_s')}\n"
+        f"Точильные камни: {inv['sharpening_stones']}\n"
+        f"Заточка: {inv['zatocka']}\n"
+        f"Супер заточка: {inv['super_zatocka']}\n"
+        f"Дополнение гаража: {inv['garage_upgrade']}\n"
+        f"Дополнение склада: {inv['warehouse_upgrade']}\n"
+        f"Видеокарты: {inv['gpu_cards']}\n"
+        f"GTX 1060: {inv['gpu_1060']}\n"
+        f"GTX 1660: {inv['gpu_1660']}\n"
+        f"RTX 2060: {inv['gpu_2060']}\n"
+        f"RTX 3060: {inv['gpu_3060']}\n"
+        f"RTX 4060: {inv['gpu_4060']}\n"
+        f"RTX 5060: {inv['gpu_5060']}\n"
+        f"Чертеж скорости B: {inv['truck_speed_blueprint_b']}\n"
+        f"Чертеж скорости A: {inv['truck_speed_blueprint_a']}\n"
+        f"Чертеж скорости S: {inv['truck_speed_blueprint_s']}\n"
+        f"Модуль грузоподъемности B: {inv['truck_capacity_module_b']}\n"
+        f"Модуль грузоподъемности A: {inv['truck_capacity_module_a']}\n"
+        f"Модуль грузоподъемности S: {inv['truck_capacity_module_s']}\n"
     )
     await render_text(query.message, text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="main")]]))
 
@@ -1856,7 +2646,7 @@ async def inventory_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def work_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    city = get_player(query.from_user.id)["city"]
+    city = (await get_player_async(query.from_user.id))["city"]
     buttons = [[InlineKeyboardButton("🚕 Таксист", callback_data="taxi_driver_menu")]]
     if city == "Новоград":
         buttons.insert(0, [InlineKeyboardButton("💼 Начальные работы", callback_data="starter_jobs")])
@@ -1868,7 +2658,7 @@ async def work_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def city_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    city = get_player(query.from_user.id)["city"]
+    city = (await get_player_async(query.from_user.id))["city"]
 
     if city == "Новоград":
         keyboard = [
@@ -1935,7 +2725,7 @@ async def placeholder(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def travel_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    current_city = get_player(query.from_user.id)["city"]
+    current_city = (await get_player_async(query.from_user.id))["city"]
     buttons = []
     for city in ALL_CITIES:
         if city != current_city:
@@ -1965,13 +2755,13 @@ def agency_keyboard(city: str):
 async def agency_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    city = get_player(query.from_user.id)["city"]
+    city = (await get_player_async(query.from_user.id))["city"]
     await render_text(query.message, f"🏢 Агентство недвижимости | {city}", reply_markup=agency_keyboard(city))
 
 async def agency_businesses(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    city = get_player(query.from_user.id)["city"]
+    city = (await get_player_async(query.from_user.id))["city"]
     factory = finalize_factory_production(city)
     shop = gpu_shop_row(city)
     owner_text = "Свободен" if not factory["owner_id"] else "Занят"
@@ -1997,7 +2787,7 @@ async def agency_businesses(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def factory_open_city(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    city = get_player(query.from_user.id)["city"]
+    city = (await get_player_async(query.from_user.id))["city"]
     await factory_menu_common(query.message, query.from_user.id, query.from_user.first_name, city)
 
 async def factory_menu_common(target_message, uid: int, first_name: str, city: str):
@@ -2049,18 +2839,22 @@ async def factory_buy(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     city = query.data.replace("factory_buy_", "")
     uid = query.from_user.id
-    factory = gpu_factory_row(city)
-    if factory["owner_id"]:
+    price = GPU_FACTORY_PRICES.get(city, 2000000)
+    with transaction():
+        if db_execute("UPDATE gpu_factories SET owner_id=? WHERE city=? AND owner_id=0", (uid, city)).rowcount == 0:
+            status = "taken"
+        elif not debit_money(uid, price):
+            mark_rollback_only()
+            status = "no_money"
+        else:
+            status = "ok"
+    if status == "taken":
         await query.answer("Завод уже куплен")
         return
-    price = GPU_FACTORY_PRICES.get(city, 2000000)
-    if get_money(uid) < price:
+    if status == "no_money":
         await query.answer("Недостаточно денег")
         return
-    add_money(uid, -price)
-    cursor.execute("UPDATE gpu_factories SET owner_id=? WHERE city=?", (uid, city))
-    conn.commit()
-    context.user_data["text_state"] = STATE_PREFIXES["factory_buy_name"] + city
+    set_text_state(context, "factory_buy_name", city)
     await render_text(query.message, f"Вы купили завод видеокарт в городе {city}.\nВведите название бизнеса одним сообщением.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="agency_businesses")]]))
 
 async def factory_storage(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2074,8 +2868,7 @@ async def factory_storage(update: Update, context: ContextTypes.DEFAULT_TYPE):
     remain = next_factory_level_remaining(factory)
     remain_text = "Максимальный уровень" if remain is None else f"{remain}"
     eta = seconds_until_factory_done(factory)
-    cursor.execute("SELECT COUNT(*) FROM gpu_factory_orders WHERE city=? AND status='pending'", (city,))
-    pending_deliveries = cursor.fetchone()[0]
+    pending_deliveries = db_fetchone("SELECT COUNT(*) FROM gpu_factory_orders WHERE city=? AND status='pending'", (city,))[0]
     text = (
         f'📦 Склад твоего бизнеса "{factory_display_name(factory)}"\n\n'
         f"📦 сырья на складе: {total_raw}/{limit} ({pct:.2f}% заполнено)\n"
@@ -2100,7 +2893,7 @@ async def factory_buyraw_menu(update: Update, context: ContextTypes.DEFAULT_TYPE
     await query.answer()
     city = query.data.replace("factory_buyraw_menu_", "")
     lines = [f"Закупить сырьё | {city}\n", "Имеется сырья:"]
-    factory = gpu_factory_row(city)
+    factory = await gpu_factory_row_async(city)
     for key, meta in GPU_RAW_DATA.items():
         suffix = key.split("_")[1]
         lines.append(f"{meta['name']}: {factory[f'stored_{suffix}']}")
@@ -2114,7 +2907,7 @@ async def factory_order_raw(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     _, _, city, raw_key = query.data.split("_", 3)
-    context.user_data["text_state"] = STATE_PREFIXES["factory_order_units"] + city + ":" + raw_key
+    set_text_state(context, "factory_order_units", city, raw_key)
     meta = GPU_RAW_DATA[raw_key]
     await render_text(query.message, f"Введите количество единиц для заказа.\n{meta['name']}\nЦена за 1 ед.: {meta['unit_price']}$", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data=f"factory_buyraw_menu_{city}")]]))
 
@@ -2132,12 +2925,12 @@ async def factory_startprod(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     speed = factory_speed_multiplier(factory["id"])
     duration = max(60, int((total_raw / 1000) * 3600 / speed))
-    cursor.execute("""
+    db_execute("""
         UPDATE gpu_factories
         SET is_processing=1, processing_started_at=?, processing_duration=?, processing_amount=?
         WHERE city=?
     """, (int(time.time()), duration, total_raw, city))
-    conn.commit()
+    db_commit()
     await render_text(query.message, f"⚙️ Переработка запущена.\nПолностью завершится через {format_seconds(duration)}", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("📦 Склад бизнеса", callback_data=f"factory_storage_{city}")], [InlineKeyboardButton("⬅️ Назад", callback_data=f"factory_open_{city}")]]))
 
 async def factory_collect(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2149,11 +2942,11 @@ async def factory_collect(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if profit <= 0:
         await query.answer("Прибыль пока не собрана")
         return
-    add_bank_balance(query.from_user.id, profit)
-    cursor.execute("UPDATE gpu_factories SET pending_profit=0 WHERE city=?", (city,))
-    conn.commit()
-    player = get_player(query.from_user.id)
-    log_bank_operation(player["account_number"], query.from_user.id, city, "factory_profit", profit, 0, f"Собрана прибыль с завода {factory_display_name(factory)}")
+    with transaction():
+        add_bank_balance(query.from_user.id, profit)
+        db_execute("UPDATE gpu_factories SET pending_profit=0 WHERE city=?", (city,))
+        player = get_player(query.from_user.id)
+        log_bank_operation(player["account_number"], query.from_user.id, city, "factory_profit", profit, 0, f"Собрана прибыль с завода {factory_display_name(factory)}")
     await render_text(query.message, f"💰 Прибыль собрана и зачислена в банк: {profit}$", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data=f"factory_open_{city}")]]))
 
 async def factory_manage(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2194,24 +2987,24 @@ async def factory_hirenpc(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     city = query.data.replace("factory_hirenpc_", "")
-    factory = gpu_factory_row(city)
+    factory = await gpu_factory_row_async(city)
     count = get_factory_employee_count(factory["id"])
     if count >= factory_employee_limit(factory["level"]):
         await query.answer("Нет свободных слотов сотрудников")
         return
     salary = random.randint(0, 49)
-    cursor.execute("""
+    db_execute("""
         INSERT INTO gpu_factory_employees(factory_id, employee_user_id, employee_name, employee_type, salary_percent, created_at)
         VALUES(?,?,?,?,?,?)
     """, (factory["id"], 0, f"NPC #{count+1}", "npc", salary, int(time.time())))
-    conn.commit()
+    db_commit()
     await render_text(query.message, f"🤖 Нанят бот-сотрудник.\nЕго зарплата: {salary}%", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data=f"factory_manage_{city}")]]))
 
 async def factory_postad_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     city = query.data.replace("factory_postad_flow_", "")
-    context.user_data["text_state"] = STATE_PREFIXES["factory_post_slots"] + city
+    set_text_state(context, "factory_post_slots", city)
     await render_text(query.message, 'Ваше обьявление появится в вкладке "трудоустройство"\nВам нужно указать процент заработной платы и сколько сотрудников вы ищете\n\nУкажите искомое количество сотрудников', reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data=f"factory_manage_{city}")]]))
 
 async def factory_bumpad(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2219,24 +3012,24 @@ async def factory_bumpad(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     city = query.data.replace("factory_bumpad_", "")
     uid = query.from_user.id
-    if get_money(uid) < GPU_FACTORY_BUMP_PRICE:
+    with transaction():
+        paid = debit_money(uid, GPU_FACTORY_BUMP_PRICE)
+        if paid:
+            db_execute("UPDATE gpu_factories SET ad_bumped_at=? WHERE city=?", (int(time.time()), city))
+    if not paid:
         await query.answer("Недостаточно денег")
         return
-    add_money(uid, -GPU_FACTORY_BUMP_PRICE)
-    cursor.execute("UPDATE gpu_factories SET ad_bumped_at=? WHERE city=?", (int(time.time()), city))
-    conn.commit()
     await render_text(query.message, f"Объявление поднято за {GPU_FACTORY_BUMP_PRICE}$", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data=f"factory_manage_{city}")]]))
 
 async def factory_jobs_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    cursor.execute("""
+    ads = db_fetchall("""
         SELECT city, name, ad_slots_target, ad_salary_percent, owner_id, id, ad_description, ad_bumped_at
         FROM gpu_factories
         WHERE owner_id != 0 AND ad_slots_target > 0
         ORDER BY ad_bumped_at DESC, id ASC
     """)
-    ads = cursor.fetchall()
     if not ads:
         await render_text(query.message, "Вот все контракты на найм:\n\nСейчас объявлений нет.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="work_menu")]]))
         return
@@ -2279,11 +3072,10 @@ async def factory_jobview(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     factory_id = int(query.data.replace("factory_jobview_", ""))
-    cursor.execute("""
+    row = db_fetchone("""
         SELECT city, name, owner_id, ad_description, ad_salary_percent, ad_slots_target
         FROM gpu_factories WHERE id=?
     """, (factory_id,))
-    row = cursor.fetchone()
     if not row:
         await query.answer("Объявление не найдено")
         return
@@ -2311,33 +3103,30 @@ async def factory_apply(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     factory_id = int(query.data.replace("factory_apply_", ""))
     uid = query.from_user.id
-    cursor.execute("SELECT 1 FROM gpu_factory_applications WHERE factory_id=? AND applicant_user_id=? AND status='pending'", (factory_id, uid))
-    if cursor.fetchone():
+    if db_fetchone("SELECT 1 FROM gpu_factory_applications WHERE factory_id=? AND applicant_user_id=? AND status='pending'", (factory_id, uid)):
         await query.answer("Вы уже подали заявку")
         return
-    cursor.execute("SELECT COUNT(*) FROM gpu_factory_applications WHERE factory_id=? AND status='pending'", (factory_id,))
-    pending = cursor.fetchone()[0]
+    pending = db_fetchone("SELECT COUNT(*) FROM gpu_factory_applications WHERE factory_id=? AND status='pending'", (factory_id,))[0]
     if pending >= 30:
         await query.answer("Ящик заявок заполнен")
         return
-    cursor.execute("""
+    db_execute("""
         INSERT INTO gpu_factory_applications(factory_id, applicant_user_id, applicant_name, status, created_at)
         VALUES(?,?,?,?,?)
     """, (factory_id, uid, query.from_user.first_name, "pending", int(time.time())))
-    conn.commit()
+    db_commit()
     await render_text(query.message, "Кандидатура отправлена", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="factory_jobs_menu")]]))
 
 async def factory_apps(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     city = query.data.replace("factory_apps_", "")
-    factory = gpu_factory_row(city)
-    cursor.execute("""
+    factory = await gpu_factory_row_async(city)
+    apps = db_fetchall("""
         SELECT id, applicant_name FROM gpu_factory_applications
         WHERE factory_id=? AND status='pending'
         ORDER BY id ASC
     """, (factory["id"],))
-    apps = cursor.fetchall()
     if not apps:
         await render_text(query.message, "Кандидаты:\n\nЗаявок нет", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data=f"factory_manage_{city}")]]))
         return
@@ -2382,8 +3171,7 @@ async def factory_appopen(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     m = re.match(r"factory_appopen_(.+)_(\d+)", query.data)
     city, app_id = m.group(1), int(m.group(2))
-    cursor.execute("SELECT applicant_name FROM gpu_factory_applications WHERE id=? AND status='pending'", (app_id,))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT applicant_name FROM gpu_factory_applications WHERE id=? AND status='pending'", (app_id,))
     if not row:
         await query.answer("Заявка не найдена")
         return
@@ -2400,26 +3188,22 @@ async def factory_app_accept(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await query.answer()
     m = re.match(r"factory_app_accept_(.+)_(\d+)", query.data)
     city, app_id = m.group(1), int(m.group(2))
-    factory = gpu_factory_row(city)
+    factory = await gpu_factory_row_async(city)
     if get_factory_employee_count(factory["id"]) >= factory_employee_limit(factory["level"]):
         await query.answer("Нет свободных слотов")
         return
-    cursor.execute("SELECT applicant_user_id, applicant_name FROM gpu_factory_applications WHERE id=? AND status='pending'", (app_id,))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT applicant_user_id, applicant_name FROM gpu_factory_applications WHERE id=? AND status='pending'", (app_id,))
     if not row:
         await query.answer("Заявка уже обработана")
         return
     applicant_user_id, applicant_name = row
-    cursor.execute("""
+    db_execute("""
         INSERT INTO gpu_factory_employees(factory_id, employee_user_id, employee_name, employee_type, salary_percent, created_at)
         VALUES(?,?,?,?,?,?)
     """, (factory["id"], applicant_user_id, applicant_name, "player", factory["ad_salary_percent"], int(time.time())))
-    cursor.execute("UPDATE gpu_factory_applications SET status='accepted' WHERE id=?", (app_id,))
-    conn.commit()
-    try:
-        await context.bot.send_message(chat_id=applicant_user_id, text=f'Владелец "{factory_display_name(factory)}" принял вашу заявку на трудоустройство')
-    except Exception:
-        pass
+    db_execute("UPDATE gpu_factory_applications SET status='accepted' WHERE id=?", (app_id,))
+    db_commit()
+    notify(applicant_user_id, f'Владелец "{factory_display_name(factory)}" принял вашу заявку на трудоустройство')
     await render_text(query.message, "Заявка принята", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data=f"factory_apps_{city}")]]))
 
 async def factory_app_decline(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2427,30 +3211,25 @@ async def factory_app_decline(update: Update, context: ContextTypes.DEFAULT_TYPE
     await query.answer()
     m = re.match(r"factory_app_decline_(.+)_(\d+)", query.data)
     city, app_id = m.group(1), int(m.group(2))
-    factory = gpu_factory_row(city)
-    cursor.execute("SELECT applicant_user_id FROM gpu_factory_applications WHERE id=? AND status='pending'", (app_id,))
-    row = cursor.fetchone()
+    factory = await gpu_factory_row_async(city)
+    row = db_fetchone("SELECT applicant_user_id FROM gpu_factory_applications WHERE id=? AND status='pending'", (app_id,))
     if row:
         applicant_user_id = row[0]
-        try:
-            await context.bot.send_message(chat_id=applicant_user_id, text=f'Владелец "{factory_display_name(factory)}" отклонил вашу заявку на трудоустройство')
-        except Exception:
-            pass
-    cursor.execute("UPDATE gpu_factory_applications SET status='declined' WHERE id=?", (app_id,))
-    conn.commit()
+        notify(applicant_user_id, f'Владелец "{factory_display_name(factory)}" отклонил вашу заявку на трудоустройство')
+    db_execute("UPDATE gpu_factory_applications SET status='declined' WHERE id=?", (app_id,))
+    db_commit()
     await render_text(query.message, "Заявка отклонена", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data=f"factory_apps_{city}")]]))
 
 async def factory_workers(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     city = query.data.replace("factory_workers_", "")
-    factory = gpu_factory_row(city)
-    cursor.execute("""
+    factory = await gpu_factory_row_async(city)
+    rows = db_fetchall("""
         SELECT employee_name, employee_type, salary_percent
         FROM gpu_factory_employees WHERE factory_id=?
         ORDER BY id ASC
     """, (factory["id"],))
-    rows = cursor.fetchall()
     if not rows:
         text = "Сотрудников пока нет"
     else:
@@ -2464,12 +3243,11 @@ async def factory_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     city = query.data.replace("factory_history_", "")
-    factory = gpu_factory_row(city)
-    cursor.execute("""
+    factory = await gpu_factory_row_async(city)
+    rows = await fetchall_async("""
         SELECT created_at, produced_1060, produced_1660, produced_2060, produced_3060, produced_4060, produced_5060, sent_prices_json
         FROM gpu_factory_history WHERE factory_id=? ORDER BY id DESC LIMIT 10
     """, (factory["id"],))
-    rows = cursor.fetchall()
     if not rows:
         text = "История отправки видеокарт пуста"
     else:
@@ -2497,7 +3275,7 @@ async def factory_open(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def gpu_shop_open_city(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    city = get_player(query.from_user.id)["city"]
+    city = (await get_player_async(query.from_user.id))["city"]
     await gpu_shop_menu_common(query.message, query.from_user.id, query.from_user.first_name, city)
 
 async def gpu_shop_open(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2572,18 +3350,22 @@ async def gpu_shop_buy(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     city = query.data.replace("gpu_shop_buy_", "")
     uid = query.from_user.id
-    shop = gpu_shop_row(city)
-    if shop["owner_id"]:
+    price = GPU_SHOP_PRICES.get(city, 1200000)
+    with transaction():
+        if db_execute("UPDATE gpu_shops SET owner_id=? WHERE city=? AND owner_id=0", (uid, city)).rowcount == 0:
+            status = "taken"
+        elif not debit_money(uid, price):
+            mark_rollback_only()
+            status = "no_money"
+        else:
+            status = "ok"
+    if status == "taken":
         await query.answer("Магазин уже куплен")
         return
-    price = GPU_SHOP_PRICES.get(city, 1200000)
-    if get_money(uid) < price:
+    if status == "no_money":
         await query.answer("Недостаточно денег")
         return
-    add_money(uid, -price)
-    cursor.execute("UPDATE gpu_shops SET owner_id=? WHERE city=?", (uid, city))
-    conn.commit()
-    context.user_data["text_state"] = STATE_PREFIXES["shop_buy_name"] + city
+    set_text_state(context, "shop_buy_name", city)
     await render_text(query.message, f"Вы купили магазин видеокарт в городе {city}.\nВведите название бизнеса одним сообщением.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="agency_businesses")]]))
 
 async def gpu_shop_storage(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2607,8 +3389,7 @@ async def gpu_shop_supplier(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     city = query.data.replace("gpu_shop_supplier_", "")
-    cursor.execute("SELECT city, name FROM gpu_factories WHERE owner_id != 0")
-    rows = cursor.fetchall()
+    rows = db_fetchall("SELECT city, name FROM gpu_factories WHERE owner_id != 0")
     if not rows:
         await render_text(query.message, "Доступных заводов нет.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data=f"gpu_shop_storage_{city}")]]))
         return
@@ -2624,8 +3405,8 @@ async def gpu_shop_selectsupplier(update: Update, context: ContextTypes.DEFAULT_
     await query.answer()
     m = re.match(r"gpu_shop_selectsupplier_(.+)_(.+)", query.data)
     city, supplier_city = m.group(1), m.group(2)
-    cursor.execute("UPDATE gpu_shops SET supplier_factory_city=? WHERE city=?", (supplier_city, city))
-    conn.commit()
+    db_execute("UPDATE gpu_shops SET supplier_factory_city=? WHERE city=?", (supplier_city, city))
+    db_commit()
     await render_text(query.message, f"Поставщик выбран: {supplier_city}", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data=f"gpu_shop_storage_{city}")]]))
 
 async def gpu_shop_shipments(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2637,14 +3418,13 @@ async def gpu_shop_shipments(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not shop["supplier_factory_city"]:
         await render_text(query.message, "Сначала выберите поставщика.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data=f"gpu_shop_storage_{city}")]]))
         return
-    factory = gpu_factory_row(shop["supplier_factory_city"])
-    cursor.execute("""
+    factory = await gpu_factory_row_async(shop["supplier_factory_city"])
+    rows = db_fetchall("""
         SELECT id, gpu_key, remaining_qty, unit_price
         FROM gpu_factory_shipments
         WHERE factory_id=? AND remaining_qty>0
         ORDER BY id DESC
     """, (factory["id"],))
-    rows = cursor.fetchall()
     if not rows:
         await render_text(query.message, "Поставок нет.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data=f"gpu_shop_storage_{city}")]]))
         return
@@ -2678,23 +3458,30 @@ async def gpu_shop_buyship(update: Update, context: ContextTypes.DEFAULT_TYPE):
     m = re.match(r"gpu_shop_buyship_(.+)_(\d+)", query.data)
     city, ship_id = m.group(1), int(m.group(2))
     shop = gpu_shop_row(city)
-    cursor.execute("SELECT gpu_key, remaining_qty, unit_price, city FROM gpu_factory_shipments WHERE id=?", (ship_id,))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT gpu_key, remaining_qty, unit_price, city FROM gpu_factory_shipments WHERE id=?", (ship_id,))
     if not row:
         await query.answer("Поставка не найдена")
         return
     gpu_key, qty, unit_price, source_city = row
     total_cost = qty * unit_price
-    if get_money(query.from_user.id) < total_cost:
+    with transaction():
+        if qty <= 0 or db_execute("UPDATE gpu_factory_shipments SET remaining_qty=remaining_qty-? WHERE id=? AND remaining_qty>=?", (qty, ship_id, qty)).rowcount == 0:
+            status = "sold_out"
+        elif not debit_money(query.from_user.id, total_cost):
+            mark_rollback_only()
+            status = "no_money"
+        else:
+            status = "ok"
+            upsert_shop_inventory(shop["id"], gpu_key, qty, unit_price)
+            supplier_factory = gpu_factory_row(source_city)
+            if supplier_factory["owner_id"]:
+                add_bank_balance(supplier_factory["owner_id"], total_cost)
+    if status == "sold_out":
+        await query.answer("Поставка уже выкуплена")
+        return
+    if status == "no_money":
         await query.answer("Недостаточно денег")
         return
-    add_money(query.from_user.id, -total_cost)
-    upsert_shop_inventory(shop["id"], gpu_key, qty, unit_price)
-    cursor.execute("UPDATE gpu_factory_shipments SET remaining_qty=0 WHERE id=?", (ship_id,))
-    supplier_factory = gpu_factory_row(source_city)
-    if supplier_factory["owner_id"]:
-        add_bank_balance(supplier_factory["owner_id"], total_cost)
-    conn.commit()
     await render_text(query.message, f"Купить {GPU_KEY_TO_LABEL[gpu_key]} за {total_cost}$?\nПокупка выполнена.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data=f"gpu_shop_storage_{city}")]]))
 
 async def gpu_shop_buyall(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2706,28 +3493,38 @@ async def gpu_shop_buyall(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not shop["supplier_factory_city"]:
         await query.answer("Нет поставщика")
         return
-    factory = gpu_factory_row(shop["supplier_factory_city"])
-    cursor.execute("""
+    factory = await gpu_factory_row_async(shop["supplier_factory_city"])
+    rows = db_fetchall("""
         SELECT id, gpu_key, remaining_qty, unit_price
         FROM gpu_factory_shipments
         WHERE factory_id=? AND remaining_qty>0
         ORDER BY id DESC
     """, (factory["id"],))
-    rows = cursor.fetchall()
     total_pages = max(1, math.ceil(len(rows) / 8))
     page = max(0, min(page, total_pages - 1))
     chunk = rows[page*8:(page+1)*8]
     total_cost = sum(qty * unit_price for _, _, qty, unit_price in chunk)
-    if get_money(query.from_user.id) < total_cost:
+    with transaction():
+        # every shipment on the page is claimed or none: a lot bought by someone
+        # else in the meantime rolls the whole page back
+        status = "ok"
+        for ship_id, gpu_key, qty, unit_price in chunk:
+            if db_execute("UPDATE gpu_factory_shipments SET remaining_qty=remaining_qty-? WHERE id=? AND remaining_qty>=?", (qty, ship_id, qty)).rowcount == 0:
+                status = "sold_out"
+                break
+            upsert_shop_inventory(shop["id"], gpu_key, qty, unit_price)
+        if status == "ok" and not debit_money(query.from_user.id, total_cost):
+            status = "no_money"
+        if status != "ok":
+            mark_rollback_only()
+        elif factory["owner_id"]:
+            add_bank_balance(factory["owner_id"], total_cost)
+    if status == "sold_out":
+        await query.answer("Поставки уже выкуплены")
+        return
+    if status == "no_money":
         await query.answer("Недостаточно денег")
         return
-    add_money(query.from_user.id, -total_cost)
-    for ship_id, gpu_key, qty, unit_price in chunk:
-        upsert_shop_inventory(shop["id"], gpu_key, qty, unit_price)
-        cursor.execute("UPDATE gpu_factory_shipments SET remaining_qty=0 WHERE id=?", (ship_id,))
-    if factory["owner_id"]:
-        add_bank_balance(factory["owner_id"], total_cost)
-    conn.commit()
     await render_text(query.message, f"Купить видеокарты на странице за {total_cost}$?\nПокупка выполнена.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data=f"gpu_shop_storage_{city}")]]))
 
 async def gpu_shop_catalog(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2784,8 +3581,7 @@ async def gpu_shop_item(update: Update, context: ContextTypes.DEFAULT_TYPE):
     m = re.match(r"gpu_shop_item_(.+)_(\d+)", query.data)
     city, gpu_key = m.group(1), m.group(2)
     shop = gpu_shop_row(city)
-    cursor.execute("SELECT qty, base_price FROM gpu_shop_inventory WHERE shop_id=? AND gpu_key=?", (shop["id"], gpu_key))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT qty, base_price FROM gpu_shop_inventory WHERE shop_id=? AND gpu_key=?", (shop["id"], gpu_key))
     if not row or row[0] <= 0:
         await query.answer("Товара нет")
         return
@@ -2809,22 +3605,29 @@ async def gpu_shop_buyitem(update: Update, context: ContextTypes.DEFAULT_TYPE):
     city, gpu_key = m.group(1), m.group(2)
     uid = query.from_user.id
     shop = gpu_shop_row(city)
-    cursor.execute("SELECT qty, base_price FROM gpu_shop_inventory WHERE shop_id=? AND gpu_key=?", (shop["id"], gpu_key))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT qty, base_price FROM gpu_shop_inventory WHERE shop_id=? AND gpu_key=?", (shop["id"], gpu_key))
     if not row or row[0] <= 0:
         await query.answer("Товара нет")
         return
     qty, base_price = row
     sell_price = shop_sell_price(base_price, shop["markup_percent"])
-    if get_money(uid) < sell_price:
+    with transaction():
+        if db_execute("UPDATE gpu_shop_inventory SET qty=qty-1 WHERE shop_id=? AND gpu_key=? AND qty>0", (shop["id"], gpu_key)).rowcount == 0:
+            status = "sold_out"
+        elif not debit_money(uid, sell_price):
+            mark_rollback_only()
+            status = "no_money"
+        else:
+            status = "ok"
+            db_execute("UPDATE gpu_shops SET pending_profit=pending_profit+? WHERE city=?", (sell_price, city))
+            db_execute("INSERT INTO gpu_shop_sales(shop_id, created_at, gpu_key, unit_price, buyer_name) VALUES(?,?,?,?,?)", (shop["id"], int(time.time()), gpu_key, sell_price, query.from_user.first_name))
+            add_player_gpu(uid, gpu_key, 1)
+    if status == "sold_out":
+        await query.answer("Товара нет")
+        return
+    if status == "no_money":
         await query.answer("Недостаточно денег")
         return
-    add_money(uid, -sell_price)
-    cursor.execute("UPDATE gpu_shop_inventory SET qty=qty-1 WHERE shop_id=? AND gpu_key=?", (shop["id"], gpu_key))
-    cursor.execute("UPDATE gpu_shops SET pending_profit=pending_profit+? WHERE city=?", (sell_price, city))
-    cursor.execute("INSERT INTO gpu_shop_sales(shop_id, created_at, gpu_key, unit_price, buyer_name) VALUES(?,?,?,?,?)", (shop["id"], int(time.time()), gpu_key, sell_price, query.from_user.first_name))
-    conn.commit()
-    add_player_gpu(uid, gpu_key, 1)
     await render_text(query.message, f"✅ Вы купили:\n{GPU_KEY_TO_LABEL[gpu_key]} x1\n\nСписано: {sell_price}$", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data=f"gpu_shop_catalog_{city}")]]))
 
 async def gpu_shop_markup(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2832,7 +3635,7 @@ async def gpu_shop_markup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     city = query.data.replace("gpu_shop_markup_", "")
     shop = gpu_shop_row(city)
-    context.user_data["text_state"] = STATE_PREFIXES["shop_markup"] + city
+    set_text_state(context, "shop_markup", city)
     await render_text(query.message, f"Изменить наценку магазина\nТекущая наценка: {shop['markup_percent']}%\nВведите новое значение от 5 до 30%", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data=f"gpu_shop_open_{city}")]]))
 
 async def gpu_shop_collect(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2844,11 +3647,11 @@ async def gpu_shop_collect(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if amount <= 0:
         await query.answer("Прибыль пока не собрана")
         return
-    add_bank_balance(query.from_user.id, amount)
-    player = get_player(query.from_user.id)
-    log_bank_operation(player["account_number"], query.from_user.id, city, "gpu_shop_profit", amount, 0, f"Собрана прибыль с магазина {gpu_shop_display_name(shop)}")
-    cursor.execute("UPDATE gpu_shops SET pending_profit=0 WHERE city=?", (city,))
-    conn.commit()
+    with transaction():
+        add_bank_balance(query.from_user.id, amount)
+        player = get_player(query.from_user.id)
+        log_bank_operation(player["account_number"], query.from_user.id, city, "gpu_shop_profit", amount, 0, f"Собрана прибыль с магазина {gpu_shop_display_name(shop)}")
+        db_execute("UPDATE gpu_shops SET pending_profit=0 WHERE city=?", (city,))
     await render_text(query.message, f"💰 Прибыль собрана и зачислена в банк: {amount}$", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data=f"gpu_shop_open_{city}")]]))
 
 async def gpu_shop_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2856,8 +3659,7 @@ async def gpu_shop_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     city = query.data.replace("gpu_shop_stats_", "")
     shop = gpu_shop_row(city)
-    cursor.execute("SELECT created_at, gpu_key, unit_price, buyer_name FROM gpu_shop_sales WHERE shop_id=? ORDER BY id DESC LIMIT 30", (shop["id"],))
-    rows = cursor.fetchall()
+    rows = await fetchall_async("SELECT created_at, gpu_key, unit_price, buyer_name FROM gpu_shop_sales WHERE shop_id=? ORDER BY id DESC LIMIT 30", (shop["id"],))
     if not rows:
         text = "Статистика продаж пуста"
     else:
@@ -2875,7 +3677,7 @@ async def gpu_shop_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def agency_houses(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    city = get_player(query.from_user.id)["city"]
+    city = (await get_player_async(query.from_user.id))["city"]
     owned = get_owned_house(query.from_user.id)
     price = HOUSE_PRICES.get(city, 1000000)
     if owned and owned["city"] == city:
@@ -2919,19 +3721,22 @@ async def house_buy(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("У вас уже есть дом")
         return
     price = HOUSE_PRICES.get(city, 1000000)
-    if get_money(uid) < price:
-        await query.answer("Недостаточно денег")
-        return
-    add_money(uid, -price)
     street = f"{random.choice(HOUSE_STREET_WORDS)} {random.randint(1,99)}"
     house_code = generate_house_code()
-    cursor.execute("""
-        INSERT INTO houses(owner_id, city, level, base_price, house_code, street, mining_progress_btc, last_mining_update, created_at)
-        VALUES(?,?,?,?,?,?,?,?,?)
-    """, (uid, city, 1, price, house_code, street, 0, int(time.time()), int(time.time())))
-    conn.commit()
-    house = get_owned_house(uid)
-    set_current_house(uid, house["id"])
+    with transaction():
+        paid = debit_money(uid, price)
+        if paid:
+            db_execute("""
+                INSERT INTO houses(owner_id, city, level, base_price, house_code, street, mining_progress_btc, last_mining_update, created_at)
+                VALUES(?,?,?,?,?,?,?,?,?)
+            """, (uid, city, 1, price, house_code, street, 0, int(time.time()), int(time.time())))
+            house = get_owned_house(uid)
+            set_current_house(uid, house["id"])
+        else:
+            mark_rollback_only()
+    if not paid:
+        await query.answer("Недостаточно денег")
+        return
     await render_text(query.message, f"✅ Вы купили дом в городе {city}\nНомер дома: {house_code}\nУлица: {street}", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Открыть дом", callback_data="house_menu")]]))
 
 async def house_upgrade(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2947,12 +3752,15 @@ async def house_upgrade(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("Максимальный уровень")
         return
     cost = house_upgrade_cost(house["base_price"], next_level)
-    if get_money(uid) < cost:
+    with transaction():
+        paid = debit_money(uid, cost)
+        if paid:
+            db_execute("UPDATE houses SET level=level+1 WHERE id=?", (house["id"],))
+        else:
+            mark_rollback_only()
+    if not paid:
         await query.answer("Недостаточно денег")
         return
-    add_money(uid, -cost)
-    cursor.execute("UPDATE houses SET level=level+1 WHERE id=?", (house["id"],))
-    conn.commit()
     await render_text(query.message, f"🏠 Дом улучшен до {next_level} уровня.\nСтоимость: {cost}$", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Открыть дом", callback_data="house_menu")]]))
 
 def house_menu_keyboard(house: dict, uid: int):
@@ -3027,8 +3835,9 @@ async def house_gpu_addslot(update: Update, context: ContextTypes.DEFAULT_TYPE):
     slot_index = int(query.data.replace("house_gpu_addslot_", ""))
     uid = query.from_user.id
     options = []
+    inv = get_inventory(uid)
     for gpu_key, item_key in GPU_KEY_TO_ITEM.items():
-        amt = get_item_amount(uid, item_key)
+        amt = inv.get(item_key, 0)
         if amt > 0:
             options.append((gpu_key, amt))
     if not options:
@@ -3058,14 +3867,13 @@ async def house_gpu_install(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if get_item_amount(uid, item_key) <= 0:
         await query.answer("У вас нет такой видеокарты")
         return
-    cursor.execute("SELECT 1 FROM house_gpus WHERE house_id=? AND slot_index=?", (house["id"], slot_index))
-    if cursor.fetchone():
+    if db_fetchone("SELECT 1 FROM house_gpus WHERE house_id=? AND slot_index=?", (house["id"], slot_index)):
         await query.answer("Слот уже занят")
         return
-    cursor.execute("UPDATE player_items SET amount=amount-1 WHERE user_id=? AND item_key=?", (uid, item_key))
-    cursor.execute("DELETE FROM player_items WHERE user_id=? AND item_key=? AND amount<=0", (uid, item_key))
-    cursor.execute("INSERT INTO house_gpus(house_id, slot_index, gpu_key) VALUES(?,?,?)", (house["id"], slot_index, gpu_key))
-    conn.commit()
+    db_execute("UPDATE player_items SET amount=amount-1 WHERE user_id=? AND item_key=?", (uid, item_key))
+    db_execute("DELETE FROM player_items WHERE user_id=? AND item_key=? AND amount<=0", (uid, item_key))
+    db_execute("INSERT INTO house_gpus(house_id, slot_index, gpu_key) VALUES(?,?,?)", (house["id"], slot_index, gpu_key))
+    db_commit()
     await house_mining(update, context)
 
 async def house_gpu_remove(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -3076,15 +3884,14 @@ async def house_gpu_remove(update: Update, context: ContextTypes.DEFAULT_TYPE):
     house = get_owned_house(uid)
     if not house:
         return
-    cursor.execute("SELECT gpu_key FROM house_gpus WHERE house_id=? AND slot_index=?", (house["id"], slot_index))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT gpu_key FROM house_gpus WHERE house_id=? AND slot_index=?", (house["id"], slot_index))
     if not row:
         await query.answer("Слот пуст")
         return
     gpu_key = row[0]
-    cursor.execute("DELETE FROM house_gpus WHERE house_id=? AND slot_index=?", (house["id"], slot_index))
-    conn.commit()
-    add_player_gpu(uid, gpu_key, 1)
+    with transaction():
+        db_execute("DELETE FROM house_gpus WHERE house_id=? AND slot_index=?", (house["id"], slot_index))
+        add_player_gpu(uid, gpu_key, 1)
     await house_mining(update, context)
 
 def item_label(item_key: str) -> str:
@@ -3142,8 +3949,9 @@ async def house_storage_move(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
     lines = ["Выбери что переместить"]
     kb = []
+    inv = get_inventory(uid)
     for item_key in HOUSE_STOREABLE_ITEMS:
-        amt = get_item_amount(uid, item_key)
+        amt = inv.get(item_key, 0)
         if amt > 0:
             lines.append(f"{item_label(item_key)} ({amt})")
             kb.append([InlineKeyboardButton(f"{item_label(item_key)} ({amt})", callback_data=f"house_move_pick_{item_key}")])
@@ -3169,13 +3977,13 @@ async def house_move_pick(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if get_house_storage_total(house["id"]) + 1 > house_storage_limit(house["level"]):
             await query.answer("На складе нет места")
             return
-        cursor.execute("UPDATE player_items SET amount=amount-1 WHERE user_id=? AND item_key=?", (uid, item_key))
-        cursor.execute("DELETE FROM player_items WHERE user_id=? AND item_key=? AND amount<=0", (uid, item_key))
+        db_execute("UPDATE player_items SET amount=amount-1 WHERE user_id=? AND item_key=?", (uid, item_key))
+        db_execute("DELETE FROM player_items WHERE user_id=? AND item_key=? AND amount<=0", (uid, item_key))
         add_house_storage(house["id"], item_key, 1)
-        conn.commit()
+        db_commit()
         await house_storage(update, context)
         return
-    context.user_data["text_state"] = STATE_PREFIXES["house_store_move"] + item_key
+    set_text_state(context, "house_store_move", item_key)
     await render_text(query.message, "Укажите кол-во", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="house_storage_move")]]))
 
 async def house_storage_take(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -3213,12 +4021,12 @@ async def house_take_pick(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if amt == 1:
         if not remove_house_storage(house["id"], item_key, 1):
             return
-        cursor.execute("INSERT OR IGNORE INTO player_items(user_id, item_key, amount) VALUES(?,?,0)", (uid, item_key))
-        cursor.execute("UPDATE player_items SET amount=amount+1 WHERE user_id=? AND item_key=?", (uid, item_key))
-        conn.commit()
+        db_execute("INSERT OR IGNORE INTO player_items(user_id, item_key, amount) VALUES(?,?,0)", (uid, item_key))
+        db_execute("UPDATE player_items SET amount=amount+1 WHERE user_id=? AND item_key=?", (uid, item_key))
+        db_commit()
         await house_storage(update, context)
         return
-    context.user_data["text_state"] = STATE_PREFIXES["house_store_take"] + item_key
+    set_text_state(context, "house_store_take", item_key)
     await render_text(query.message, "Укажите кол-во", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="house_storage_take")]]))
 
 async def house_guests(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -3263,13 +4071,10 @@ async def house_kick(update: Update, context: ContextTypes.DEFAULT_TYPE):
     house = get_owned_house(uid)
     if not house:
         return
-    cursor.execute("DELETE FROM house_guests WHERE house_id=? AND guest_user_id=?", (house["id"], guest_uid))
-    cursor.execute("UPDATE players SET current_house_id=0 WHERE user_id=?", (guest_uid,))
-    conn.commit()
-    try:
-        await context.bot.send_message(chat_id=guest_uid, text="Владелец вас выгнал из дома")
-    except Exception:
-        pass
+    db_execute("DELETE FROM house_guests WHERE house_id=? AND guest_user_id=?", (house["id"], guest_uid))
+    db_execute("UPDATE players SET current_house_id=0 WHERE user_id=?", (guest_uid,))
+    db_commit()
+    notify(guest_uid, "Владелец вас выгнал из дома")
     await house_guests(update, context)
 
 async def house_invite_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -3291,7 +4096,7 @@ async def house_invite_by_id(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await query.answer()
     uid = query.from_user.id
     house = get_owned_house(uid)
-    context.user_data["text_state"] = STATE_PREFIXES["house_invite_id"] + str(house["id"])
+    set_text_state(context, "house_invite_id", house["id"])
     await render_text(query.message, "Введите id телеграма игрока.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="house_invite_menu")]]))
 
 async def house_invite_send(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -3305,21 +4110,17 @@ async def house_invite_send(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(get_house_guests(house["id"])) >= 4:
         await query.answer("Дом уже заполнен")
         return
-    cursor.execute("INSERT INTO house_invites(house_id, owner_id, owner_name, target_user_id, status, created_at) VALUES(?,?,?,?,?,?)", (house["id"], uid, query.from_user.first_name, target_uid, "pending", int(time.time())))
-    invite_id = cursor.lastrowid
-    conn.commit()
-    try:
-        await context.bot.send_message(chat_id=target_uid, text=f"{query.from_user.first_name} приглашает вас в дом", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("✅ Принять", callback_data=f"house_invite_accept_{invite_id}")],[InlineKeyboardButton("❌ Отказать", callback_data=f"house_invite_decline_{invite_id}")]]))
-    except Exception:
-        pass
+    cur = db_execute("INSERT INTO house_invites(house_id, owner_id, owner_name, target_user_id, status, created_at) VALUES(?,?,?,?,?,?)", (house["id"], uid, query.from_user.first_name, target_uid, "pending", int(time.time())))
+    invite_id = cur.lastrowid
+    db_commit()
+    notify(target_uid, f"{query.from_user.first_name} приглашает вас в дом", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("✅ Принять", callback_data=f"house_invite_accept_{invite_id}")],[InlineKeyboardButton("❌ Отказать", callback_data=f"house_invite_decline_{invite_id}")]]))
     await render_text(query.message, "Приглашение отправлено", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="house_guests")]]))
 
 async def house_invite_accept(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     invite_id = int(query.data.replace("house_invite_accept_", ""))
-    cursor.execute("SELECT house_id, owner_name, target_user_id, status FROM house_invites WHERE id=?", (invite_id,))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT house_id, owner_name, target_user_id, status FROM house_invites WHERE id=?", (invite_id,))
     if not row:
         await query.answer("Приглашение не найдено")
         return
@@ -3331,16 +4132,16 @@ async def house_invite_accept(update: Update, context: ContextTypes.DEFAULT_TYPE
         await query.answer("В доме нет места")
         return
     add_house_guest(house_id, query.from_user.id)
-    cursor.execute("UPDATE house_invites SET status='accepted' WHERE id=?", (invite_id,))
-    conn.commit()
+    db_execute("UPDATE house_invites SET status='accepted' WHERE id=?", (invite_id,))
+    db_commit()
     await render_text(query.message, f"Вы вошли в дом игрока {owner_name}", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Открыть дом", callback_data="house_menu")]]))
 
 async def house_invite_decline(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     invite_id = int(query.data.replace("house_invite_decline_", ""))
-    cursor.execute("UPDATE house_invites SET status='declined' WHERE id=?", (invite_id,))
-    conn.commit()
+    db_execute("UPDATE house_invites SET status='declined' WHERE id=?", (invite_id,))
+    db_commit()
     await render_text(query.message, "Приглашение отклонено", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="main")]]))
 
 async def house_chat_open(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -3348,15 +4149,14 @@ async def house_chat_open(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     uid = query.from_user.id
     house = active_house_for_user(uid)
-    cursor.execute("SELECT sender_name, message FROM house_chat_messages WHERE house_id=? ORDER BY id DESC LIMIT 10", (house["id"],))
-    rows = cursor.fetchall()
+    rows = await fetchall_async("SELECT sender_name, message FROM house_chat_ring WHERE house_id=? ORDER BY seq DESC LIMIT 10", (house["id"],))
     rows.reverse()
     lines = ["Чат дома:\n"]
     for sender_name, message in rows:
         lines.append(f"{sender_name}: {message}")
     if len(lines) == 1:
         lines.append("Пока сообщений нет.")
-    context.user_data["text_state"] = STATE_PREFIXES["house_chat"] + str(house["id"])
+    set_text_state(context, "house_chat", house["id"])
     await render_text(query.message, "\n".join(lines), reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="house_guests")]]))
 
 async def house_exit(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -3368,25 +4168,37 @@ async def house_exit(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await main_menu(update, context)
         return
     if house["owner_id"] != uid:
-        cursor.execute("DELETE FROM house_guests WHERE house_id=? AND guest_user_id=?", (house["id"], uid))
-        cursor.execute("UPDATE players SET current_house_id=0 WHERE user_id=?", (uid,))
-        conn.commit()
+        db_execute("DELETE FROM house_guests WHERE house_id=? AND guest_user_id=?", (house["id"], uid))
+        db_execute("UPDATE players SET current_house_id=0 WHERE user_id=?", (uid,))
+        db_commit()
     else:
-        cursor.execute("UPDATE players SET current_house_id=0 WHERE user_id=?", (uid,))
-        conn.commit()
-    cursor.execute("SELECT sender_name, message, created_at FROM house_chat_messages WHERE house_id=? ORDER BY id ASC", (house["id"],))
-    rows = cursor.fetchall()
-    if rows:
-        txt_path = f"/mnt/data/house_chat_{house['id']}_{uid}.txt"
-        with open(txt_path, "w", encoding="utf-8") as f:
-            for sender_name, message, created_at in rows:
-                f.write(f"[{time.strftime('%d.%m.%Y %H:%M:%S', time.localtime(created_at))}] {sender_name}: {message}\n")
-        try:
-            with open(txt_path, "rb") as fdoc:
-                await context.bot.send_document(chat_id=uid, document=fdoc, filename=f"house_chat_{house['house_code']}.txt", caption="TXT файл переписки из этого дома")
-        except Exception:
-            pass
+        db_execute("UPDATE players SET current_house_id=0 WHERE user_id=?", (uid,))
+        db_commit()
     await render_text(query.message, "Вы вышли из дома.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="main")]]))
+    context.application.create_task(export_house_chat(context.bot, uid, house))
+
+async def export_house_chat(bot, uid: int, house: dict):
+    # sends the transcript only if the house chat moved since this user's last export
+    row = await fetchone_async("""
+        SELECT h.chat_seq, COALESCE(e.last_seq, 0)
+        FROM houses h LEFT JOIN house_chat_exports e ON e.house_id=h.id AND e.user_id=?
+        WHERE h.id=?
+    """, (uid, house["id"]))
+    if not row or (row[0] or 0) <= row[1]:
+        return
+    export = await run_db(render_house_chat_export, house["id"])
+    if not export:
+        return
+    data, extension, last_seq = export
+    try:
+        await bot.send_document(chat_id=uid, document=data, filename=f"house_chat_{house['house_code']}{extension}", caption="TXT файл переписки из этого дома")
+    except Exception:
+        return
+    db_execute("""
+        INSERT INTO house_chat_exports(user_id, house_id, last_seq, exported_at) VALUES(?,?,?,?)
+        ON CONFLICT(user_id, house_id) DO UPDATE SET last_seq=excluded.last_seq, exported_at=excluded.exported_at
+    """, (uid, house["id"], last_seq, int(time.time())))
+    db_commit()
 
 async def friends_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -3408,7 +4220,7 @@ async def friends_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def friend_add_manual(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    context.user_data["text_state"] = STATE_PREFIXES["friend_add_manual"]
+    set_text_state(context, "friend_add_manual")
     await render_text(query.message, "Введите id человека.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="friends_menu")]]))
 
 async def friend_request_direct(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -3422,52 +4234,41 @@ async def friend_request_direct(update: Update, context: ContextTypes.DEFAULT_TY
     if friend_exists(uid, target_uid):
         await query.answer("Вы уже друзья")
         return
-    cursor.execute("INSERT INTO friend_requests(from_user_id, from_name, to_user_id, status, created_at) VALUES(?,?,?,?,?)", (uid, query.from_user.first_name, target_uid, "pending", int(time.time())))
-    req_id = cursor.lastrowid
-    conn.commit()
-    try:
-        await context.bot.send_message(chat_id=target_uid, text=f"{query.from_user.first_name} хочет добавить вас в друзья", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("✅️ Добавить в ответ", callback_data=f"friend_accept_{req_id}")],[InlineKeyboardButton("❌️ отказать", callback_data=f"friend_decline_{req_id}")]]))
-    except Exception:
-        pass
+    cur = db_execute("INSERT INTO friend_requests(from_user_id, from_name, to_user_id, status, created_at) VALUES(?,?,?,?,?)", (uid, query.from_user.first_name, target_uid, "pending", int(time.time())))
+    req_id = cur.lastrowid
+    db_commit()
+    notify(target_uid, f"{query.from_user.first_name} хочет добавить вас в друзья", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("✅️ Добавить в ответ", callback_data=f"friend_accept_{req_id}")],[InlineKeyboardButton("❌️ отказать", callback_data=f"friend_decline_{req_id}")]]))
     await render_text(query.message, "Запрос в друзья отправлен", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="house_guests")]]))
 
 async def friend_accept(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     req_id = int(query.data.replace("friend_accept_", ""))
-    cursor.execute("SELECT from_user_id, from_name, to_user_id, status FROM friend_requests WHERE id=?", (req_id,))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT from_user_id, from_name, to_user_id, status FROM friend_requests WHERE id=?", (req_id,))
     if not row:
         return
     from_uid, from_name, to_uid, status = row
     if status != "pending" or to_uid != query.from_user.id:
         return
     create_friendship(from_uid, to_uid)
-    cursor.execute("UPDATE friend_requests SET status='accepted' WHERE id=?", (req_id,))
-    conn.commit()
-    try:
-        await context.bot.send_message(chat_id=from_uid, text=f"{query.from_user.first_name}\nТеперь ваш друг! 😁")
-    except Exception:
-        pass
+    db_execute("UPDATE friend_requests SET status='accepted' WHERE id=?", (req_id,))
+    db_commit()
+    notify(from_uid, f"{query.from_user.first_name}\nТеперь ваш друг! 😁")
     await render_text(query.message, "Друг добавлен", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="main")]]))
 
 async def friend_decline(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     req_id = int(query.data.replace("friend_decline_", ""))
-    cursor.execute("SELECT from_user_id, to_user_id, status FROM friend_requests WHERE id=?", (req_id,))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT from_user_id, to_user_id, status FROM friend_requests WHERE id=?", (req_id,))
     if not row:
         return
     from_uid, to_uid, status = row
     if status != "pending" or to_uid != query.from_user.id:
         return
-    cursor.execute("UPDATE friend_requests SET status='declined' WHERE id=?", (req_id,))
-    conn.commit()
-    try:
-        await context.bot.send_message(chat_id=from_uid, text=f"{query.from_user.first_name} отказался быть вашим другом ☹️")
-    except Exception:
-        pass
+    db_execute("UPDATE friend_requests SET status='declined' WHERE id=?", (req_id,))
+    db_commit()
+    notify(from_uid, f"{query.from_user.first_name} отказался быть вашим другом ☹️")
     await render_text(query.message, "Запрос отклонен", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="main")]]))
 
 async def friend_open(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -3488,13 +4289,10 @@ async def friend_visitreq(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not house:
         await query.answer("У друга нет дома")
         return
-    cursor.execute("INSERT INTO house_invites(house_id, owner_id, owner_name, target_user_id, status, created_at) VALUES(?,?,?,?,?,?)", (house["id"], fid, str(fid), query.from_user.id, "pending", int(time.time())))
-    invite_id = cursor.lastrowid
-    conn.commit()
-    try:
-        await context.bot.send_message(chat_id=fid, text=f"{query.from_user.first_name} просит посетить ваш дом", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("✅ Принять", callback_data=f"house_invite_accept_{invite_id}")],[InlineKeyboardButton("❌ Отказать", callback_data=f"house_invite_decline_{invite_id}")]]))
-    except Exception:
-        pass
+    cur = db_execute("INSERT INTO house_invites(house_id, owner_id, owner_name, target_user_id, status, created_at) VALUES(?,?,?,?,?,?)", (house["id"], fid, str(fid), query.from_user.id, "pending", int(time.time())))
+    invite_id = cur.lastrowid
+    db_commit()
+    notify(fid, f"{query.from_user.first_name} просит посетить ваш дом", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("✅ Принять", callback_data=f"house_invite_accept_{invite_id}")],[InlineKeyboardButton("❌ Отказать", callback_data=f"house_invite_decline_{invite_id}")]]))
     await render_text(query.message, "Запрос на посещение отправлен", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="friends_menu")]]))
 
 async def house_wardrobe(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -3514,13 +4312,10 @@ async def trade_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not house or target_uid not in get_house_guests(house["id"]):
         await query.answer("Игрок не найден в доме")
         return
-    cursor.execute("INSERT INTO trade_sessions(house_id, user1_id, user2_id, status, created_at) VALUES(?,?,?,?,?)", (house["id"], uid, target_uid, "pending", int(time.time())))
-    sid = cursor.lastrowid
-    conn.commit()
-    try:
-        await context.bot.send_message(chat_id=target_uid, text=f"{query.from_user.first_name} предлогает вам трейд", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Принять", callback_data=f"trade_accept_{sid}")],[InlineKeyboardButton("Отклонить", callback_data=f"trade_decline_{sid}")]]))
-    except Exception:
-        pass
+    cur = db_execute("INSERT INTO trade_sessions(house_id, user1_id, user2_id, status, created_at) VALUES(?,?,?,?,?)", (house["id"], uid, target_uid, "pending", int(time.time())))
+    sid = cur.lastrowid
+    db_commit()
+    notify(target_uid, f"{query.from_user.first_name} предлогает вам трейд", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Принять", callback_data=f"trade_accept_{sid}")],[InlineKeyboardButton("Отклонить", callback_data=f"trade_decline_{sid}")]]))
     await render_text(query.message, "Предложение трейда отправлено", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="house_guests")]]))
 
 def trade_text(session: dict, viewer_uid: int):
@@ -3577,23 +4372,19 @@ async def trade_accept(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     sid = int(query.data.replace("trade_accept_", ""))
-    cursor.execute("UPDATE trade_sessions SET status='active' WHERE id=?", (sid,))
-    conn.commit()
+    db_execute("UPDATE trade_sessions SET status='active' WHERE id=?", (sid,))
+    db_commit()
     await render_trade(sid, query.message, query.from_user.id)
 
 async def trade_decline(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     sid = int(query.data.replace("trade_decline_", ""))
-    cursor.execute("SELECT user1_id FROM trade_sessions WHERE id=?", (sid,))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT user1_id FROM trade_sessions WHERE id=?", (sid,))
     if row:
-        try:
-            await context.bot.send_message(chat_id=row[0], text=f"{query.from_user.first_name} отказался от сделки.")
-        except Exception:
-            pass
-    cursor.execute("UPDATE trade_sessions SET status='cancelled' WHERE id=?", (sid,))
-    conn.commit()
+        notify(row[0], f"{query.from_user.first_name} отказался от сделки.")
+    db_execute("UPDATE trade_sessions SET status='cancelled' WHERE id=?", (sid,))
+    db_commit()
     await render_text(query.message, "Сделка отклонена", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="house_guests")]]))
 
 async def trade_additem(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -3609,8 +4400,9 @@ async def trade_additem(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("Нет свободных ячеек")
         return
     kb = []
+    inv = get_inventory(uid)
     for item_key in HOUSE_STOREABLE_ITEMS:
-        amt = get_item_amount(uid, item_key)
+        amt = inv.get(item_key, 0)
         if amt > 0:
             kb.append([InlineKeyboardButton(f"{item_label(item_key)} ({amt})", callback_data=f"trade_pickitem_{sid}_{slot}_{item_key}")])
     kb.append([InlineKeyboardButton("⬅️ Назад", callback_data=f"trade_open_{sid}")])
@@ -3627,19 +4419,19 @@ async def trade_pickitem(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("Предмета нет")
         return
     if amt == 1:
-        cursor.execute("INSERT OR REPLACE INTO trade_offers(session_id, user_id, slot_index, item_key, amount) VALUES(?,?,?,?,?)", (sid, uid, slot, item_key, 1))
-        conn.commit()
+        db_execute("INSERT OR REPLACE INTO trade_offers(session_id, user_id, slot_index, item_key, amount) VALUES(?,?,?,?,?)", (sid, uid, slot, item_key, 1))
+        db_commit()
         reset_trade_ready(sid)
         await render_trade(sid, query.message, uid)
         return
-    context.user_data["text_state"] = STATE_PREFIXES["trade_add_item_amount"] + f"{sid}:{slot}:{item_key}"
+    set_text_state(context, "trade_add_item_amount", sid, slot, item_key)
     await render_text(query.message, "Укажите количество", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data=f"trade_open_{sid}")]]))
 
 async def trade_addmoney(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     sid = int(query.data.replace("trade_addmoney_", ""))
-    context.user_data["text_state"] = STATE_PREFIXES["trade_money"] + str(sid)
+    set_text_state(context, "trade_money", sid)
     await render_text(query.message, "Введите сумму денег для трейда", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data=f"trade_open_{sid}")]]))
 
 async def trade_open(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -3659,8 +4451,8 @@ async def trade_ready(update: Update, context: ContextTypes.DEFAULT_TYPE):
     set_trade_ready(sid, query.from_user.id, 0 if ready else 1)
     session = get_active_trade_for_user(query.from_user.id)
     if session["user1_ready"] and session["user2_ready"]:
-        cursor.execute("UPDATE trade_sessions SET status='locked' WHERE id=?", (sid,))
-        conn.commit()
+        db_execute("UPDATE trade_sessions SET status='locked' WHERE id=?", (sid,))
+        db_commit()
     await render_trade(sid, query.message, query.from_user.id)
 
 async def trade_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -3674,37 +4466,16 @@ async def trade_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     set_trade_confirm(sid, query.from_user.id, 1)
     session = get_active_trade_for_user(query.from_user.id)
     if session["user1_confirmed"] and session["user2_confirmed"]:
-        u1, u2 = session["user1_id"], session["user2_id"]
-        money1 = get_trade_money(sid, u1); money2 = get_trade_money(sid, u2)
-        if get_money(u1) < money1 or get_money(u2) < money2:
-            cursor.execute("UPDATE trade_sessions SET status='cancelled' WHERE id=?", (sid,))
-            conn.commit()
-            await render_text(query.message, "Сделка отменена: не хватает денег", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="house_guests")]]))
+        result = complete_trade(sid)
+        if result == "taken":
+            await query.answer("Сделка уже завершена")
+            return
+        if result in ("no_money", "no_items"):
+            db_execute("UPDATE trade_sessions SET status='cancelled' WHERE id=? AND status='locked'", (sid,))
+            db_commit()
+            reason = "не хватает денег" if result == "no_money" else "не хватает предметов"
+            await render_text(query.message, f"Сделка отменена: {reason}", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="house_guests")]]))
             return
-        # validate items
-        for uid_check in (u1, u2):
-            for _, item_key, amount in get_trade_offers(sid, uid_check):
-                if get_item_amount(uid_check, item_key) < amount:
-                    cursor.execute("UPDATE trade_sessions SET status='cancelled' WHERE id=?", (sid,))
-                    conn.commit()
-                    await render_text(query.message, "Сделка отменена: не хватает предметов", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="house_guests")]]))
-                    return
-        # exchange money
-        add_money(u1, -money1 + money2)
-        add_money(u2, -money2 + money1)
-        # exchange items
-        offers1 = get_trade_offers(sid, u1); offers2 = get_trade_offers(sid, u2)
-        for _, item_key, amount in offers1:
-            cursor.execute("UPDATE player_items SET amount=amount-? WHERE user_id=? AND item_key=?", (amount, u1, item_key))
-            cursor.execute("INSERT OR IGNORE INTO player_items(user_id, item_key, amount) VALUES(?,?,0)", (u2, item_key))
-            cursor.execute("UPDATE player_items SET amount=amount+? WHERE user_id=? AND item_key=?", (amount, u2, item_key))
-        for _, item_key, amount in offers2:
-            cursor.execute("UPDATE player_items SET amount=amount-? WHERE user_id=? AND item_key=?", (amount, u2, item_key))
-            cursor.execute("INSERT OR IGNORE INTO player_items(user_id, item_key, amount) VALUES(?,?,0)", (u1, item_key))
-            cursor.execute("UPDATE player_items SET amount=amount+? WHERE user_id=? AND item_key=?", (amount, u1, item_key))
-        cursor.execute("DELETE FROM player_items WHERE amount<=0")
-        cursor.execute("UPDATE trade_sessions SET status='completed' WHERE id=?", (sid,))
-        conn.commit()
         await render_text(query.message, "✅ Сделка завершена", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="house_guests")]]))
         return
     await render_trade(sid, query.message, query.from_user.id)
@@ -3713,8 +4484,8 @@ async def trade_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     sid = int(query.data.replace("trade_cancel_", ""))
-    cursor.execute("UPDATE trade_sessions SET status='cancelled' WHERE id=?", (sid,))
-    conn.commit()
+    db_execute("UPDATE trade_sessions SET status='cancelled' WHERE id=?", (sid,))
+    db_commit()
     await render_text(query.message, "Сделка отменена", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="house_guests")]]))
 
 
@@ -3762,18 +4533,17 @@ def logistics_next_level_at(level: int):
     return LOGISTICS_LEVEL_THRESHOLDS[level]
 
 def add_logistics_delivery(uid: int):
-    cursor.execute("UPDATE players SET logistics_done = logistics_done + 1 WHERE user_id=?", (uid,))
-    conn.commit()
-    cursor.execute("SELECT logistics_done, logistics_level FROM players WHERE user_id=?", (uid,))
-    done, level = cursor.fetchone()
+    db_execute("UPDATE players SET logistics_done = logistics_done + 1 WHERE user_id=?", (uid,))
+    db_commit()
+    done, level = db_fetchone("SELECT logistics_done, logistics_level FROM players WHERE user_id=?", (uid,))
     new_level = clamp_logistics_level(level)
     for i, threshold in enumerate(LOGISTICS_LEVEL_THRESHOLDS, start=1):
         if done >= threshold:
             new_level = i
     new_level = clamp_logistics_level(new_level)
     if new_level != level:
-        cursor.execute("UPDATE players SET logistics_level=? WHERE user_id=?", (new_level, uid))
-        conn.commit()
+        db_execute("UPDATE players SET logistics_level=? WHERE user_id=?", (new_level, uid))
+        db_commit()
         return new_level
     return None
 
@@ -3841,11 +4611,10 @@ def get_selected_logistics_vehicle(context: ContextTypes.DEFAULT_TYPE, uid: int)
     selected = context.user_data.get(f"logistics_vehicle_{uid}")
     if selected and selected.get("source") == "own":
         garage_id = selected.get("garage_id")
-        cursor.execute("""
+        row = db_fetchone("""
             SELECT id, car, speed, truck_level, cargo_capacity, speed_bonus_percent, capacity_bonus_percent
             FROM garage WHERE id=? AND owner=?
         """, (garage_id, uid))
-        row = cursor.fetchone()
         if row and row[1] in LOGISTICS_TRUCKS:
             gid, car, speed, truck_level, capacity, speed_bonus, capacity_bonus = row
             speed_bonus = speed_bonus or 0
@@ -3876,64 +4645,52 @@ def set_selected_logistics_vehicle(context: ContextTypes.DEFAULT_TYPE, uid: int,
     context.user_data[f"logistics_vehicle_{uid}"] = vehicle
 
 def get_active_logistics_order(uid: int):
-    cursor.execute("""
+    row = db_fetchone("""
         SELECT id, city, order_code, resource_key, units, delivery_cost, cargo_weight, vehicle_name,
                delivery_started_at, delivery_eta_seconds, reward_amount, driver_type
         FROM gpu_factory_orders
         WHERE status='in_delivery' AND driver_id=?
         ORDER BY id DESC LIMIT 1
     """, (uid,))
-    row = cursor.fetchone()
     return row
 
 def get_order_business_name(factory_id: int, city: str) -> str:
-    cursor.execute("SELECT name FROM gpu_factories WHERE id=?", (factory_id,))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT name FROM gpu_factories WHERE id=?", (factory_id,))
     if row and row[0]:
         return row[0]
     return f"Завод видеокарт | {city}"
 
 def add_player_item(uid: int, item_key: str, amount: int = 1):
-    cursor.execute("INSERT OR IGNORE INTO player_items(user_id, item_key, amount) VALUES(?,?,0)", (uid, item_key))
-    cursor.execute("UPDATE player_items SET amount=amount+? WHERE user_id=? AND item_key=?", (amount, uid, item_key))
-    conn.commit()
+    db_execute("INSERT OR IGNORE INTO player_items(user_id, item_key, amount) VALUES(?,?,0)", (uid, item_key))
+    db_execute("UPDATE player_items SET amount=amount+? WHERE user_id=? AND item_key=?", (amount, uid, item_key))
+    db_commit()
 
-async def grant_logistics_rare_reward(driver_id: int, factory_id: int, order_code: str, app):
+def grant_logistics_rare_reward(driver_id: int, factory_id: int, order_code: str):
+    # applies the reward and returns the text for the driver, or None
     if random.random() >= LOGISTICS_REWARD_CHANCE:
-        return
+        return None
     if random.random() < 0.25:
-        cursor.execute("UPDATE gpu_factories SET warehouse_bonus_percent = warehouse_bonus_percent + 25 WHERE id=?", (factory_id,))
-        conn.commit()
-        try:
-            await app.bot.send_message(
-                chat_id=driver_id,
-                text=f"🎁 Редкая награда за доставку #{order_code}: план расширения склада. Склад бизнеса расширен на +25%."
-            )
-        except Exception:
-            pass
-        return
+        db_execute("UPDATE gpu_factories SET warehouse_bonus_percent = warehouse_bonus_percent + 25 WHERE id=?", (factory_id,))
+        db_commit()
+        return f"🎁 Редкая награда за доставку #{order_code}: план расширения склада. Склад бизнеса расширен на +25%."
     item_key, label = random.choice(LOGISTICS_REWARD_ITEMS)
     add_player_item(driver_id, item_key, 1)
-    try:
-        await app.bot.send_message(chat_id=driver_id, text=f"🎁 Редкая награда за доставку #{order_code}: {label}")
-    except Exception:
-        pass
+    return f"🎁 Редкая награда за доставку #{order_code}: {label}"
 
 async def logistics_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     uid = query.from_user.id
-    player = get_player(uid)
+    player = await get_player_async(uid)
     vehicle = get_selected_logistics_vehicle(context, uid)
     page = context.user_data.get("logistics_page", 0)
 
-    cursor.execute("""
+    orders = await fetchall_async("""
         SELECT id, order_code, city, factory_id
         FROM gpu_factory_orders
         WHERE status='pending'
         ORDER BY id DESC
     """)
-    orders = cursor.fetchall()
     total_pages = max(1, math.ceil(len(orders) / 5))
     page = max(0, min(page, total_pages - 1))
     context.user_data["logistics_page"] = page
@@ -3992,11 +4749,10 @@ async def logistics_own_trucks(update: Update, context: ContextTypes.DEFAULT_TYP
     query = update.callback_query
     await query.answer()
     uid = query.from_user.id
-    cursor.execute("""
+    rows = [r for r in db_fetchall("""
         SELECT id, car, speed, truck_level, cargo_capacity, speed_bonus_percent, capacity_bonus_percent
         FROM garage WHERE owner=?
-    """, (uid,))
-    rows = [r for r in cursor.fetchall() if r[1] in LOGISTICS_TRUCKS]
+    """, (uid,)) if r[1] in LOGISTICS_TRUCKS]
     if not rows:
         await render_text(query.message, "У вас нет своих грузовиков.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="logistics_choose_truck")]]))
         return
@@ -4013,8 +4769,7 @@ async def logistics_select_own(update: Update, context: ContextTypes.DEFAULT_TYP
     await query.answer()
     uid = query.from_user.id
     gid = int(query.data.replace("logistics_select_own_", ""))
-    cursor.execute("SELECT car FROM garage WHERE id=? AND owner=?", (gid, uid))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT car FROM garage WHERE id=? AND owner=?", (gid, uid))
     if not row or row[0] not in LOGISTICS_TRUCKS:
         await query.answer("Грузовик не найден")
         return
@@ -4031,7 +4786,7 @@ async def logistics_rent_menu(update: Update, context: ContextTypes.DEFAULT_TYPE
     truck = trucks[idx]
     meta = LOGISTICS_TRUCKS[truck]
     rent_cost = int(meta["price"] * 0.10)
-    player_level = get_player(uid)["logistics_level"]
+    player_level = (await get_player_async(uid))["logistics_level"]
     lock_text = f"\nТребуется уровень логиста: {meta['truck_level']}" if player_level < meta["truck_level"] else ""
     caption = (
         f"{truck}\n\n"
@@ -4069,17 +4824,20 @@ async def logistics_rent_pick(update: Update, context: ContextTypes.DEFAULT_TYPE
     trucks = list(LOGISTICS_TRUCKS.keys())
     truck = trucks[idx]
     meta = LOGISTICS_TRUCKS[truck]
-    player = get_player(uid)
+    player = await get_player_async(uid)
     if player["logistics_level"] < meta["truck_level"]:
         await query.answer(f"Нужен уровень логиста {meta['truck_level']}")
         return
     rent_cost = int(meta["price"] * 0.10)
-    if player["money"] < rent_cost:
+    with transaction():
+        paid = debit_money(uid, rent_cost)
+        if paid:
+            db_execute("UPDATE players SET logistics_rent_truck=?, logistics_rent_remaining=? WHERE user_id=?", (truck, LOGISTICS_RENT_TRIPS, uid))
+        else:
+            mark_rollback_only()
+    if not paid:
         await query.answer("Недостаточно денег")
         return
-    add_money(uid, -rent_cost)
-    cursor.execute("UPDATE players SET logistics_rent_truck=?, logistics_rent_remaining=? WHERE user_id=?", (truck, LOGISTICS_RENT_TRIPS, uid))
-    conn.commit()
     set_selected_logistics_vehicle(context, uid, {"source": "rent", "name": truck})
     await render_text(query.message, f"Вы арендовали {truck} на 3 поездки за {rent_cost}$", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🚚 Логистика", callback_data="logistics_menu")]]))
 
@@ -4088,18 +4846,17 @@ async def logistics_order_view(update: Update, context: ContextTypes.DEFAULT_TYP
     await query.answer()
     order_id = int(query.data.replace("logistics_order_", ""))
     uid = query.from_user.id
-    cursor.execute("""
+    row = db_fetchone("""
         SELECT id, city, factory_id, owner_id, order_code, resource_key, units, resource_cost, delivery_cost, status, cargo_weight
         FROM gpu_factory_orders WHERE id=?
     """, (order_id,))
-    row = cursor.fetchone()
     if not row:
         await query.answer("Заказ не найден")
         return
     _, city, factory_id, owner_id, order_code, resource_key, units, resource_cost, delivery_cost, status, cargo_weight = row
     business = get_order_business_name(factory_id, city)
     vehicle = get_selected_logistics_vehicle(context, uid)
-    player = get_player(uid)
+    player = await get_player_async(uid)
     if not cargo_weight:
         cargo_weight = calculate_logistics_cargo_weight(resource_key, units)
     if vehicle:
@@ -4139,11 +4896,10 @@ async def logistics_accept_order(update: Update, context: ContextTypes.DEFAULT_T
     if get_active_logistics_order(uid):
         await query.answer("У вас уже есть текущий заказ", show_alert=True)
         return
-    cursor.execute("""
+    row = db_fetchone("""
         SELECT id, city, factory_id, owner_id, owner_name, order_code, resource_key, units, delivery_cost, status, cargo_weight
         FROM gpu_factory_orders WHERE id=?
     """, (order_id,))
-    row = cursor.fetchone()
     if not row:
         await query.answer("Заказ не найден", show_alert=True)
         return
@@ -4161,12 +4917,12 @@ async def logistics_accept_order(update: Update, context: ContextTypes.DEFAULT_T
         msg = f"На вашем грузовкие нельзя совершить такой тяжелый заказ. Перегруз слишком велик({overload_percent:.1f}%) улучшите или смените грузовик или выберите заказ легче."
         await query.answer(msg, show_alert=True)
         return
-    player = get_player(uid)
+    player = await get_player_async(uid)
     percent = logistics_percent(player["logistics_level"], rented=vehicle.get("source") == "rent")
     reward = int(delivery_cost * percent / 100)
     driver_name = query.from_user.first_name or str(uid)
     now = int(time.time())
-    cursor.execute("""
+    cur = db_execute("""
         UPDATE gpu_factory_orders
         SET status='in_delivery', driver_id=?, driver_name=?, driver_type=?, vehicle_name=?, vehicle_type=?,
             vehicle_speed=?, vehicle_capacity=?, cargo_weight=?, delivery_started_at=?, delivery_eta_seconds=?, reward_amount=?
@@ -4175,11 +4931,12 @@ async def logistics_accept_order(update: Update, context: ContextTypes.DEFAULT_T
         uid, driver_name, vehicle.get("source", "own"), vehicle["name"], "truck", vehicle["speed"], vehicle["capacity"],
         cargo_weight, now, total_seconds, reward, order_id
     ))
-    if cursor.rowcount == 0:
-        conn.commit()
+    if cur.rowcount == 0:
+        db_commit()
         await query.answer("Заказ уже взял другой логист", show_alert=True)
         return
-    conn.commit()
+    # commits the claim together with its delivery timer
+    schedule_job("logistics_finish", order_id, now + total_seconds)
     start_msg = None
     try:
         start_msg = await context.bot.send_message(
@@ -4192,9 +4949,8 @@ async def logistics_accept_order(update: Update, context: ContextTypes.DEFAULT_T
     except Exception:
         pass
     if start_msg:
-        cursor.execute("UPDATE gpu_factory_orders SET start_notice_chat_id=?, start_notice_message_id=? WHERE id=?", (start_msg.chat_id, start_msg.message_id, order_id))
-        conn.commit()
-    context.application.create_task(finish_logistics_order_later(order_id, context.application))
+        db_execute("UPDATE gpu_factory_orders SET start_notice_chat_id=?, start_notice_message_id=? WHERE id=?", (start_msg.chat_id, start_msg.message_id, order_id))
+        db_commit()
     await query.answer("Заказ принят")
     await render_text(query.message, f"🚚 Заказ #{order_code} принят.\nОсталось времени: {format_seconds(total_seconds)}", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🧾 Текущий заказ", callback_data="logistics_current_order")]]))
 
@@ -4220,103 +4976,106 @@ async def logistics_current_order(update: Update, context: ContextTypes.DEFAULT_
     )
     await render_text(query.message, text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Обновить ⏳", callback_data="logistics_current_order")], [InlineKeyboardButton("⬅️ Назад", callback_data="logistics_menu")]]))
 
-async def finish_logistics_order_later(order_id: int, app):
-    cursor.execute("SELECT delivery_started_at, delivery_eta_seconds FROM gpu_factory_orders WHERE id=?", (order_id,))
-    row = cursor.fetchone()
+async def logistics_npc_takeover(order_id: int, app):
+    # pending orders wait LOGISTICS_NPC_WAIT_SECONDS for a real logistics player, then NPC takes them
+    row = db_fetchone("SELECT city, owner_id, order_code, resource_key, units, cargo_weight FROM gpu_factory_orders WHERE id=? AND status='pending'", (order_id,))
     if not row:
         return
-    started_at, eta_seconds = row
-    seconds = max(1, int((started_at or int(time.time())) + (eta_seconds or 1) - time.time()))
-    await asyncio.sleep(seconds)
-    await finalize_logistics_order(order_id, app)
-
-async def finalize_logistics_order(order_id: int, app):
-    cursor.execute("""
-        SELECT id, city, factory_id, owner_id, owner_name, order_code, resource_key, units, status,
-               driver_id, driver_name, driver_type, reward_amount, start_notice_chat_id, start_notice_message_id
-        FROM gpu_factory_orders WHERE id=?
-    """, (order_id,))
-    row = cursor.fetchone()
-    if not row:
-        return
-    (oid, city, factory_id, owner_id, owner_name, order_code, resource_key, units, status,
-     driver_id, driver_name, driver_type, reward_amount, notice_chat_id, notice_message_id) = row
-    if status != "in_delivery":
-        return
+    city, owner_id, order_code, resource_key, units, cargo_weight = row
+    if not cargo_weight:
+        cargo_weight = calculate_logistics_cargo_weight(resource_key, units)
+    npc_truck = LOGISTICS_TRUCKS["Ford F-250"]
+    total_seconds, _, _, _, _ = calculate_logistics_time(city, npc_truck["speed"], npc_truck["cargo_capacity"], cargo_weight, force_npc=True)
     now = int(time.time())
-    suffix = resource_key.split("_")[1]
-    stored_key = f"stored_{suffix}"
-    cursor.execute(f"UPDATE gpu_factories SET {stored_key} = {stored_key} + ? WHERE id=?", (units, factory_id))
-    final_status = "npc_delivered" if driver_type == "npc" else "delivered"
-    cursor.execute("UPDATE gpu_factory_orders SET status=?, delivered_at=? WHERE id=?", (final_status, now, order_id))
-    conn.commit()
-
-    if notice_chat_id and notice_message_id:
-        try:
-            await app.bot.delete_message(chat_id=notice_chat_id, message_id=notice_message_id)
-        except Exception:
-            pass
-
-    if driver_type == "npc":
+    with transaction():
+        cur = db_execute("""
+            UPDATE gpu_factory_orders
+            SET status='in_delivery', driver_id=0, driver_name='NPC-логист', driver_type='npc',
+                vehicle_name=?, vehicle_type='truck', vehicle_speed=?, vehicle_capacity=?, cargo_weight=?,
+                delivery_started_at=?, delivery_eta_seconds=?, reward_amount=0
+            WHERE id=? AND status='pending'
+        """, ("Ford F-250", npc_truck["speed"], npc_truck["cargo_capacity"], cargo_weight, now, total_seconds, order_id))
+        if cur.rowcount == 0:
+            return
+        schedule_job("logistics_finish", order_id, now + total_seconds)
         if owner_id:
-            try:
-                await app.bot.send_message(
-                    chat_id=owner_id,
-                    text=f"📦 Твой заказ #{order_code} был доставлен службой NPC-логистики.\nСырьё отгружено на склад бизнеса."
-                )
-            except Exception:
-                pass
-        return
-
-    if driver_id:
-        add_money(driver_id, reward_amount or 0)
-        if order_code.startswith("DELIVERY"):
-            add_money(driver_id, 50000000)
-        new_level = add_logistics_delivery(driver_id)
-        set_city(driver_id, city)
-        if driver_type == "rent":
-            cursor.execute("UPDATE players SET logistics_rent_remaining = MAX(logistics_rent_remaining - 1, 0) WHERE user_id=?", (driver_id,))
-            cursor.execute("UPDATE players SET logistics_rent_truck='' WHERE user_id=? AND logistics_rent_remaining<=0", (driver_id,))
-            conn.commit()
-        try:
-            msg = (
-                f"✅ Доставка завершена\n\n"
-                f"ORDER #{order_code}\n"
-                f"Груз: {GPU_RAW_DATA[resource_key]['name']} x{units}\n"
-                f"Получено: {reward_amount}$"
-            )
-            if order_code.startswith("DELIVERY"):
-                msg += "\n🎉 Пасхалка DELIVERY: дополнительно получено 50000000$"
-            if new_level:
-                msg += f"\n🎉 Уровень логиста повышен! Теперь ваш уровень: {new_level}"
-            await app.bot.send_message(chat_id=driver_id, text=msg)
-        except Exception:
-            pass
-        await grant_logistics_rare_reward(driver_id, factory_id, order_code, app)
+            notify(owner_id, f"📦 Твой заказ #{order_code} будет доставлен службой NPC-логистики.\nСырьё будет отгружено на склад бизнеса.")
 
-    if owner_id:
-        try:
-            await app.bot.send_message(
-                chat_id=owner_id,
-                text=(
-                    f"📦 {owner_name or owner_id}, сотрудник службы доставки {driver_name} звершил работать по твоему заказу #{order_code}.\n"
-                    f"Сырье отгружено на склад бизнесса"
-                ),
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("💰Чаевые", callback_data=f"logistics_tip_{order_id}"),
-                     InlineKeyboardButton("🆗 хорошо", callback_data=f"logistics_notice_ok_{order_id}")]
-                ])
-            )
-        except Exception:
-            pass
+async def finalize_logistics_order(order_id: int, app):
+    notifications = []
+    with transaction():
+        # claiming the order is the only check, so a repeated or concurrent run changes nothing
+        cur = db_execute("""
+            UPDATE gpu_factory_orders
+            SET status=CASE WHEN driver_type='npc' THEN 'npc_delivered' ELSE 'delivered' END, delivered_at=?
+            WHERE id=? AND status='in_delivery'
+        """, (int(time.time()), order_id))
+        if cur.rowcount == 0:
+            return
+        row = db_fetchone("""
+            SELECT city, factory_id, owner_id, owner_name, order_code, resource_key, units,
+                   driver_id, driver_name, driver_type, reward_amount, start_notice_chat_id, start_notice_message_id
+            FROM gpu_factory_orders WHERE id=?
+        """, (order_id,))
+        (city, factory_id, owner_id, owner_name, order_code, resource_key, units,
+         driver_id, driver_name, driver_type, reward_amount, notice_chat_id, notice_message_id) = row
+        stored_key = f"stored_{resource_key.split('_')[1]}"
+        db_execute(f"UPDATE gpu_factories SET {stored_key} = {stored_key} + ? WHERE id=?", (units, factory_id))
+
+        if notice_chat_id and notice_message_id:
+            notifications.append({"chat_id": notice_chat_id, "delete_message_id": notice_message_id})
+
+        if driver_type == "npc":
+            if owner_id:
+                notifications.append({
+                    "chat_id": owner_id,
+                    "text": f"📦 Твой заказ #{order_code} был доставлен службой NPC-логистики.\nСырьё отгружено на склад бизнеса.",
+                })
+        else:
+            if driver_id:
+                add_money(driver_id, reward_amount or 0)
+                if order_code.startswith("DELIVERY"):
+                    add_money(driver_id, 50000000)
+                new_level = add_logistics_delivery(driver_id)
+                set_city(driver_id, city)
+                if driver_type == "rent":
+                    db_execute("UPDATE players SET logistics_rent_remaining = MAX(logistics_rent_remaining - 1, 0) WHERE user_id=?", (driver_id,))
+                    db_execute("UPDATE players SET logistics_rent_truck='' WHERE user_id=? AND logistics_rent_remaining<=0", (driver_id,))
+                reward_text = grant_logistics_rare_reward(driver_id, factory_id, order_code)
+                msg = (
+                    f"✅ Доставка завершена\n\n"
+                    f"ORDER #{order_code}\n"
+                    f"Груз: {GPU_RAW_DATA[resource_key]['name']} x{units}\n"
+                    f"Получено: {reward_amount}$"
+                )
+                if order_code.startswith("DELIVERY"):
+                    msg += "\n🎉 Пасхалка DELIVERY: дополнительно получено 50000000$"
+                if new_level:
+                    msg += f"\n🎉 Уровень логиста повышен! Теперь ваш уровень: {new_level}"
+                notifications.append({"chat_id": driver_id, "text": msg})
+                if reward_text:
+                    notifications.append({"chat_id": driver_id, "text": reward_text})
+            if owner_id:
+                notifications.append({
+                    "chat_id": owner_id,
+                    "text": (
+                        f"📦 {owner_name or owner_id}, сотрудник службы доставки {driver_name} звершил работать по твоему заказу #{order_code}.\n"
+                        f"Сырье отгружено на склад бизнесса"
+                    ),
+                    "reply_markup": InlineKeyboardMarkup([
+                        [InlineKeyboardButton("💰Чаевые", callback_data=f"logistics_tip_{order_id}"),
+                         InlineKeyboardButton("🆗 хорошо", callback_data=f"logistics_notice_ok_{order_id}")]
+                    ]),
+                })
+        # queued in the same transaction, so only a committed delivery is announced
+        enqueue_notifications(notifications)
 
 async def logistics_tip_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     order_id = int(query.data.replace("logistics_tip_", ""))
     uid = query.from_user.id
-    cursor.execute("SELECT owner_id, driver_id, status, tip_amount FROM gpu_factory_orders WHERE id=?", (order_id,))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT owner_id, driver_id, status, tip_amount FROM gpu_factory_orders WHERE id=?", (order_id,))
     if not row:
         await query.answer("Заказ не найден")
         return
@@ -4330,7 +5089,7 @@ async def logistics_tip_start(update: Update, context: ContextTypes.DEFAULT_TYPE
     if tip_amount:
         await query.answer("Чаевые уже оставлены")
         return
-    context.user_data["text_state"] = STATE_PREFIXES["logistics_tip"] + str(order_id)
+    set_text_state(context, "logistics_tip", order_id)
     await render_text(
         query.message,
         'Введите сумму не более 50000$ и напишите текст в одном сообщении.\n\nПример:"6700 Быстро, спасибо"',
@@ -4357,41 +5116,40 @@ async def handle_logistics_tip_text(update: Update, context: ContextTypes.DEFAUL
     if amount <= 0 or amount > 50000:
         await update.message.reply_text("Сумма чаевых должна быть от 1$ до 50000$.")
         return
-    cursor.execute("""
+    row = db_fetchone("""
         SELECT owner_id, driver_id, driver_name, order_code, status, tip_amount
         FROM gpu_factory_orders WHERE id=?
     """, (order_id,))
-    row = cursor.fetchone()
     if not row:
         await update.message.reply_text("Заказ не найден.")
-        context.user_data.pop("text_state", None)
+        clear_text_state(context)
         return
     owner_id, driver_id, driver_name, order_code, status, tip_amount = row
     if owner_id != uid:
         await update.message.reply_text("Чаевые может оставить только заказчик.")
-        context.user_data.pop("text_state", None)
+        clear_text_state(context)
         return
     if status != "delivered" or not driver_id:
         await update.message.reply_text("Чаевые доступны только после доставки игроком.")
-        context.user_data.pop("text_state", None)
+        clear_text_state(context)
         return
     if tip_amount:
         await update.message.reply_text("Чаевые уже оставлены.")
-        context.user_data.pop("text_state", None)
-        return
-    if get_money(uid) < amount:
+        clear_text_state(context)
+        return
+    with transaction():
+        paid = debit_money(uid, amount)
+        if paid:
+            add_money(driver_id, amount)
+            db_execute("UPDATE gpu_factory_orders SET tip_amount=?, tip_message=?, tip_created_at=? WHERE id=?", (amount, message, int(time.time()), order_id))
+            notify(driver_id, f"💸 Вам оставили чаевые за доставку #{order_code}\n\nСумма: {amount}$\nСообщение: {message}")
+        else:
+            mark_rollback_only()
+    if not paid:
         await update.message.reply_text("Недостаточно денег для чаевых.")
         return
-    add_money(uid, -amount)
-    add_money(driver_id, amount)
-    cursor.execute("UPDATE gpu_factory_orders SET tip_amount=?, tip_message=?, tip_created_at=? WHERE id=?", (amount, message, int(time.time()), order_id))
-    conn.commit()
-    context.user_data.pop("text_state", None)
+    clear_text_state(context)
     await update.message.reply_text(f"✅ Чаевые отправлены доставщику {driver_name}\nСумма: {amount}$\nСообщение: {message}")
-    try:
-        await context.bot.send_message(chat_id=driver_id, text=f"💸 Вам оставили чаевые за доставку #{order_code}\n\nСумма: {amount}$\nСообщение: {message}")
-    except Exception:
-        pass
 
 # ---------------- BANK ----------------
 
@@ -4409,7 +5167,7 @@ def bank_keyboard():
 async def bank_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    player = get_player(query.from_user.id)
+    player = await get_player_async(query.from_user.id)
     city = player["city"]
     image = BANK_IMAGES.get(city, BANK_IMAGES["Новоград"])
     caption = (
@@ -4424,25 +5182,25 @@ async def bank_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def bank_deposit(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    context.user_data["bank_action"] = "deposit"
+    set_text_state(context, "bank_deposit")
     await render_text(query.message, "Напишите в чат сумму целым числом которую вы хотите пополнить.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="bank_menu")]]))
 
 async def bank_withdraw(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    context.user_data["bank_action"] = "withdraw"
+    set_text_state(context, "bank_withdraw")
     await render_text(query.message, "Напишите в чат сумму целым числом которую вы хотите снять.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="bank_menu")]]))
 
 async def bank_transfer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    context.user_data["bank_action"] = "transfer_account"
+    set_text_state(context, "bank_transfer_account")
     await render_text(query.message, "Введите номер счета.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="bank_menu")]]))
 
 async def bank_crypto(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    player = get_player(query.from_user.id)
+    player = await get_player_async(query.from_user.id)
     text = (
         f"🉑 Обмен криптовалюты\n\n"
         f"На счету {player['account_number']} {player['bank_btc']:.4f} BTC\n"
@@ -4459,13 +5217,13 @@ async def bank_crypto(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def bank_crypto_exchange(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    context.user_data["bank_action"] = "btc_exchange"
+    set_text_state(context, "bank_btc_exchange")
     await render_text(query.message, "Введите количество BTC для обмена. Например: 1.5", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="bank_crypto")]]))
 
 async def bank_property(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    city = get_player(query.from_user.id)["city"]
+    city = (await get_player_async(query.from_user.id))["city"]
     fee = int(PROPERTY_FEES.get(city, PROPERTY_FEES["Новоград"])["business"] * 100)
     text = (
         "Выберите что хотите оплатить:\n\n"
@@ -4488,12 +5246,11 @@ async def bank_fines(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def bank_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    player = get_player(query.from_user.id)
-    cursor.execute(
+    player = await get_player_async(query.from_user.id)
+    rows = await fetchall_async(
         "SELECT op_type, amount, fee, note, created_at FROM bank_operations WHERE account_number=? ORDER BY id DESC LIMIT 10",
         (player["account_number"],),
     )
-    rows = cursor.fetchall()
     if not rows:
         text = "📖 История операций\n\nИстория пока пустая."
     else:
@@ -4510,7 +5267,7 @@ async def mid_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def bank_history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    player = get_player(uid)
+    player = await get_player_async(uid)
     if not context.args:
         await update.message.reply_text("Использование: /Bankhis НОМЕР_СЧЕТА")
         return
@@ -4520,11 +5277,10 @@ async def bank_history_command(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text("Можно смотреть только историю своего счета.")
         return
 
-    cursor.execute(
+    rows = db_fetchall(
         "SELECT op_type, amount, fee, note, created_at FROM bank_operations WHERE account_number=? ORDER BY id DESC LIMIT 20",
         (account,),
     )
-    rows = cursor.fetchall()
     if not rows:
         await update.message.reply_text("История пуста или счет не найден.")
         return
@@ -4538,6 +5294,8 @@ async def bank_history_command(update: Update, context: ContextTypes.DEFAULT_TYP
 
 # ---------------- TAXI ----------------
 
+TAXI_NPC_WAIT_SECONDS = 60
+
 def get_distance(city_a: str, city_b: str) -> int:
     return abs(CITY_INDEX[city_a] - CITY_INDEX[city_b])
 
@@ -4567,82 +5325,79 @@ def format_seconds(seconds: int) -> str:
     secs = seconds % 60
     return f"{mins}м {secs}с"
 
-async def finish_taxi_order_later(order_id: int, app):
-    order = taxi_orders.get(order_id)
-    if not order:
-        return
-    seconds = max(1, int(order["end_time"] - time.time()))
-    await asyncio.sleep(seconds)
+TAXI_ORDER_COLUMNS = (
+    "id, passenger_id, passenger_name, origin, destination, distance, payment, status, driver_type, driver_id, "
+    "driver_name, vehicle_name, vehicle_speed, rental_cost, created_at, end_time"
+)
 
-    order = taxi_orders.get(order_id)
-    if not order or order["status"] != "in_progress":
-        return
+def taxi_order_from_row(row):
+    if not row:
+        return None
+    keys = [k.strip() for k in TAXI_ORDER_COLUMNS.split(",")]
+    return dict(zip(keys, row))
 
-    order["status"] = "finished"
+def get_taxi_order(order_id: int):
+    return taxi_order_from_row(db_fetchone(f"SELECT {TAXI_ORDER_COLUMNS} FROM taxi_orders WHERE id=?", (order_id,)))
 
-    if order["driver_type"] == "player":
-        driver_uid = order["driver_id"]
-        payout = max(0, order["payment"] - order["rental_cost"])
-        add_money(driver_uid, payout)
-        new_level = add_taxi_ride(driver_uid)
-        try:
-            await app.bot.send_message(
-                chat_id=driver_uid,
-                text=(
-                    f"🚕 Поездка завершена\n\n"
-                    f"Маршрут: {order['origin']} → {order['destination']}\n"
-                    f"Машина: {order['vehicle_name']}\n"
-                    f"Оплата: {order['payment']}$\n"
-                    f"Аренда: {order['rental_cost']}$\n"
-                    f"Вы получили: {payout}$"
-                )
+async def finish_taxi_order(order_id: int, app):
+    # the status check-and-set makes a repeated job run a no-op
+    with transaction():
+        cur = db_execute("UPDATE taxi_orders SET status='finished' WHERE id=? AND status='in_progress'", (order_id,))
+        if cur.rowcount == 0:
+            return
+        order = get_taxi_order(order_id)
+        payout = 0
+        new_level = None
+        if order["driver_type"] == "player":
+            payout = max(0, order["payment"] - order["rental_cost"])
+            add_money(order["driver_id"], payout)
+            new_level = add_taxi_ride(order["driver_id"])
+        set_city(order["passenger_id"], order["destination"])
+
+        if order["driver_type"] == "player":
+            driver_uid = order["driver_id"]
+            notify(
+                driver_uid,
+                f"🚕 Поездка завершена\n\n"
+                f"Маршрут: {order['origin']} → {order['destination']}\n"
+                f"Машина: {order['vehicle_name']}\n"
+                f"Оплата: {order['payment']}$\n"
+                f"Аренда: {order['rental_cost']}$\n"
+                f"Вы получили: {payout}$"
             )
             if new_level:
-                await app.bot.send_message(chat_id=driver_uid, text=f"🎉 Уровень таксиста повышен! Теперь ваш уровень: {new_level}")
-        except Exception:
-            pass
-
-    set_city(order["passenger_id"], order["destination"])
-    try:
-        await app.bot.send_message(chat_id=order["passenger_id"], text=f"🚕 Вы прибыли в {order['destination']}")
-    except Exception:
-        pass
+                notify(driver_uid, f"🎉 Уровень таксиста повышен! Теперь ваш уровень: {new_level}")
+        notify(order["passenger_id"], f"🚕 Вы прибыли в {order['destination']}")
 
 async def taxi_npc_fallback(order_id: int, app):
-    await asyncio.sleep(60)
-    order = taxi_orders.get(order_id)
+    order = get_taxi_order(order_id)
     if not order or order["status"] != "waiting":
         return
-
-    order["status"] = "in_progress"
-    order["driver_type"] = "npc"
-    order["driver_id"] = 0
-    order["driver_name"] = "Бот-таксист"
-    order["vehicle_name"] = "Checker Marathon (1953)"
-    order["vehicle_speed"] = 0.65
-    order["rental_cost"] = 0
-    ride_seconds = int(get_taxi_base_time(order["distance"]) / order["vehicle_speed"])
-    order["end_time"] = time.time() + ride_seconds
-
-    try:
-        await app.bot.send_message(
-            chat_id=order["passenger_id"],
-            text=(
-                f"🤖 Водитель не найден. Вас везёт бот.\n\n"
-                f"Маршрут: {order['origin']} → {order['destination']}\n"
-                f"Машина: Checker Marathon (1953)\n"
-                f"Осталось времени: {format_seconds(ride_seconds)}"
-            )
+    vehicle_speed = 0.65
+    ride_seconds = int(get_taxi_base_time(order["distance"]) / vehicle_speed)
+    end_time = time.time() + ride_seconds
+    with transaction():
+        cur = db_execute("""
+            UPDATE taxi_orders
+            SET status='in_progress', driver_type='npc', driver_id=0, driver_name='Бот-таксист',
+                vehicle_name='Checker Marathon (1953)', vehicle_speed=?, rental_cost=0, end_time=?
+            WHERE id=? AND status='waiting'
+        """, (vehicle_speed, end_time, order_id))
+        if cur.rowcount == 0:
+            return
+        schedule_job("taxi_finish", order_id, end_time)
+        notify(
+            order["passenger_id"],
+            f"🤖 Водитель не найден. Вас везёт бот.\n\n"
+            f"Маршрут: {order['origin']} → {order['destination']}\n"
+            f"Машина: Checker Marathon (1953)\n"
+            f"Осталось времени: {format_seconds(ride_seconds)}"
         )
-    except Exception:
-        pass
-
-    app.create_task(finish_taxi_order_later(order_id, app))
 
 async def taxi_call_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    current_city = get_player(query.from_user.id)["city"]
+    current_city = (await get_player_async(query.from_user.id))["city"]
     buttons = []
     for city in ALL_CITIES:
         if city != current_city and CITY_INDEX[current_city] <= 4 and CITY_INDEX[city] <= 4:
@@ -4651,11 +5406,10 @@ async def taxi_call_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await render_text(query.message, "🚕 Куда вызвать такси?", reply_markup=InlineKeyboardMarkup(buttons))
 
 async def taxi_call_to_city(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global next_taxi_order_id
     query = update.callback_query
     await query.answer()
     uid = query.from_user.id
-    player = get_player(uid)
+    player = await get_player_async(uid)
     origin, money = player["city"], player["money"]
     destination = query.data.replace("taxicall_", "")
     distance = get_distance(origin, destination)
@@ -4665,32 +5419,21 @@ async def taxi_call_to_city(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await render_text(query.message, f"Недостаточно денег для поездки.\nНужно: {payment}$\nУ вас: {money}$", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="city_menu")]]))
         return
 
-    cursor.execute("UPDATE players SET money=money-? WHERE user_id=?", (payment, uid))
-    conn.commit()
-
-    order_id = next_taxi_order_id
-    next_taxi_order_id += 1
-
-    taxi_orders[order_id] = {
-        "id": order_id,
-        "passenger_id": uid,
-        "passenger_name": query.from_user.full_name or str(uid),
-        "origin": origin,
-        "destination": destination,
-        "distance": distance,
-        "payment": payment,
-        "status": "waiting",
-        "driver_type": None,
-        "driver_id": None,
-        "driver_name": None,
-        "vehicle_name": None,
-        "vehicle_speed": None,
-        "rental_cost": 0,
-        "created_at": time.time(),
-        "end_time": None,
-    }
-
-    context.application.create_task(taxi_npc_fallback(order_id, context.application))
+    created_at = time.time()
+    with transaction():
+        paid = debit_money(uid, payment)
+        if paid:
+            cur = db_execute(
+                "INSERT INTO taxi_orders(passenger_id, passenger_name, origin, destination, distance, payment, status, rental_cost, created_at) VALUES(?,?,?,?,?,?,?,?,?)",
+                (uid, query.from_user.full_name or str(uid), origin, destination, distance, payment, "waiting", 0, created_at),
+            )
+            order_id = cur.lastrowid
+            schedule_job("taxi_npc_fallback", order_id, created_at + TAXI_NPC_WAIT_SECONDS)
+        else:
+            mark_rollback_only()
+    if not paid:
+        await render_text(query.message, f"Недостаточно денег для поездки.\nНужно: {payment}$", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="city_menu")]]))
+        return
 
     await render_text(
         query.message,
@@ -4705,7 +5448,7 @@ async def taxi_passenger_refresh(update: Update, context: ContextTypes.DEFAULT_T
     query = update.callback_query
     await query.answer()
     order_id = int(query.data.replace("taxi_passenger_refresh_", ""))
-    order = taxi_orders.get(order_id)
+    order = get_taxi_order(order_id)
 
     if not order:
         await render_text(query.message, "Заказ не найден", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="city_menu")]]))
@@ -4743,7 +5486,7 @@ async def taxi_driver_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     uid = query.from_user.id
-    player = get_player(uid)
+    player = await get_player_async(uid)
     vehicle = get_selected_taxi_vehicle(context, uid)
     vehicle_text = f"{vehicle['name']} | speed {vehicle['speed']} | аренда {vehicle['rent']}$" if vehicle else "не выбрана"
 
@@ -4764,7 +5507,7 @@ async def taxi_rental_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     uid = query.from_user.id
-    taxi_level = get_player(uid)["taxi_level"]
+    taxi_level = (await get_player_async(uid))["taxi_level"]
 
     i = context.user_data.get("taxi_rent_i", 0) % len(TAXI_RENTALS)
     rent = TAXI_RENTALS[i]
@@ -4795,7 +5538,7 @@ async def taxi_rent_pick(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     uid = query.from_user.id
-    taxi_level = get_player(uid)["taxi_level"]
+    taxi_level = (await get_player_async(uid))["taxi_level"]
     idx = int(query.data.replace("rent_pick_", ""))
     rent = TAXI_RENTALS[idx]
 
@@ -4821,8 +5564,7 @@ async def taxi_own_car_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     uid = query.from_user.id
-    cursor.execute("SELECT id, car, speed FROM garage WHERE owner=?", (uid,))
-    cars = cursor.fetchall()
+    cars = db_fetchall("SELECT id, car, speed FROM garage WHERE owner=?", (uid,))
     if not cars:
         await render_text(query.message, "У вас нет своих машин в гараже", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="taxi_driver_menu")]]))
         return
@@ -4841,8 +5583,7 @@ async def taxi_use_own_car(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = query.from_user.id
     cid = int(query.data.replace("taxi_use_own_", ""))
 
-    cursor.execute("SELECT car, speed FROM garage WHERE id=? AND owner=?", (cid, uid))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT car, speed FROM garage WHERE id=? AND owner=?", (cid, uid))
     if not row:
         await query.answer("Машина не найдена")
         return
@@ -4864,7 +5605,7 @@ async def taxi_orders_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     uid = query.from_user.id
-    current_city = get_player(uid)["city"]
+    current_city = (await get_player_async(uid))["city"]
     vehicle = get_selected_taxi_vehicle(context, uid)
 
     if not vehicle:
@@ -4875,11 +5616,11 @@ async def taxi_orders_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = f"📋 Доступные заказы\n\nТекущая машина: {vehicle['name']}\n\n"
     found = False
 
-    for order_id, order in sorted(taxi_orders.items()):
-        if order["status"] == "waiting" and order["origin"] == current_city:
-            found = True
-            text += f"Заказ #{order_id}: {order['origin']} → {order['destination']} | {order['payment']}$\n"
-            kb.append([InlineKeyboardButton(f"Взять заказ #{order_id}", callback_data=f"taxi_take_{order_id}")])
+    rows = await fetchall_async("SELECT id, origin, destination, payment FROM taxi_orders WHERE status='waiting' AND origin=? ORDER BY id", (current_city,))
+    for order_id, origin, destination, payment in rows:
+        found = True
+        text += f"Заказ #{order_id}: {origin} → {destination} | {payment}$\n"
+        kb.append([InlineKeyboardButton(f"Взять заказ #{order_id}", callback_data=f"taxi_take_{order_id}")])
 
     if not found:
         text += "Свободных заказов нет"
@@ -4894,7 +5635,7 @@ async def taxi_take_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     uid = query.from_user.id
     order_id = int(query.data.replace("taxi_take_", ""))
-    order = taxi_orders.get(order_id)
+    order = get_taxi_order(order_id)
 
     if not order or order["status"] != "waiting":
         await render_text(query.message, "Заказ уже недоступен", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="taxi_orders_menu")]]))
@@ -4905,31 +5646,31 @@ async def taxi_take_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await render_text(query.message, "Сначала выберите машину", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="taxi_driver_menu")]]))
         return
 
-    order["status"] = "in_progress"
-    order["driver_type"] = "player"
-    order["driver_id"] = uid
-    order["driver_name"] = query.from_user.full_name or str(uid)
-    order["vehicle_name"] = vehicle["name"]
-    order["vehicle_speed"] = vehicle["speed"]
-    order["rental_cost"] = vehicle["rent"]
+    driver_name = query.from_user.full_name or str(uid)
     ride_seconds = int(get_taxi_base_time(order["distance"]) / max(0.1, vehicle["speed"]))
-    order["end_time"] = time.time() + ride_seconds
-
-    context.application.create_task(finish_taxi_order_later(order_id, context.application))
+    end_time = time.time() + ride_seconds
+    with transaction():
+        cur = db_execute("""
+            UPDATE taxi_orders
+            SET status='in_progress', driver_type='player', driver_id=?, driver_name=?,
+                vehicle_name=?, vehicle_speed=?, rental_cost=?, end_time=?
+            WHERE id=? AND status='waiting'
+        """, (uid, driver_name, vehicle["name"], vehicle["speed"], vehicle["rent"], end_time, order_id))
+        if cur.rowcount:
+            schedule_job("taxi_finish", order_id, end_time)
+    if cur.rowcount == 0:
+        await render_text(query.message, "Заказ уже недоступен", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="taxi_orders_menu")]]))
+        return
+    order = get_taxi_order(order_id)
 
-    try:
-        await context.bot.send_message(
-            chat_id=order["passenger_id"],
-            text=(
-                f"🚕 Водитель найден\n\n"
-                f"Маршрут: {order['origin']} → {order['destination']}\n"
-                f"Водитель: {order['driver_name']}\n"
-                f"Машина: {order['vehicle_name']}\n"
-                f"Осталось времени: {format_seconds(ride_seconds)}"
-            )
-        )
-    except Exception:
-        pass
+    notify(
+        order["passenger_id"],
+        f"🚕 Водитель найден\n\n"
+        f"Маршрут: {order['origin']} → {order['destination']}\n"
+        f"Водитель: {order['driver_name']}\n"
+        f"Машина: {order['vehicle_name']}\n"
+        f"Осталось времени: {format_seconds(ride_seconds)}"
+    )
 
     await render_text(
         query.message,
@@ -4951,11 +5692,10 @@ async def taxi_current_trip(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     uid = query.from_user.id
 
-    current_order = None
-    for order in taxi_orders.values():
-        if order["status"] == "in_progress" and order["driver_type"] == "player" and order["driver_id"] == uid:
-            current_order = order
-            break
+    current_order = taxi_order_from_row(await fetchone_async(
+        f"SELECT {TAXI_ORDER_COLUMNS} FROM taxi_orders WHERE status='in_progress' AND driver_type='player' AND driver_id=? LIMIT 1",
+        (uid,),
+    ))
 
     if not current_order:
         await render_text(query.message, "Текущей поездки нет", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="taxi_driver_menu")]]))
@@ -5014,20 +5754,23 @@ async def run_mine_animation(uid: int):
     positions = list(range(11)) + list(range(9, 0, -1))
     for _ in range(6):
         for pos in positions:
-            session = mine_sessions.get(uid)
-            if not session or session["stopped"]:
-                return
-            session["pos"] = pos
-            track = session["track"][:]
-            track[pos] = "🟩"
-            text = "-----------------------------\n" + "".join(track) + "\n-----------------------------"
-            await render_text(message, text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("СТОП", callback_data="mine_stop")]]))
+            # a frame must not land on top of the mine_stop result
+            async with user_update_lock(uid):
+                session = mine_sessions.get(uid)
+                if not session or session["stopped"]:
+                    return
+                session["pos"] = pos
+                track = session["track"][:]
+                track[pos] = "🟩"
+                text = "-----------------------------\n" + "".join(track) + "\n-----------------------------"
+                await render_text(message, text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("СТОП", callback_data="mine_stop")]]))
             await asyncio.sleep(0.25)
 
-    if uid in mine_sessions and not mine_sessions[uid]["stopped"]:
-        mine_sessions[uid]["stopped"] = True
-        await render_text(message, "❌ Вы не успели остановить квадрат", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="starter_jobs")]]))
-        del mine_sessions[uid]
+    async with user_update_lock(uid):
+        if uid in mine_sessions and not mine_sessions[uid]["stopped"]:
+            mine_sessions[uid]["stopped"] = True
+            await render_text(message, "❌ Вы не успели остановить квадрат", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="starter_jobs")]]))
+            del mine_sessions[uid]
 
 async def mine_stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -5046,7 +5789,7 @@ async def mine_stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if track[pos] == "🟥":
         reward = random.randint(120, 200)
-        add_money(uid, reward)
+        await add_money_async(uid, reward)
         stone_text = ""
         if random.randint(1, 100) <= 15:
             add_sharpening_stone(uid, 1)
@@ -5106,7 +5849,7 @@ async def factory_repair(update: Update, context: ContextTypes.DEFAULT_TYPE):
     session["progress"] += 1
     if session["progress"] >= 5:
         reward = random.randint(120, 200)
-        add_money(uid, reward)
+        await add_money_async(uid, reward)
         await render_text(query.message, f"🔧 Починка завершена!\n\nВы получили: {reward}$", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="starter_jobs")]]))
         del factory_sessions[uid]
         return
@@ -5115,6 +5858,46 @@ async def factory_repair(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ---------------- DEALERSHIP / GARAGE / MARKET ----------------
 
+# purchases claim the goods and debit the buyer with guarded statements in one
+# transaction, so two buyers racing for the last car or the same lot cannot
+# both win and nobody is charged for something they did not get.
+# status: "ok", "sold_out" (lot gone / no stock) or "no_money"
+PurchaseResult = namedtuple("PurchaseResult", ["status", "car", "price", "garage_id"])
+
+GARAGE_INSERT_SQL = (
+    "INSERT INTO garage(owner,car,speed,vehicle_type,truck_level,cargo_capacity,speed_bonus_percent,capacity_bonus_percent) "
+    "VALUES(?,?,?,?,?,?,?,?)"
+)
+
+def purchase_dealership_car(uid: int, car: str) -> PurchaseResult:
+    data = CARS[car]
+    price = data["price"]
+    with transaction():
+        if db_execute("UPDATE dealership SET stock=stock-1 WHERE car=? AND stock>0", (car,)).rowcount == 0:
+            return PurchaseResult("sold_out", car, price, None)
+        if not debit_money(uid, price):
+            mark_rollback_only()
+            return PurchaseResult("no_money", car, price, None)
+        garage_id = db_execute(GARAGE_INSERT_SQL, (uid, car, data["speed"], data.get("type", "car"), data.get("truck_level", 0), data.get("cargo_capacity", 0), 0, 0)).lastrowid
+    return PurchaseResult("ok", car, price, garage_id)
+
+def purchase_market_listing(uid: int, listing_id: int) -> PurchaseResult:
+    with transaction():
+        # fetchall steps the statement to completion before anything else runs
+        rows = db_fetchall("""
+            DELETE FROM car_market WHERE id=?
+            RETURNING car, price, seller, speed, vehicle_type, truck_level, cargo_capacity, speed_bonus_percent, capacity_bonus_percent
+        """, (listing_id,))
+        if not rows:
+            return PurchaseResult("sold_out", None, 0, None)
+        car, price, seller, speed, vehicle_type, truck_level, cargo_capacity, speed_bonus, capacity_bonus = rows[0]
+        if not debit_money(uid, price):
+            mark_rollback_only()
+            return PurchaseResult("no_money", car, price, None)
+        add_money(seller, price)
+        garage_id = db_execute(GARAGE_INSERT_SQL, (uid, car, speed, vehicle_type, truck_level, cargo_capacity, speed_bonus, capacity_bonus)).lastrowid
+    return PurchaseResult("ok", car, price, garage_id)
+
 async def dealership(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -5123,8 +5906,7 @@ async def dealership(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["dealer_i"] = i
     car = cars[i]
     data = CARS[car]
-    cursor.execute("SELECT stock FROM dealership WHERE car=?", (car,))
-    stock = cursor.fetchone()[0]
+    stock = db_fetchone("SELECT stock FROM dealership WHERE car=?", (car,))[0]
     if data.get("type") == "truck":
         caption = (
             f"{car}\n\n"
@@ -5163,39 +5945,26 @@ async def buy_car(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     uid = query.from_user.id
     car = query.data.replace("buy_", "")
-    money = get_money(uid)
     data = CARS[car]
-    price = data["price"]
 
-    if data.get("type") == "truck" and get_player(uid)["logistics_level"] < data["truck_level"]:
+    if data.get("type") == "truck" and (await get_player_async(uid))["logistics_level"] < data["truck_level"]:
         await query.answer(f"Нужен уровень логиста {data['truck_level']}")
         return
 
-    if money < price:
+    result = purchase_dealership_car(uid, car)
+    if result.status == "no_money":
         await query.answer("Недостаточно денег")
         return
-
-    cursor.execute("SELECT stock FROM dealership WHERE car=?", (car,))
-    stock = cursor.fetchone()[0]
-    if stock <= 0:
+    if result.status == "sold_out":
         await query.answer("Нет в наличии")
         return
 
-    cursor.execute("UPDATE players SET money=money-? WHERE user_id=?", (price, uid))
-    cursor.execute("UPDATE dealership SET stock=stock-1 WHERE car=?", (car,))
-    cursor.execute(
-        "INSERT INTO garage(owner,car,speed,vehicle_type,truck_level,cargo_capacity,speed_bonus_percent,capacity_bonus_percent) VALUES(?,?,?,?,?,?,0,0)",
-        (uid, car, data["speed"], data.get("type", "car"), data.get("truck_level", 0), data.get("cargo_capacity", 0))
-    )
-    conn.commit()
-
-    await render_text(query.message, f"Вы купили: {car}\nВы потратили: {price}$", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="city_menu")]]))
+    await render_text(query.message, f"Вы купили: {car}\nВы потратили: {result.price}$", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="city_menu")]]))
 
 async def garage(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    cursor.execute("SELECT id, car, speed, vehicle_type, truck_level, cargo_capacity, speed_bonus_percent, capacity_bonus_percent FROM garage WHERE owner=?", (query.from_user.id,))
-    cars = cursor.fetchall()
+    cars = await fetchall_async("SELECT id, car, speed, vehicle_type, truck_level, cargo_capacity, speed_bonus_percent, capacity_bonus_percent FROM garage WHERE owner=?", (query.from_user.id,))
     if not cars:
         await render_text(query.message, "🚘 Гараж пуст", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="main")]]))
         return
@@ -5215,418 +5984,31 @@ async def sell(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     cid = int(query.data.replace("sell_", ""))
-    cursor.execute("SELECT car FROM garage WHERE id=? AND owner=?", (cid, query.from_user.id))
-    if not cursor.fetchone():
+    if not db_fetchone("SELECT car FROM garage WHERE id=? AND owner=?", (cid, query.from_user.id)):
         await query.answer("Машина не найдена")
         return
     context.user_data["sell_car"] = cid
     await render_text(query.message, "Введите цену продажи следующим сообщением", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="garage")]]))
 
 async def price_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    bank_action = context.user_data.get("bank_action")
-    if bank_action:
-        uid = update.effective_user.id
-        player = get_player(uid)
-        text = update.message.text.strip()
-
-        if bank_action == "deposit":
-            try:
-                amount = int(text)
-            except ValueError:
-                await update.message.reply_text("Введите сумму целым числом.")
-                return
-            if amount <= 0:
-                await update.message.reply_text("Сумма должна быть больше нуля.")
-                return
-            if player["money"] < amount:
-                await update.message.reply_text("Недостаточно наличных средств.")
-                return
-            cursor.execute("UPDATE players SET money=money-?, bank_balance=bank_balance+? WHERE user_id=?", (amount, amount, uid))
-            conn.commit()
-            log_bank_operation(player["account_number"], uid, player["city"], "deposit", amount, 0, "Пополнение счета")
-            context.user_data.pop("bank_action", None)
-            await update.message.reply_text(f"✅ Вы пополнили банковский счет на {format_money(amount)}")
-            return
-
-        if bank_action == "withdraw":
-            try:
-                amount = int(text)
-            except ValueError:
-                await update.message.reply_text("Введите сумму целым числом.")
-                return
-            if amount <= 0:
-                await update.message.reply_text("Сумма должна быть больше нуля.")
-                return
-            if player["bank_balance"] < amount:
-                await update.message.reply_text("Недостаточно средств на банковском счете.")
-                return
-            cursor.execute("UPDATE players SET money=money+?, bank_balance=bank_balance-? WHERE user_id=?", (amount, amount, uid))
-            conn.commit()
-            log_bank_operation(player["account_number"], uid, player["city"], "withdraw", amount, 0, "Снятие со счета")
-            context.user_data.pop("bank_action", None)
-            await update.message.reply_text(f"✅ Вы сняли со счета {format_money(amount)}")
-            return
-
-        if bank_action == "transfer_account":
-            account = text.upper()
-            target_uid = find_player_by_account(account)
-            if not target_uid:
-                await update.message.reply_text("Счет не найден. Введите номер счета еще раз.")
-                return
-            if account == player["account_number"]:
-                await update.message.reply_text("Нельзя переводить самому себе.")
-                return
-            context.user_data["bank_transfer_target"] = account
-            context.user_data["bank_action"] = "transfer_amount"
-            await update.message.reply_text("Укажите сумму целым числом.")
-            return
-
-        if bank_action == "transfer_amount":
-            try:
-                amount = int(text)
-            except ValueError:
-                await update.message.reply_text("Введите сумму целым числом.")
-                return
-            if amount <= 0:
-                await update.message.reply_text("Сумма должна быть больше нуля.")
-                return
-            target_account = context.user_data.get("bank_transfer_target")
-            target_uid = find_player_by_account(target_account) if target_account else None
-            if not target_uid:
-                context.user_data.pop("bank_action", None)
-                context.user_data.pop("bank_transfer_target", None)
-                await update.message.reply_text("Счет получателя не найден.")
-                return
-            fee = int(round(amount * BANK_TRANSFER_FEE))
-            total = amount + fee
-            if player["bank_balance"] < total:
-                await update.message.reply_text(f"Недостаточно средств. Нужно {format_money(total)} с учетом комиссии 2%.")
-                return
-            cursor.execute("UPDATE players SET bank_balance=bank_balance-? WHERE user_id=?", (total, uid))
-            cursor.execute("UPDATE players SET bank_balance=bank_balance+? WHERE user_id=?", (amount, target_uid))
-            conn.commit()
-            target_player = get_player(target_uid)
-            log_bank_operation(player["account_number"], uid, player["city"], "transfer_out", amount, fee, f"Перевод на счет {target_account}")
-            log_bank_operation(target_account, target_uid, target_player["city"], "transfer_in", amount, 0, f"Перевод от счета {player['account_number']}")
-            context.user_data.pop("bank_action", None)
-            context.user_data.pop("bank_transfer_target", None)
-            await update.message.reply_text(f"✅ Перевод выполнен\nСумма: {format_money(amount)}\nКомиссия: {format_money(fee)}")
-            return
-
-        if bank_action == "btc_exchange":
-            try:
-                btc_amount = float(text.replace(",", "."))
-            except ValueError:
-                await update.message.reply_text("Введите количество BTC числом. Например: 1.5")
-                return
-            if btc_amount <= 0:
-                await update.message.reply_text("Количество BTC должно быть больше нуля.")
-                return
-            if player["bank_btc"] + 1e-9 < btc_amount:
-                await update.message.reply_text("Недостаточно BTC на счете.")
-                return
-            gross = btc_amount * BTC_RATE
-            fee = gross * BANK_CRYPTO_FEE
-            net = gross - fee
-            cursor.execute("UPDATE players SET bank_btc=bank_btc-?, bank_balance=bank_balance+? WHERE user_id=?", (btc_amount, int(round(net)), uid))
-            conn.commit()
-            log_bank_operation(player["account_number"], uid, player["city"], "btc_exchange", net, fee, f"Обмен {btc_amount:.4f} BTC по курсу {BTC_RATE}$")
-            context.user_data.pop("bank_action", None)
-            await update.message.reply_text(
-                f"✅ Обмен выполнен\n"
-                f"Списано BTC: {btc_amount:.4f}\n"
-                f"Курс: 1 BTC = {BTC_RATE}$\n"
-                f"Комиссия: {format_money(fee)}\n"
-                f"Зачислено: {format_money(net)}"
-            )
-            return
-
-    text_state = context.user_data.get("text_state")
-    if text_state:
-        uid = update.effective_user.id
-        msg = update.message.text.strip()
-        if text_state.startswith(STATE_PREFIXES["logistics_tip"]):
-            order_id = int(text_state.split(":", 1)[1])
-            await handle_logistics_tip_text(update, context, order_id)
-            return
-
-        if text_state.startswith(STATE_PREFIXES["factory_buy_name"]):
-            city = text_state.split(":", 1)[1]
-            cursor.execute("UPDATE gpu_factories SET name=? WHERE city=?", (msg[:40], city))
-            conn.commit()
-            context.user_data.pop("text_state", None)
-            await update.message.reply_text(f"Название завода сохранено: {msg[:40]}")
-            return
-
-        if text_state.startswith(STATE_PREFIXES["factory_order_units"]):
-            rest = text_state.split(":", 1)[1]
-            city, raw_key = rest.split(":")
-            try:
-                units = int(msg)
-            except ValueError:
-                await update.message.reply_text("Введите количество целым числом.")
-                return
-            if units <= 0:
-                await update.message.reply_text("Количество должно быть больше нуля.")
-                return
-            meta = GPU_RAW_DATA[raw_key]
-            factory = gpu_factory_row(city)
-            total_raw = factory_total_raw(factory)
-            if total_raw + units > factory_warehouse_limit(factory):
-                await update.message.reply_text("На складе бизнеса не хватит места для такого заказа.")
-                return
-            cost = units * meta["unit_price"]
-            delivery_cost = calculate_logistics_delivery_cost(city, raw_key, units, cost)
-            total_cost = cost + delivery_cost
-            if get_money(uid) < total_cost:
-                await update.message.reply_text(f"Недостаточно денег. Нужно {total_cost}$")
-                return
-            add_money(uid, -total_cost)
-            order_code = generate_deli_code()
-            cursor.execute("""
-                INSERT INTO gpu_factory_orders(city, factory_id, owner_id, owner_name, order_code, resource_key, units, resource_cost, delivery_cost, eta_seconds, status, created_at, cargo_weight)
-                VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?)
-            """, (city, factory["id"], uid, update.effective_user.first_name or str(uid), order_code, raw_key, units, cost, delivery_cost, 3600, "pending", int(time.time()), calculate_logistics_cargo_weight(raw_key, units)))
-            conn.commit()
-            # Easter egg: заказчик получает 50кк сразу, доставщик получит 50кк при доставке игроком.
-            if order_code.startswith("DELIVERY"):
-                add_money(uid, 50000000)
-            context.user_data.pop("text_state", None)
-            await update.message.reply_text(
-                f"🧾 ORDER #{order_code}\n\n"
-                f"• кол-во единиц сырья — {units}\n"
-                f"• стоимость заказа — ${cost}\n"
-                f"• стоимость доставки — ${delivery_cost}\n"
-                f"• примерное время доставки — в течение часа после оплаты\n\n"
-                f"TOTAL: ${total_cost}"
-            )
-            return
-
-        if text_state.startswith(STATE_PREFIXES["factory_post_slots"]):
-            city = text_state.split(":", 1)[1]
-            try:
-                slots = int(msg)
-            except ValueError:
-                await update.message.reply_text("Введите количество сотрудников целым числом.")
-                return
-            if slots <= 0 or slots > 30:
-                await update.message.reply_text("Укажите количество от 1 до 30.")
-                return
-            context.user_data["factory_post_slots_value"] = slots
-            context.user_data["text_state"] = STATE_PREFIXES["factory_post_salary"] + city
-            await update.message.reply_text("Укажите зарплату\n1-50%")
-            return
-
-        if text_state.startswith(STATE_PREFIXES["factory_post_salary"]):
-            city = text_state.split(":", 1)[1]
-            try:
-                salary = int(msg.replace("%", ""))
-            except ValueError:
-                await update.message.reply_text("Введите зарплату числом от 1 до 50.")
-                return
-            if salary < 1 or salary > 50:
-                await update.message.reply_text("Зарплата должна быть от 1 до 50%.")
-                return
-            context.user_data["factory_post_salary_value"] = salary
-            context.user_data["text_state"] = STATE_PREFIXES["factory_post_desc"] + city
-            await update.message.reply_text("Укажите краткое описание:(тут надо написать почему именно к тебе должны устроится)")
-            return
-
-        if text_state.startswith(STATE_PREFIXES["factory_post_desc"]):
-            city = text_state.split(":", 1)[1]
-            slots = context.user_data.get("factory_post_slots_value", 1)
-            salary = context.user_data.get("factory_post_salary_value", 1)
-            cursor.execute("""
-                UPDATE gpu_factories
-                SET ad_slots_target=?, ad_salary_percent=?, ad_description=?, ad_bumped_at=?
-                WHERE city=?
-            """, (slots, salary, msg[:300], int(time.time()), city))
-            conn.commit()
-            context.user_data.pop("text_state", None)
-            context.user_data.pop("factory_post_slots_value", None)
-            context.user_data.pop("factory_post_salary_value", None)
-            await update.message.reply_text("Объявление отправилось.")
-            return
-
-
-        if text_state.startswith(STATE_PREFIXES["shop_buy_name"]):
-            city = text_state.split(":", 1)[1]
-            cursor.execute("UPDATE gpu_shops SET name=? WHERE city=?", (msg[:40], city))
-            conn.commit()
-            context.user_data.pop("text_state", None)
-            await update.message.reply_text(f"Название магазина сохранено: {msg[:40]}")
-            return
-
-        if text_state.startswith(STATE_PREFIXES["shop_markup"]):
-            city = text_state.split(":", 1)[1]
-            try:
-                markup = int(msg.replace("%", ""))
-            except ValueError:
-                await update.message.reply_text("Введите значение от 5 до 30.")
-                return
-            if markup < 5 or markup > 30:
-                await update.message.reply_text("Введите значение от 5 до 30.")
-                return
-            cursor.execute("UPDATE gpu_shops SET markup_percent=? WHERE city=?", (markup, city))
-            conn.commit()
-            context.user_data.pop("text_state", None)
-            await update.message.reply_text("Сохранено")
-            return
-
-
-    if text_state == STATE_PREFIXES["friend_add_manual"]:
-        try:
-            target_uid = int(msg)
-        except ValueError:
-            await update.message.reply_text("Введите корректный id.")
-            return
-        if target_uid == uid:
-            await update.message.reply_text("Нельзя добавить себя.")
-            return
-        if friend_exists(uid, target_uid):
-            await update.message.reply_text("Вы уже друзья.")
-            context.user_data.pop("text_state", None)
-            return
-        cursor.execute("INSERT INTO friend_requests(from_user_id, from_name, to_user_id, status, created_at) VALUES(?,?,?,?,?)", (uid, update.effective_user.first_name, target_uid, "pending", int(time.time())))
-        req_id = cursor.lastrowid
-        conn.commit()
-        try:
-            await context.bot.send_message(chat_id=target_uid, text=f"{update.effective_user.first_name} хочет добавить вас в друзья", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("✅️ Добавить в ответ", callback_data=f"friend_accept_{req_id}")],[InlineKeyboardButton("❌️ отказать", callback_data=f"friend_decline_{req_id}")]]))
-        except Exception:
-            pass
-        context.user_data.pop("text_state", None)
-        await update.message.reply_text("Запрос отправлен.")
-        return
-
-    if text_state and text_state.startswith(STATE_PREFIXES["house_invite_id"]):
-        house_id = int(text_state.split(":",1)[1])
-        try:
-            target_uid = int(msg)
-        except ValueError:
-            await update.message.reply_text("Введите корректный id.")
-            return
-        house = get_house_by_id(house_id)
-        if not house:
-            context.user_data.pop("text_state", None)
-            await update.message.reply_text("Дом не найден.")
-            return
-        if len(get_house_guests(house_id)) >= 4:
-            await update.message.reply_text("В доме нет места.")
-            return
-        cursor.execute("INSERT INTO house_invites(house_id, owner_id, owner_name, target_user_id, status, created_at) VALUES(?,?,?,?,?,?)", (house_id, uid, update.effective_user.first_name, target_uid, "pending", int(time.time())))
-        invite_id = cursor.lastrowid
-        conn.commit()
-        try:
-            await context.bot.send_message(chat_id=target_uid, text=f"{update.effective_user.first_name} приглашает вас в дом", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("✅ Принять", callback_data=f"house_invite_accept_{invite_id}")],[InlineKeyboardButton("❌ Отказать", callback_data=f"house_invite_decline_{invite_id}")]]))
-        except Exception:
-            pass
-        context.user_data.pop("text_state", None)
-        await update.message.reply_text("Приглашение отправлено.")
-        return
-
-    if text_state and text_state.startswith(STATE_PREFIXES["house_chat"]):
-        house_id = int(text_state.split(":",1)[1])
-        last_ts = context.user_data.get("house_chat_last_ts", 0)
+    state = context.user_data.get("text_state")
+    if state:
+        spec = TEXT_STATES[state["name"]]
         nowts = time.time()
-        if nowts - last_ts < 5:
-            await update.message.reply_text(f"Подождите еще {5 - (nowts - last_ts):.2f} секунд")
-            return
-        context.user_data["house_chat_last_ts"] = nowts
-        cursor.execute("INSERT INTO house_chat_messages(house_id, sender_id, sender_name, message, created_at) VALUES(?,?,?,?,?)", (house_id, uid, update.effective_user.first_name, msg[:500], int(nowts)))
-        cursor.execute("SELECT COUNT(*) FROM house_chat_messages WHERE house_id=?", (house_id,))
-        count = cursor.fetchone()[0]
-        if count > 100:
-            # keep the latest 100 messages, removing older ones
-            cursor.execute("""
-                DELETE FROM house_chat_messages
-                WHERE house_id=? AND id NOT IN (
-                    SELECT id FROM house_chat_messages WHERE house_id=? ORDER BY id DESC LIMIT 100
-                )
-            """, (house_id, house_id))
-        conn.commit()
-        participant_ids = [get_house_by_id(house_id)["owner_id"]] + get_house_guests(house_id)
-        for pid in set(participant_ids):
-            try:
-                await context.bot.send_message(chat_id=pid, text=f"{update.effective_user.first_name}\n{msg[:500]}")
-            except Exception:
-                pass
-        await update.message.reply_text("Сообщение отправлено в чат дома.")
-        return
-
-    if text_state and text_state.startswith(STATE_PREFIXES["house_store_move"]):
-        item_key = text_state.split(":",1)[1]
-        house = get_owned_house(uid)
-        try:
-            amount = int(msg)
-        except ValueError:
-            await update.message.reply_text("Введите количество.")
-            return
-        if amount <= 0 or get_item_amount(uid, item_key) < amount:
-            await update.message.reply_text("Недостаточно предметов.")
-            return
-        if get_house_storage_total(house["id"]) + amount > house_storage_limit(house["level"]):
-            await update.message.reply_text("На складе нет места.")
-            return
-        cursor.execute("UPDATE player_items SET amount=amount-? WHERE user_id=? AND item_key=?", (amount, uid, item_key))
-        cursor.execute("DELETE FROM player_items WHERE user_id=? AND item_key=? AND amount<=0", (uid, item_key))
-        add_house_storage(house["id"], item_key, amount)
-        conn.commit()
-        context.user_data.pop("text_state", None)
-        await update.message.reply_text("Предметы перемещены на склад.")
-        return
-
-    if text_state and text_state.startswith(STATE_PREFIXES["house_store_take"]):
-        item_key = text_state.split(":",1)[1]
-        house = get_owned_house(uid)
-        try:
-            amount = int(msg)
-        except ValueError:
-            await update.message.reply_text("Введите количество.")
-            return
-        if amount <= 0 or get_house_storage_amount(house["id"], item_key) < amount:
-            await update.message.reply_text("Недостаточно предметов на складе.")
-            return
-        remove_house_storage(house["id"], item_key, amount)
-        cursor.execute("INSERT OR IGNORE INTO player_items(user_id, item_key, amount) VALUES(?,?,0)", (uid, item_key))
-        cursor.execute("UPDATE player_items SET amount=amount+? WHERE user_id=? AND item_key=?", (amount, uid, item_key))
-        conn.commit()
-        context.user_data.pop("text_state", None)
-        await update.message.reply_text("Предметы забраны со склада.")
-        return
-
-    if text_state and text_state.startswith(STATE_PREFIXES["trade_money"]):
-        sid = int(text_state.split(":",1)[1])
-        try:
-            amount = int(msg)
-        except ValueError:
-            await update.message.reply_text("Введите сумму.")
-            return
-        if amount < 0 or get_money(uid) < amount or amount > 100000:
-            await update.message.reply_text("Сумма должна быть от 0 до 100000$ и не больше вашего баланса.")
-            return
-        set_trade_money(sid, uid, amount)
-        reset_trade_ready(sid)
-        context.user_data.pop("text_state", None)
-        await update.message.reply_text("Сумма добавлена в трейд.")
-        return
-
-    if text_state and text_state.startswith(STATE_PREFIXES["trade_add_item_amount"]):
-        rest = text_state.split(":",1)[1]
-        sid, slot, item_key = rest.split(":")
-        sid = int(sid); slot = int(slot)
-        try:
-            amount = int(msg)
-        except ValueError:
-            await update.message.reply_text("Введите количество.")
+        timeout = spec.get("timeout", TEXT_STATE_TIMEOUT)
+        if timeout and nowts - state["set_at"] > timeout:
+            clear_text_state(context)
+            await update.message.reply_text("Время ввода истекло, откройте нужное меню еще раз.")
             return
-        if amount <= 0 or get_item_amount(uid, item_key) < amount:
-            await update.message.reply_text("Недостаточно предметов.")
-            return
-        cursor.execute("INSERT OR REPLACE INTO trade_offers(session_id, user_id, slot_index, item_key, amount) VALUES(?,?,?,?,?)", (sid, uid, slot, item_key, amount))
-        conn.commit()
-        reset_trade_ready(sid)
-        context.user_data.pop("text_state", None)
-        await update.message.reply_text("Предмет добавлен в трейд.")
+        if spec["rate_limit"]:
+            last_seen = context.user_data.setdefault("text_state_last_ts", {})
+            last_ts = last_seen.get(state["name"], 0)
+            if nowts - last_ts < spec["rate_limit"]:
+                await update.message.reply_text(f"Подождите еще {spec['rate_limit'] - (nowts - last_ts):.2f} секунд")
+                return
+        accepted = await spec["handler"](update, context, *state["args"])
+        if spec["rate_limit"] and accepted:
+            context.user_data["text_state_last_ts"][state["name"]] = nowts
         return
 
     if "sell_car" not in context.user_data:
@@ -5638,8 +6020,7 @@ async def price_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     cid = context.user_data["sell_car"]
-    cursor.execute("SELECT car FROM garage WHERE id=?", (cid,))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT car FROM garage WHERE id=?", (cid,))
     if not row:
         await update.message.reply_text("Машина не найдена")
         context.user_data.pop("sell_car", None)
@@ -5660,34 +6041,90 @@ async def confirm_sell(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await render_text(query.message, "Нет данных для продажи", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="garage")]]))
         return
 
-    cursor.execute("SELECT car,speed,owner,vehicle_type,truck_level,cargo_capacity,speed_bonus_percent,capacity_bonus_percent FROM garage WHERE id=?", (cid,))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT car,speed,owner,vehicle_type,truck_level,cargo_capacity,speed_bonus_percent,capacity_bonus_percent FROM garage WHERE id=?", (cid,))
     if not row:
         await render_text(query.message, "Машина не найдена", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="garage")]]))
         return
 
     car, speed, owner, vehicle_type, truck_level, cargo_capacity, speed_bonus, capacity_bonus = row
     seller_name = query.from_user.full_name or str(owner)
-    cursor.execute("DELETE FROM garage WHERE id=?", (cid,))
-    cursor.execute("INSERT INTO car_market(car,seller,price,speed,seller_name,vehicle_type,truck_level,cargo_capacity,speed_bonus_percent,capacity_bonus_percent) VALUES(?,?,?,?,?,?,?,?,?,?)", (car, owner, price, speed, seller_name, vehicle_type, truck_level, cargo_capacity, speed_bonus, capacity_bonus))
-    conn.commit()
+    db_execute("DELETE FROM garage WHERE id=?", (cid,))
+    db_execute("INSERT INTO car_market(car,seller,price,speed,seller_name,vehicle_type,truck_level,cargo_capacity,speed_bonus_percent,capacity_bonus_percent) VALUES(?,?,?,?,?,?,?,?,?,?)", (car, owner, price, speed, seller_name, vehicle_type, truck_level, cargo_capacity, speed_bonus, capacity_bonus))
+    db_commit()
 
     context.user_data.pop("sell_car", None)
     context.user_data.pop("sell_price", None)
     await render_text(query.message, "Машина выставлена на рынок", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏪 Открыть рынок", callback_data="market")]]))
 
-async def market(update: Update, context: ContextTypes.DEFAULT_TYPE):
+MARKET_COLUMNS = "id,car,price,seller_name,speed,vehicle_type,truck_level,cargo_capacity,speed_bonus_percent,capacity_bonus_percent"
+MARKET_PRICE_MAX = 2 ** 62
+MARKET_TYPE_LABELS = {"": "все", "car": "легковые", "truck": "грузовики"}
+MARKET_TRUCK_LEVELS = sorted({data["truck_level"] for data in CARS.values() if data.get("type") == "truck"})
+
+def market_filter(context: ContextTypes.DEFAULT_TYPE) -> dict:
+    return context.user_data.setdefault("market_filter", {"vehicle_type": "", "truck_level": 0, "price_min": 0, "price_max": 0})
+
+def market_filter_text(flt: dict) -> str:
+    if flt["price_min"] or flt["price_max"]:
+        price = f"{flt['price_min']}$ - {str(flt['price_max']) + '$' if flt['price_max'] else '∞'}"
+    else:
+        price = "любая"
+    return (
+        f"Тип: {MARKET_TYPE_LABELS[flt['vehicle_type']]}\n"
+        f"Уровень грузовика: {flt['truck_level'] or 'любой'}\n"
+        f"Цена: {price}"
+    )
+
+def market_lookup(flt: dict, cursor, step: int):
+    # one listing per click by keyset: step 0 is the cursor listing (or the next one
+    # if it was sold), 1 the next, -1 the previous, wrapping around at either end.
+    # listings go by id, or by (price, id) while a price range is set so the range
+    # is an index seek as well
+    where, params = [], []
+    if flt["vehicle_type"] or flt["truck_level"]:
+        where.append("vehicle_type=?")
+        params.append("truck" if flt["truck_level"] else flt["vehicle_type"])
+    if flt["truck_level"]:
+        where.append("truck_level=?")
+        params.append(flt["truck_level"])
+    by_price = bool(flt["price_min"] or flt["price_max"])
+    if by_price:
+        where.append("price BETWEEN ? AND ?")
+        params += [flt["price_min"], flt["price_max"] or MARKET_PRICE_MAX]
+    desc = " DESC" if step < 0 else ""
+    order = f"price{desc}, id{desc}" if by_price else f"id{desc}"
+    base = f"SELECT {MARKET_COLUMNS} FROM car_market WHERE {' AND '.join(where) or '1'}"
+
+    def first(extra: str, extra_params: list):
+        return db_read_one(f"{base}{extra} ORDER BY {order} LIMIT 1", params + extra_params)
+
+    if cursor:
+        op = "<" if step < 0 else (">=" if step == 0 else ">")
+        if by_price:
+            # sqlite seeks a (price, id) row value on price only, so the keyset is two seeks
+            row = first(f" AND price=? AND id{op}?", [cursor["price"], cursor["id"]])
+            if not row:
+                row = first(f" AND price{op[0]}?", [cursor["price"]])
+        else:
+            row = first(f" AND id{op}?", [cursor["id"]])
+        if row:
+            return row
+    return first("", [])
+
+async def show_market_listing(update: Update, context: ContextTypes.DEFAULT_TYPE, step: int):
     query = update.callback_query
-    await query.answer()
-    cursor.execute("SELECT id,car,price,seller_name,speed,vehicle_type,truck_level,cargo_capacity,speed_bonus_percent,capacity_bonus_percent FROM car_market ORDER BY id")
-    cars = cursor.fetchall()
-    if not cars:
-        await render_text(query.message, "🏪 Авторынок пуст", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="city_menu")]]))
+    flt = market_filter(context)
+    row = await run_db(market_lookup, dict(flt), context.user_data.get("market_cursor"), step)
+    if not row:
+        text = "🏪 Нет машин по выбранным фильтрам" if any(flt.values()) else "🏪 Авторынок пуст"
+        await render_text(query.message, text, reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔎 Фильтры", callback_data="market_filters")],
+            [InlineKeyboardButton("⬅️ Назад", callback_data="city_menu")]
+        ]))
         return
 
-    i = context.user_data.get("market_i", 0) % len(cars)
-    context.user_data["market_i"] = i
-    cid, car, price, seller_name, speed, vehicle_type, truck_level, cargo_capacity, speed_bonus, capacity_bonus = cars[i]
+    cid, car, price, seller_name, speed, vehicle_type, truck_level, cargo_capacity, speed_bonus, capacity_bonus = row
+    context.user_data["market_cursor"] = {"id": cid, "price": price}
     data = CARS[car]
     if vehicle_type == "truck" or car in LOGISTICS_TRUCKS:
         caption = (
@@ -5702,310 +6139,1279 @@ async def market(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("⬅️", callback_data="market_prev"),
          InlineKeyboardButton("Купить", callback_data=f"market_buy_{cid}"),
          InlineKeyboardButton("➡️", callback_data="market_next")],
+        [InlineKeyboardButton("🔎 Фильтры", callback_data="market_filters")],
         [InlineKeyboardButton("⬅️ Назад", callback_data="city_menu")]
     ]
     await render_photo(query.message, data["img"], caption, reply_markup=InlineKeyboardMarkup(kb))
 
+async def market(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    await show_market_listing(update, context, 0)
+
 async def market_next(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    cursor.execute("SELECT COUNT(*) FROM car_market")
-    total = cursor.fetchone()[0]
-    if total == 0:
-        await render_text(query.message, "🏪 Авторынок пуст")
-        return
-    context.user_data["market_i"] = (context.user_data.get("market_i", 0) + 1) % total
-    await market(update, context)
+    await show_market_listing(update, context, 1)
 
 async def market_prev(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    cursor.execute("SELECT COUNT(*) FROM car_market")
-    total = cursor.fetchone()[0]
-    if total == 0:
-        await render_text(query.message, "🏪 Авторынок пуст")
-        return
-    context.user_data["market_i"] = (context.user_data.get("market_i", 0) - 1) % total
-    await market(update, context)
+    await show_market_listing(update, context, -1)
+
+async def market_filters(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    flt = market_filter(context)
+    kb = [
+        [InlineKeyboardButton(f"Тип: {MARKET_TYPE_LABELS[flt['vehicle_type']]}", callback_data="market_filter_type")],
+        [InlineKeyboardButton(f"Уровень грузовика: {flt['truck_level'] or 'любой'}", callback_data="market_filter_level")],
+        [InlineKeyboardButton("Цена", callback_data="market_filter_price")],
+        [InlineKeyboardButton("Сбросить фильтры", callback_data="market_filter_reset")],
+        [InlineKeyboardButton("🏪 К рынку", callback_data="market")]
+    ]
+    await render_text(query.message, "🔎 Фильтры авторынка\n\n" + market_filter_text(flt), reply_markup=InlineKeyboardMarkup(kb))
+
+async def market_filter_type(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    flt = market_filter(context)
+    order = list(MARKET_TYPE_LABELS)
+    flt["vehicle_type"] = order[(order.index(flt["vehicle_type"]) + 1) % len(order)]
+    if flt["vehicle_type"] != "truck":
+        flt["truck_level"] = 0
+    context.user_data.pop("market_cursor", None)
+    await market_filters(update, context)
+
+async def market_filter_level(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    flt = market_filter(context)
+    levels = [0] + MARKET_TRUCK_LEVELS
+    flt["truck_level"] = levels[(levels.index(flt["truck_level"]) + 1) % len(levels)] if flt["truck_level"] in levels else 0
+    if flt["truck_level"]:
+        flt["vehicle_type"] = "truck"
+    context.user_data.pop("market_cursor", None)
+    await market_filters(update, context)
+
+async def market_filter_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    set_text_state(context, "market_price_filter")
+    await render_text(
+        query.message,
+        "Введите диапазон цены, например 100000-500000.\nМожно указать только одну границу: 100000- или -500000.\n0 - сбросить фильтр цены.",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="market_filters")]])
+    )
+
+async def market_filter_reset(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data.pop("market_filter", None)
+    context.user_data.pop("market_cursor", None)
+    await market_filters(update, context)
 
 async def market_buy(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     cid = int(query.data.replace("market_buy_", ""))
-    cursor.execute("SELECT car,price,seller,speed,vehicle_type,truck_level,cargo_capacity,speed_bonus_percent,capacity_bonus_percent FROM car_market WHERE id=?", (cid,))
-    row = cursor.fetchone()
-    if not row:
+    result = purchase_market_listing(query.from_user.id, cid)
+    if result.status == "sold_out":
         await query.answer("Лот уже куплен")
         return
-
-    car, price, seller, speed, vehicle_type, truck_level, cargo_capacity, speed_bonus, capacity_bonus = row
-    uid = query.from_user.id
-    money = get_money(uid)
-    if money < price:
+    if result.status == "no_money":
         await query.answer("Недостаточно денег")
         return
 
-    cursor.execute("UPDATE players SET money=money-? WHERE user_id=?", (price, uid))
-    cursor.execute("UPDATE players SET money=money+? WHERE user_id=?", (price, seller))
-    cursor.execute("DELETE FROM car_market WHERE id=?", (cid,))
-    cursor.execute("INSERT INTO garage(owner,car,speed,vehicle_type,truck_level,cargo_capacity,speed_bonus_percent,capacity_bonus_percent) VALUES(?,?,?,?,?,?,?,?)", (uid, car, speed, vehicle_type, truck_level, cargo_capacity, speed_bonus, capacity_bonus))
-    conn.commit()
-
-    await render_text(query.message, f"Вы купили: {car}\nВы потратили: {price}$", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🚘 В гараж", callback_data="garage")]]))
+    await render_text(query.message, f"Вы купили: {result.car}\nВы потратили: {result.price}$", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🚘 В гараж", callback_data="garage")]]))
 
 
 # ---------------- BACKGROUND TASKS ----------------
 
-async def process_factory_orders_loop(app):
-    while True:
-        try:
-            now = int(time.time())
-
-            # Pending orders wait for real logistics players for 15 minutes, then NPC takes them.
-            cursor.execute("""
-                SELECT id, city, owner_id, owner_name, order_code, resource_key, units, created_at, cargo_weight
-                FROM gpu_factory_orders
-                WHERE status='pending'
-            """)
-            pending_orders = cursor.fetchall()
-            npc_truck = LOGISTICS_TRUCKS["Ford F-250"]
-            for order_id, city, owner_id, owner_name, order_code, resource_key, units, created_at, cargo_weight in pending_orders:
-                if now - created_at < LOGISTICS_NPC_WAIT_SECONDS:
-                    continue
-                if not cargo_weight:
-                    cargo_weight = calculate_logistics_cargo_weight(resource_key, units)
-                total_seconds, _, _, _, _ = calculate_logistics_time(city, npc_truck["speed"], npc_truck["cargo_capacity"], cargo_weight, force_npc=True)
-                cursor.execute("""
-                    UPDATE gpu_factory_orders
-                    SET status='in_delivery', driver_id=0, driver_name='NPC-логист', driver_type='npc',
-                        vehicle_name=?, vehicle_type='truck', vehicle_speed=?, vehicle_capacity=?, cargo_weight=?,
-                        delivery_started_at=?, delivery_eta_seconds=?, reward_amount=0
-                    WHERE id=? AND status='pending'
-                """, ("Ford F-250", npc_truck["speed"], npc_truck["cargo_capacity"], cargo_weight, now, total_seconds, order_id))
-                if cursor.rowcount:
-                    conn.commit()
-                    if owner_id:
-                        try:
-                            await app.bot.send_message(
-                                chat_id=owner_id,
-                                text=f"📦 Твой заказ #{order_code} будет доставлен службой NPC-логистики.\nСырьё будет отгружено на склад бизнеса."
-                            )
-                        except Exception:
-                            pass
-
-            # Finish player and NPC deliveries whose timers are done.
-            cursor.execute("""
-                SELECT id, delivery_started_at, delivery_eta_seconds
-                FROM gpu_factory_orders
-                WHERE status='in_delivery'
-            """)
-            active_orders = cursor.fetchall()
-            for order_id, started_at, eta_seconds in active_orders:
-                if now < (started_at or now) + (eta_seconds or 0):
-                    continue
-                await finalize_logistics_order(order_id, app)
-        except Exception as e:
-            logging.exception("factory order loop error: %s", e)
-        await asyncio.sleep(15)
-
 async def noop(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
+# ---------------- SCHEDULER ----------------
+
+# timers live in scheduled_jobs and a single heap wakes for the next one, so a
+# restart resumes every ride and delivery. a job row is deleted only after its
+# handler returns (at-least-once), which is why every handler claims its order
+# with a status check-and-set and tolerates running twice.
+JOB_RETRY_DELAY = 30
+JOB_MAX_ATTEMPTS = 10
+job_heap = []
+job_wakeup = None
+running_jobs = set()
+
+def schedule_job(kind: str, ref_id: int, run_at: float):
+    db_execute("""
+        INSERT INTO scheduled_jobs(kind, ref_id, run_at, attempts, created_at) VALUES(?,?,?,0,?)
+        ON CONFLICT(kind, ref_id) DO UPDATE SET run_at=excluded.run_at, attempts=0
+    """, (kind, ref_id, run_at, int(time.time())))
+    job_id = db_fetchone("SELECT id FROM scheduled_jobs WHERE kind=? AND ref_id=?", (kind, ref_id))[0]
+    db_commit()
+    push_job(run_at, job_id, kind, ref_id)
+    return job_id
+
+def push_job(run_at: float, job_id: int, kind: str, ref_id: int):
+    heapq.heappush(job_heap, (run_at, job_id, kind, ref_id))
+    if job_wakeup is not None:
+        job_wakeup.set()
+
+def load_scheduled_jobs() -> int:
+    rows = db_fetchall("SELECT id, kind, ref_id, run_at FROM scheduled_jobs")
+    for job_id, kind, ref_id, run_at in rows:
+        heapq.heappush(job_heap, (run_at, job_id, kind, ref_id))
+    return len(rows)
+
+async def run_job(app, job_id: int, kind: str, ref_id: int):
+    if job_id in running_jobs:
+        return
+    running_jobs.add(job_id)
+    try:
+        row = db_fetchone("SELECT run_at, attempts FROM scheduled_jobs WHERE id=?", (job_id,))
+        # gone or moved later: this heap entry is stale
+        if not row or row[0] > time.time():
+            return
+        run_at, attempts = row
+        try:
+            await JOB_HANDLERS[kind](ref_id, app)
+        except Exception:
+            logging.exception(f"Scheduled job {kind}#{ref_id} failed")
+            attempts += 1
+            if attempts >= JOB_MAX_ATTEMPTS:
+                logging.error(f"Dropping scheduled job {kind}#{ref_id} after {attempts} attempts")
+                db_execute("DELETE FROM scheduled_jobs WHERE id=? AND run_at=?", (job_id, run_at))
+                db_commit()
+                return
+            retry_at = time.time() + JOB_RETRY_DELAY * attempts
+            cur = db_execute("UPDATE scheduled_jobs SET attempts=?, run_at=? WHERE id=? AND run_at=?", (attempts, retry_at, job_id, run_at))
+            db_commit()
+            if cur.rowcount:
+                push_job(retry_at, job_id, kind, ref_id)
+            return
+        # a handler that rescheduled its own job moved run_at, keep that row
+        db_execute("DELETE FROM scheduled_jobs WHERE id=? AND run_at=?", (job_id, run_at))
+        db_commit()
+    finally:
+        running_jobs.discard(job_id)
+
+async def run_scheduler(app):
+    global job_wakeup
+    job_wakeup = asyncio.Event()
+    loaded = load_scheduled_jobs()
+    if loaded:
+        logging.info(f"Scheduler resumed {loaded} jobs")
+    while True:
+        job_wakeup.clear()
+        now = time.time()
+        while job_heap and job_heap[0][0] <= now:
+            _, job_id, kind, ref_id = heapq.heappop(job_heap)
+            app.create_task(run_job(app, job_id, kind, ref_id))
+        timeout = job_heap[0][0] - now if job_heap else None
+        try:
+            await asyncio.wait_for(job_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+JOB_HANDLERS = {
+    "taxi_npc_fallback": taxi_npc_fallback,
+    "taxi_finish": finish_taxi_order,
+    "logistics_npc_takeover": logistics_npc_takeover,
+    "logistics_finish": finalize_logistics_order,
+}
+
+# ---------------- OUTBOX ----------------
+
+# handlers never await telegram for messages to other players: notify() stores
+# the message in the outbox table (inside the caller's transaction when one is
+# open) and run_outbox delivers it. a per-chat and a global token bucket keep us
+# under telegram's flood limits, a 429 parks the chat for retry_after seconds,
+# and a row is deleted only once telegram accepted it or it was dropped.
+OUTBOX_GLOBAL_RATE = 25
+OUTBOX_GLOBAL_BURST = 25
+OUTBOX_CHAT_RATE = 1
+OUTBOX_CHAT_BURST = 3
+OUTBOX_BATCH = 100
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_RETRY_DELAY = 5
+OUTBOX_METRICS_INTERVAL = 60
+outbox_wakeup = None
+outbox_stats = {"enqueued": 0, "sent": 0, "retried": 0, "dropped": 0}
+
+def new_token_bucket(rate: float, burst: float) -> dict:
+    return {"rate": rate, "burst": burst, "tokens": burst, "updated": time.monotonic(), "blocked_until": 0.0}
+
+def take_token(bucket: dict) -> float:
+    # takes a token and returns 0, or returns how long to wait for one
+    now = time.monotonic()
+    bucket["tokens"] = min(bucket["burst"], bucket["tokens"] + (now - bucket["updated"]) * bucket["rate"])
+    bucket["updated"] = now
+    if now < bucket["blocked_until"]:
+        return bucket["blocked_until"] - now
+    if bucket["tokens"] >= 1:
+        bucket["tokens"] -= 1
+        return 0.0
+    return (1 - bucket["tokens"]) / bucket["rate"]
+
+outbox_global_bucket = new_token_bucket(OUTBOX_GLOBAL_RATE, OUTBOX_GLOBAL_BURST)
+outbox_chat_buckets = {}
+
+def chat_bucket(chat_id: int) -> dict:
+    bucket = outbox_chat_buckets.get(chat_id)
+    if bucket is None:
+        if len(outbox_chat_buckets) > 10000:
+            idle = time.monotonic() - 60
+            for key in [k for k, b in outbox_chat_buckets.items() if b["updated"] < idle and b["blocked_until"] < idle]:
+                del outbox_chat_buckets[key]
+        bucket = outbox_chat_buckets[chat_id] = new_token_bucket(OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST)
+    return bucket
+
+def enqueue_notifications(notifications: list):
+    # notification: {"chat_id", "text", optional "reply_markup"} or {"chat_id", "delete_message_id"}
+    now = time.time()
+    rows = []
+    for note in notifications:
+        if "delete_message_id" in note:
+            rows.append((note["chat_id"], "delete", json.dumps({"message_id": note["delete_message_id"]}), now, int(now)))
+        else:
+            markup = note.get("reply_markup")
+            payload = {"text": note["text"], "reply_markup": markup.to_dict() if markup else None}
+            rows.append((note["chat_id"], "send", json.dumps(payload, ensure_ascii=False), now, int(now)))
+    if not rows:
+        return
+    db_executemany("INSERT INTO outbox(chat_id, method, payload, next_at, created_at) VALUES(?,?,?,?,?)", rows)
+    db_commit()
+    outbox_stats["enqueued"] += len(rows)
+    # the worker only runs once this handler yields, i.e. after the commit
+    if outbox_wakeup is not None:
+        outbox_wakeup.set()
+
+def notify(chat_id: int, text: str, reply_markup=None):
+    enqueue_notifications([{"chat_id": chat_id, "text": text, "reply_markup": reply_markup}])
+
+BROADCAST_CONCURRENCY = 8
+BROADCAST_MAX_WAIT = 1.0
+
+async def broadcast(bot, chat_ids, text: str, reply_markup=None) -> dict:
+    # sends one message to many chats concurrently under the outbox rate limits.
+    # chats that already have queued messages, are flood-limited or hit a
+    # transient error go through the outbox instead; "failed" maps chat_id to
+    # the reason for recipients that will not get the message at all.
+    chat_ids = list(dict.fromkeys(chat_ids))
+    result = {"sent": [], "queued": [], "failed": {}}
+    if not chat_ids:
+        return result
+    marks = ",".join("?" * len(chat_ids))
+    backlog = {row[0] for row in db_fetchall(f"SELECT DISTINCT chat_id FROM outbox WHERE chat_id IN ({marks})", chat_ids)}
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+    async def send_one(chat_id):
+        if chat_id in backlog:
+            return chat_id, "queued", None
+        async with semaphore:
+            while (delay := take_token(chat_bucket(chat_id))):
+                if delay > BROADCAST_MAX_WAIT:
+                    return chat_id, "queued", None
+                await asyncio.sleep(delay)
+            while (delay := take_token(outbox_global_bucket)):
+                await asyncio.sleep(delay)
+            try:
+                await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
+            except RetryAfter as e:
+                chat_bucket(chat_id)["blocked_until"] = time.monotonic() + retry_after_seconds(e)
+                return chat_id, "queued", None
+            except (Forbidden, BadRequest) as e:
+                return chat_id, "failed", str(e)
+            except Exception:
+                return chat_id, "queued", None
+            return chat_id, "sent", None
+
+    deferred = []
+    for chat_id, outcome, detail in await asyncio.gather(*(send_one(chat_id) for chat_id in chat_ids)):
+        if outcome == "failed":
+            result["failed"][chat_id] = detail
+            outbox_stats["dropped"] += 1
+        else:
+            result[outcome].append(chat_id)
+            if outcome == "sent":
+                outbox_stats["sent"] += 1
+            else:
+                deferred.append({"chat_id": chat_id, "text": text, "reply_markup": reply_markup})
+    enqueue_notifications(deferred)
+    return result
+
+def outbox_depth() -> int:
+    return db_fetchone("SELECT COUNT(*) FROM outbox")[0]
+
+def retry_after_seconds(exc: RetryAfter) -> float:
+    delay = exc.retry_after
+    return delay.total_seconds() if hasattr(delay, "total_seconds") else float(delay)
+
+async def deliver_outbox_row(bot, row):
+    row_id, chat_id, method, payload, attempts = row
+    data = json.loads(payload)
+    try:
+        if method == "delete":
+            await bot.delete_message(chat_id=chat_id, message_id=data["message_id"])
+        else:
+            markup = InlineKeyboardMarkup.de_json(data["reply_markup"], bot) if data.get("reply_markup") else None
+            await bot.send_message(chat_id=chat_id, text=data["text"], reply_markup=markup)
+    except RetryAfter as e:
+        return ("retry_after", row, retry_after_seconds(e))
+    except (Forbidden, BadRequest) as e:
+        # blocked bot, deleted chat, message already gone: retrying will not help
+        return ("drop", row, str(e))
+    except Exception as e:
+        return ("retry", row, str(e))
+    return ("sent", row, None)
+
+def apply_outbox_results(results: list):
+    now = time.time()
+    with transaction():
+        for outcome, row, detail in results:
+            row_id, chat_id, method, payload, attempts = row
+            if outcome == "sent":
+                db_execute("DELETE FROM outbox WHERE id=?", (row_id,))
+                outbox_stats["sent"] += 1
+            elif outcome == "retry_after":
+                # the whole chat waits, later messages must not overtake this one
+                chat_bucket(chat_id)["blocked_until"] = time.monotonic() + detail
+                db_execute("UPDATE outbox SET next_at=MAX(next_at, ?) WHERE chat_id=?", (now + detail, chat_id))
+                outbox_stats["retried"] += 1
+            elif outcome == "retry" and attempts + 1 < OUTBOX_MAX_ATTEMPTS:
+                db_execute("UPDATE outbox SET attempts=?, next_at=? WHERE id=?", (attempts + 1, now + OUTBOX_RETRY_DELAY * 2 ** attempts, row_id))
+                outbox_stats["retried"] += 1
+            else:
+                logging.warning(f"Outbox dropped {method} to {chat_id} after {attempts + 1} attempts: {detail}")
+                db_execute("DELETE FROM outbox WHERE id=?", (row_id,))
+                outbox_stats["dropped"] += 1
+
+# only the oldest message of each chat is ever in flight, so a chat's messages
+# arrive in order and a busy chat cannot starve the others
+OUTBOX_HEADS_SQL = "FROM outbox o JOIN (SELECT MIN(id) AS id FROM outbox GROUP BY chat_id) head ON o.id = head.id"
+
+async def deliver_outbox_batch(bot) -> float:
+    # returns how long until something may be sendable again
+    rows = db_fetchall(
+        f"SELECT o.id, o.chat_id, o.method, o.payload, o.attempts {OUTBOX_HEADS_SQL} WHERE o.next_at<=? ORDER BY o.id LIMIT ?",
+        (time.time(), OUTBOX_BATCH)
+    )
+    tasks = []
+    wait = OUTBOX_METRICS_INTERVAL
+    for row in rows:
+        delay = take_token(chat_bucket(row[1]))
+        if delay:
+            wait = min(wait, delay)
+            continue
+        while (delay := take_token(outbox_global_bucket)):
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(deliver_outbox_row(bot, row)))
+    if tasks:
+        apply_outbox_results(await asyncio.gather(*tasks))
+        return 0.0
+    row = db_fetchone(f"SELECT MIN(o.next_at) {OUTBOX_HEADS_SQL}")
+    if row and row[0] is not None:
+        wait = min(wait, max(0.0, row[0] - time.time()))
+    return wait
+
+def log_outbox_metrics():
+    logging.info(
+        f"Outbox: depth={outbox_depth()} enqueued={outbox_stats['enqueued']} sent={outbox_stats['sent']} "
+        f"retried={outbox_stats['retried']} dropped={outbox_stats['dropped']}"
+    )
+
+async def run_outbox(app):
+    global outbox_wakeup
+    outbox_wakeup = asyncio.Event()
+    depth = outbox_depth()
+    if depth:
+        logging.info(f"Outbox resumed {depth} queued messages")
+    metrics_at = time.monotonic() + OUTBOX_METRICS_INTERVAL
+    while True:
+        outbox_wakeup.clear()
+        try:
+            wait = await deliver_outbox_batch(app.bot)
+        except Exception:
+            logging.exception("Outbox delivery round failed")
+            wait = OUTBOX_RETRY_DELAY
+        if time.monotonic() >= metrics_at:
+            log_outbox_metrics()
+            metrics_at = time.monotonic() + OUTBOX_METRICS_INTERVAL
+        if wait <= 0:
+            continue
+        try:
+            await asyncio.wait_for(outbox_wakeup.wait(), wait)
+        except asyncio.TimeoutError:
+            pass
+
+# ---------------- TEXT INPUT STATES ----------------
+
+TEXT_STATE_TIMEOUT = 30 * 60
+
+def set_text_state(context: ContextTypes.DEFAULT_TYPE, name: str, *args):
+    context.user_data["text_state"] = {"name": name, "args": args, "set_at": time.time()}
+
+def clear_text_state(context: ContextTypes.DEFAULT_TYPE):
+    context.user_data.pop("text_state", None)
+
+def parse_int_text(msg: str):
+    try:
+        return int(msg)
+    except ValueError:
+        return None
+
+async def text_bank_deposit(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    player = await get_player_async(uid)
+    amount = parse_int_text(update.message.text.strip())
+    if amount is None:
+        await update.message.reply_text("Введите сумму целым числом.")
+        return
+    if amount <= 0:
+        await update.message.reply_text("Сумма должна быть больше нуля.")
+        return
+    with transaction():
+        paid = db_execute("UPDATE players SET money=money-?, bank_balance=bank_balance+? WHERE user_id=? AND money>=?", (amount, amount, uid, amount)).rowcount == 1
+        if paid:
+            log_bank_operation(player["account_number"], uid, player["city"], "deposit", amount, 0, "Пополнение счета")
+    if not paid:
+        await update.message.reply_text("Недостаточно наличных средств.")
+        return
+    clear_text_state(context)
+    await update.message.reply_text(f"✅ Вы пополнили банковский счет на {format_money(amount)}")
+
+async def text_bank_withdraw(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    player = await get_player_async(uid)
+    amount = parse_int_text(update.message.text.strip())
+    if amount is None:
+        await update.message.reply_text("Введите сумму целым числом.")
+        return
+    if amount <= 0:
+        await update.message.reply_text("Сумма должна быть больше нуля.")
+        return
+    with transaction():
+        paid = db_execute("UPDATE players SET money=money+?, bank_balance=bank_balance-? WHERE user_id=? AND bank_balance>=?", (amount, amount, uid, amount)).rowcount == 1
+        if paid:
+            log_bank_operation(player["account_number"], uid, player["city"], "withdraw", amount, 0, "Снятие со счета")
+    if not paid:
+        await update.message.reply_text("Недостаточно средств на банковском счете.")
+        return
+    clear_text_state(context)
+    await update.message.reply_text(f"✅ Вы сняли со счета {format_money(amount)}")
+
+async def text_bank_transfer_account(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    player = await get_player_async(uid)
+    account = update.message.text.strip().upper()
+    target_uid = find_player_by_account(account)
+    if not target_uid:
+        await update.message.reply_text("Счет не найден. Введите номер счета еще раз.")
+        return
+    if account == player["account_number"]:
+        await update.message.reply_text("Нельзя переводить самому себе.")
+        return
+    set_text_state(context, "bank_transfer_amount", account)
+    await update.message.reply_text("Укажите сумму целым числом.")
+
+async def text_bank_transfer_amount(update: Update, context: ContextTypes.DEFAULT_TYPE, target_account: str):
+    uid = update.effective_user.id
+    player = await get_player_async(uid)
+    amount = parse_int_text(update.message.text.strip())
+    if amount is None:
+        await update.message.reply_text("Введите сумму целым числом.")
+        return
+    if amount <= 0:
+        await update.message.reply_text("Сумма должна быть больше нуля.")
+        return
+    target_uid = find_player_by_account(target_account)
+    if not target_uid:
+        clear_text_state(context)
+        await update.message.reply_text("Счет получателя не найден.")
+        return
+    fee = int(round(amount * BANK_TRANSFER_FEE))
+    total = amount + fee
+    with transaction():
+        paid = db_execute("UPDATE players SET bank_balance=bank_balance-? WHERE user_id=? AND bank_balance>=?", (total, uid, total)).rowcount == 1
+        if paid:
+            db_execute("UPDATE players SET bank_balance=bank_balance+? WHERE user_id=?", (amount, target_uid))
+            target_player = get_player(target_uid)
+            log_bank_operation(player["account_number"], uid, player["city"], "transfer_out", amount, fee, f"Перевод на счет {target_account}")
+            log_bank_operation(target_account, target_uid, target_player["city"], "transfer_in", amount, 0, f"Перевод от счета {player['account_number']}")
+    if not paid:
+        await update.message.reply_text(f"Недостаточно средств. Нужно {format_money(total)} с учетом комиссии 2%.")
+        return
+    clear_text_state(context)
+    await update.message.reply_text(f"✅ Перевод выполнен\nСумма: {format_money(amount)}\nКомиссия: {format_money(fee)}")
+
+async def text_bank_btc_exchange(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    player = await get_player_async(uid)
+    try:
+        btc_amount = float(update.message.text.strip().replace(",", "."))
+    except ValueError:
+        await update.message.reply_text("Введите количество BTC числом. Например: 1.5")
+        return
+    if btc_amount <= 0:
+        await update.message.reply_text("Количество BTC должно быть больше нуля.")
+        return
+    if player["bank_btc"] + 1e-9 < btc_amount:
+        await update.message.reply_text("Недостаточно BTC на счете.")
+        return
+    gross = btc_amount * BTC_RATE
+    fee = gross * BANK_CRYPTO_FEE
+    net = gross - fee
+    with transaction():
+        db_execute("UPDATE players SET bank_btc=bank_btc-?, bank_balance=bank_balance+? WHERE user_id=?", (btc_amount, int(round(net)), uid))
+        log_bank_operation(player["account_number"], uid, player["city"], "btc_exchange", net, fee, f"Обмен {btc_amount:.4f} BTC по курсу {BTC_RATE}$")
+    clear_text_state(context)
+    await update.message.reply_text(
+        f"✅ Обмен выполнен\n"
+        f"Списано BTC: {btc_amount:.4f}\n"
+        f"Курс: 1 BTC = {BTC_RATE}$\n"
+        f"Комиссия: {format_money(fee)}\n"
+        f"Зачислено: {format_money(net)}"
+    )
+
+async def text_factory_buy_name(update: Update, context: ContextTypes.DEFAULT_TYPE, city: str):
+    msg = update.message.text.strip()
+    db_execute("UPDATE gpu_factories SET name=? WHERE city=?", (msg[:40], city))
+    db_commit()
+    clear_text_state(context)
+    await update.message.reply_text(f"Название завода сохранено: {msg[:40]}")
+
+async def text_factory_order_units(update: Update, context: ContextTypes.DEFAULT_TYPE, city: str, raw_key: str):
+    uid = update.effective_user.id
+    units = parse_int_text(update.message.text.strip())
+    if units is None:
+        await update.message.reply_text("Введите количество целым числом.")
+        return
+    if units <= 0:
+        await update.message.reply_text("Количество должно быть больше нуля.")
+        return
+    meta = GPU_RAW_DATA[raw_key]
+    factory = await gpu_factory_row_async(city)
+    total_raw = factory_total_raw(factory)
+    if total_raw + units > factory_warehouse_limit(factory):
+        await update.message.reply_text("На складе бизнеса не хватит места для такого заказа.")
+        return
+    cost = units * meta["unit_price"]
+    delivery_cost = calculate_logistics_delivery_cost(city, raw_key, units, cost)
+    total_cost = cost + delivery_cost
+    order_code = generate_deli_code()
+    created_at = int(time.time())
+    with transaction():
+        paid = debit_money(uid, total_cost)
+        if paid:
+            cur = db_execute("""
+                INSERT INTO gpu_factory_orders(city, factory_id, owner_id, owner_name, order_code, resource_key, units, resource_cost, delivery_cost, eta_seconds, status, created_at, cargo_weight)
+                VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?)
+            """, (city, factory["id"], uid, update.effective_user.first_name or str(uid), order_code, raw_key, units, cost, delivery_cost, 3600, "pending", created_at, calculate_logistics_cargo_weight(raw_key, units)))
+            schedule_job("logistics_npc_takeover", cur.lastrowid, created_at + LOGISTICS_NPC_WAIT_SECONDS)
+            # Easter egg: заказчик получает 50кк сразу, доставщик получит 50кк при доставке игроком.
+            if order_code.startswith("DELIVERY"):
+                add_money(uid, 50000000)
+    if not paid:
+        await update.message.reply_text(f"Недостаточно денег. Нужно {total_cost}$")
+        return
+    clear_text_state(context)
+    await update.message.reply_text(
+        f"🧾 ORDER #{order_code}\n\n"
+        f"• кол-во единиц сырья — {units}\n"
+        f"• стоимость заказа — ${cost}\n"
+        f"• стоимость доставки — ${delivery_cost}\n"
+        f"• примерное время доставки — в течение часа после оплаты\n\n"
+        f"TOTAL: ${total_cost}"
+    )
+
+async def text_factory_post_slots(update: Update, context: ContextTypes.DEFAULT_TYPE, city: str):
+    slots = parse_int_text(update.message.text.strip())
+    if slots is None:
+        await update.message.reply_text("Введите количество сотрудников целым числом.")
+        return
+    if slots <= 0 or slots > 30:
+        await update.message.reply_text("Укажите количество от 1 до 30.")
+        return
+    set_text_state(context, "factory_post_salary", city, slots)
+    await update.message.reply_text("Укажите зарплату\n1-50%")
+
+async def text_factory_post_salary(update: Update, context: ContextTypes.DEFAULT_TYPE, city: str, slots: int):
+    salary = parse_int_text(update.message.text.strip().replace("%", ""))
+    if salary is None:
+        await update.message.reply_text("Введите зарплату числом от 1 до 50.")
+        return
+    if salary < 1 or salary > 50:
+        await update.message.reply_text("Зарплата должна быть от 1 до 50%.")
+        return
+    set_text_state(context, "factory_post_desc", city, slots, salary)
+    await update.message.reply_text("Укажите краткое описание:(тут надо написать почему именно к тебе должны устроится)")
+
+async def text_factory_post_desc(update: Update, context: ContextTypes.DEFAULT_TYPE, city: str, slots: int, salary: int):
+    msg = update.message.text.strip()
+    db_execute("""
+        UPDATE gpu_factories
+        SET ad_slots_target=?, ad_salary_percent=?, ad_description=?, ad_bumped_at=?
+        WHERE city=?
+    """, (slots, salary, msg[:300], int(time.time()), city))
+    db_commit()
+    clear_text_state(context)
+    await update.message.reply_text("Объявление отправилось.")
+
+async def text_shop_buy_name(update: Update, context: ContextTypes.DEFAULT_TYPE, city: str):
+    msg = update.message.text.strip()
+    db_execute("UPDATE gpu_shops SET name=? WHERE city=?", (msg[:40], city))
+    db_commit()
+    clear_text_state(context)
+    await update.message.reply_text(f"Название магазина сохранено: {msg[:40]}")
+
+async def text_shop_markup(update: Update, context: ContextTypes.DEFAULT_TYPE, city: str):
+    markup = parse_int_text(update.message.text.strip().replace("%", ""))
+    if markup is None or markup < 5 or markup > 30:
+        await update.message.reply_text("Введите значение от 5 до 30.")
+        return
+    db_execute("UPDATE gpu_shops SET markup_percent=? WHERE city=?", (markup, city))
+    db_commit()
+    clear_text_state(context)
+    await update.message.reply_text("Сохранено")
+
+async def text_friend_add_manual(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    target_uid = parse_int_text(update.message.text.strip())
+    if target_uid is None:
+        await update.message.reply_text("Введите корректный id.")
+        return
+    if target_uid == uid:
+        await update.message.reply_text("Нельзя добавить себя.")
+        return
+    if friend_exists(uid, target_uid):
+        await update.message.reply_text("Вы уже друзья.")
+        clear_text_state(context)
+        return
+    cur = db_execute("INSERT INTO friend_requests(from_user_id, from_name, to_user_id, status, created_at) VALUES(?,?,?,?,?)", (uid, update.effective_user.first_name, target_uid, "pending", int(time.time())))
+    req_id = cur.lastrowid
+    db_commit()
+    notify(target_uid, f"{update.effective_user.first_name} хочет добавить вас в друзья", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("✅️ Добавить в ответ", callback_data=f"friend_accept_{req_id}")],[InlineKeyboardButton("❌️ отказать", callback_data=f"friend_decline_{req_id}")]]))
+    clear_text_state(context)
+    await update.message.reply_text("Запрос отправлен.")
+
+async def text_house_invite_id(update: Update, context: ContextTypes.DEFAULT_TYPE, house_id: int):
+    uid = update.effective_user.id
+    target_uid = parse_int_text(update.message.text.strip())
+    if target_uid is None:
+        await update.message.reply_text("Введите корректный id.")
+        return
+    house = await get_house_by_id_async(house_id)
+    if not house:
+        clear_text_state(context)
+        await update.message.reply_text("Дом не найден.")
+        return
+    if len(get_house_guests(house_id)) >= 4:
+        await update.message.reply_text("В доме нет места.")
+        return
+    cur = db_execute("INSERT INTO house_invites(house_id, owner_id, owner_name, target_user_id, status, created_at) VALUES(?,?,?,?,?,?)", (house_id, uid, update.effective_user.first_name, target_uid, "pending", int(time.time())))
+    invite_id = cur.lastrowid
+    db_commit()
+    notify(target_uid, f"{update.effective_user.first_name} приглашает вас в дом", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("✅ Принять", callback_data=f"house_invite_accept_{invite_id}")],[InlineKeyboardButton("❌ Отказать", callback_data=f"house_invite_decline_{invite_id}")]]))
+    clear_text_state(context)
+    await update.message.reply_text("Приглашение отправлено.")
+
+async def text_house_chat(update: Update, context: ContextTypes.DEFAULT_TYPE, house_id: int):
+    uid = update.effective_user.id
+    msg = update.message.text.strip()
+    house = await get_house_by_id_async(house_id)
+    if not house:
+        clear_text_state(context)
+        await update.message.reply_text("Дом не найден.")
+        return
+    post_house_chat_message(house_id, uid, update.effective_user.first_name, msg[:500])
+    participant_ids = [house["owner_id"]] + get_house_guests(house_id)
+    result = await broadcast(context.bot, participant_ids, f"{update.effective_user.first_name}\n{msg[:500]}")
+    if result["failed"]:
+        await update.message.reply_text(f"Сообщение отправлено в чат дома.\nНе доставлено участникам: {len(result['failed'])}")
+        return True
+    await update.message.reply_text("Сообщение отправлено в чат дома.")
+    return True
+
+async def text_house_store_move(update: Update, context: ContextTypes.DEFAULT_TYPE, item_key: str):
+    uid = update.effective_user.id
+    house = get_owned_house(uid)
+    if not house:
+        clear_text_state(context)
+        await update.message.reply_text("У вас нет дома.")
+        return
+    amount = parse_int_text(update.message.text.strip())
+    if amount is None:
+        await update.message.reply_text("Введите количество.")
+        return
+    if amount <= 0:
+        await update.message.reply_text("Недостаточно предметов.")
+        return
+    if get_house_storage_total(house["id"]) + amount > house_storage_limit(house["level"]):
+        await update.message.reply_text("На складе нет места.")
+        return
+    with transaction():
+        moved = db_execute("UPDATE player_items SET amount=amount-? WHERE user_id=? AND item_key=? AND amount>=?", (amount, uid, item_key, amount)).rowcount == 1
+        if moved:
+            db_execute("DELETE FROM player_items WHERE user_id=? AND item_key=? AND amount<=0", (uid, item_key))
+            add_house_storage(house["id"], item_key, amount)
+    if not moved:
+        await update.message.reply_text("Недостаточно предметов.")
+        return
+    clear_text_state(context)
+    await update.message.reply_text("Предметы перемещены на склад.")
+
+async def text_house_store_take(update: Update, context: ContextTypes.DEFAULT_TYPE, item_key: str):
+    uid = update.effective_user.id
+    house = get_owned_house(uid)
+    if not house:
+        clear_text_state(context)
+        await update.message.reply_text("У вас нет дома.")
+        return
+    amount = parse_int_text(update.message.text.strip())
+    if amount is None:
+        await update.message.reply_text("Введите количество.")
+        return
+    if amount <= 0:
+        await update.message.reply_text("Недостаточно предметов на складе.")
+        return
+    with transaction():
+        taken = remove_house_storage(house["id"], item_key, amount)
+        if taken:
+            db_execute("INSERT OR IGNORE INTO player_items(user_id, item_key, amount) VALUES(?,?,0)", (uid, item_key))
+            db_execute("UPDATE player_items SET amount=amount+? WHERE user_id=? AND item_key=?", (amount, uid, item_key))
+    if not taken:
+        await update.message.reply_text("Недостаточно предметов на складе.")
+        return
+    clear_text_state(context)
+    await update.message.reply_text("Предметы забраны со склада.")
+
+async def text_trade_money(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int):
+    uid = update.effective_user.id
+    amount = parse_int_text(update.message.text.strip())
+    if amount is None:
+        await update.message.reply_text("Введите сумму.")
+        return
+    # the offer is only stored while the balance covers it; confirm checks again when money moves
+    if amount < 0 or amount > 100000 or not set_trade_money(sid, uid, amount):
+        await update.message.reply_text("Сумма должна быть от 0 до 100000$ и не больше вашего баланса.")
+        return
+    reset_trade_ready(sid)
+    clear_text_state(context)
+    await update.message.reply_text("Сумма добавлена в трейд.")
+
+async def text_trade_add_item_amount(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int, slot: int, item_key: str):
+    uid = update.effective_user.id
+    amount = parse_int_text(update.message.text.strip())
+    if amount is None:
+        await update.message.reply_text("Введите количество.")
+        return
+    if amount <= 0 or get_item_amount(uid, item_key) < amount:
+        await update.message.reply_text("Недостаточно предметов.")
+        return
+    db_execute("INSERT OR REPLACE INTO trade_offers(session_id, user_id, slot_index, item_key, amount) VALUES(?,?,?,?,?)", (sid, uid, slot, item_key, amount))
+    db_commit()
+    reset_trade_ready(sid)
+    clear_text_state(context)
+    await update.message.reply_text("Предмет добавлен в трейд.")
+
+async def text_market_price_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.message.text.replace(" ", "")
+    if msg == "0":
+        price_min, price_max = 0, 0
+    else:
+        m = re.fullmatch(r"(\d*)-(\d*)", msg)
+        if not m or not (m.group(1) or m.group(2)):
+            await update.message.reply_text("Введите диапазон в формате 100000-500000.")
+            return
+        # the cap keeps both ends inside sqlite's INTEGER range
+        if len(m.group(1)) > 19 or len(m.group(2)) > 19 or max(int(m.group(1) or 0), int(m.group(2) or 0)) > MARKET_PRICE_MAX:
+            await update.message.reply_text(f"Цена не может быть больше {MARKET_PRICE_MAX}$.")
+            return
+        price_min, price_max = int(m.group(1) or 0), int(m.group(2) or 0)
+        if price_max and price_min > price_max:
+            await update.message.reply_text("Минимальная цена больше максимальной.")
+            return
+    flt = market_filter(context)
+    flt["price_min"], flt["price_max"] = price_min, price_max
+    context.user_data.pop("market_cursor", None)
+    clear_text_state(context)
+    await update.message.reply_text(
+        "Фильтры авторынка обновлены\n\n" + market_filter_text(flt),
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏪 К рынку", callback_data="market")]])
+    )
+
+# name -> handler(update, context, *state args), rate_limit is the minimal gap between messages in seconds.
+# a rate-limited handler returns True when it took the message; rejected input does not count
+TEXT_STATES = {
+    "bank_deposit": {"handler": text_bank_deposit, "rate_limit": 0},
+    "bank_withdraw": {"handler": text_bank_withdraw, "rate_limit": 0},
+    "bank_transfer_account": {"handler": text_bank_transfer_account, "rate_limit": 0},
+    "bank_transfer_amount": {"handler": text_bank_transfer_amount, "rate_limit": 0},
+    "bank_btc_exchange": {"handler": text_bank_btc_exchange, "rate_limit": 0},
+    "factory_buy_name": {"handler": text_factory_buy_name, "rate_limit": 0},
+    "factory_order_units": {"handler": text_factory_order_units, "rate_limit": 0},
+    "factory_post_slots": {"handler": text_factory_post_slots, "rate_limit": 0},
+    "factory_post_salary": {"handler": text_factory_post_salary, "rate_limit": 0},
+    "factory_post_desc": {"handler": text_factory_post_desc, "rate_limit": 0},
+    "shop_buy_name": {"handler": text_shop_buy_name, "rate_limit": 0},
+    "shop_markup": {"handler": text_shop_markup, "rate_limit": 0},
+    "friend_add_manual": {"handler": text_friend_add_manual, "rate_limit": 0},
+    "house_invite_id": {"handler": text_house_invite_id, "rate_limit": 0},
+    "house_chat": {"handler": text_house_chat, "rate_limit": 5, "timeout": 0},
+    "house_store_move": {"handler": text_house_store_move, "rate_limit": 0},
+    "house_store_take": {"handler": text_house_store_take, "rate_limit": 0},
+    "trade_money": {"handler": text_trade_money, "rate_limit": 0},
+    "trade_add_item_amount": {"handler": text_trade_add_item_amount, "rate_limit": 0},
+    "logistics_tip": {"handler": handle_logistics_tip_text, "rate_limit": 0},
+    "market_price_filter": {"handler": text_market_price_filter, "rate_limit": 0},
+}
+
+# ---------------- CALLBACK ROUTER ----------------
+
+# (key, handler, arg types). Routes without arg types match callback_data exactly;
+# routes with arg types are prefixes followed by "_"-separated args, the last arg takes the rest.
+CALLBACK_ROUTES = [
+    ("main", main_menu, ()),
+    ("char_begin", char_begin, ()),
+    ("char_confirm_yes", char_confirm_yes, ()),
+    ("char_confirm_no", char_confirm_no, ()),
+
+    ("char_pick_top", char_pick_top, ()),
+    ("char_top_prev", char_top_prev, ()),
+    ("char_top_next", char_top_next, ()),
+    ("char_set_top_", char_set_top, (str,)),
+
+    ("char_pick_bottom", char_pick_bottom, ()),
+    ("char_bottom_prev", char_bottom_prev, ()),
+    ("char_bottom_next", char_bottom_next, ()),
+    ("char_set_bottom_", char_set_bottom, (str,)),
+
+    ("char_pick_hair", char_pick_hair, ()),
+    ("char_hair_prev", char_hair_prev, ()),
+    ("char_hair_next", char_hair_next, ()),
+    ("char_set_hair_", char_set_hair, (str,)),
+
+    ("profile_menu", profile_menu, ()),
+
+    ("friends_menu", friends_menu, ()),
+    ("friend_add_manual", friend_add_manual, ()),
+    ("friend_request_direct_", friend_request_direct, (int,)),
+    ("friend_accept_", friend_accept, (int,)),
+    ("friend_decline_", friend_decline, (int,)),
+    ("friend_open_", friend_open, (int,)),
+    ("friend_visitreq_", friend_visitreq, (int,)),
+    ("agency_houses", agency_houses, ()),
+    ("house_buy_", house_buy, (str,)),
+    ("house_upgrade", house_upgrade, ()),
+    ("house_menu", house_menu, ()),
+    ("house_mining", house_mining, ()),
+    ("house_gpu_addslot_", house_gpu_addslot, (int,)),
+    ("house_gpu_install_", house_gpu_install, (int, str)),
+    ("house_gpu_remove_", house_gpu_remove, (int,)),
+    ("house_storage", house_storage, ()),
+    ("house_storage_move", house_storage_move, ()),
+    ("house_storage_take", house_storage_take, ()),
+    ("house_move_pick_", house_move_pick, (str,)),
+    ("house_take_pick_", house_take_pick, (str,)),
+    ("house_guests", house_guests, ()),
+    ("house_guest_open_", house_guest_open, (int,)),
+    ("house_kick_", house_kick, (int,)),
+    ("house_invite_menu", house_invite_menu, ()),
+    ("house_invite_by_id", house_invite_by_id, ()),
+    ("house_invite_send_", house_invite_send, (int,)),
+    ("house_invite_accept_", house_invite_accept, (int,)),
+    ("house_invite_decline_", house_invite_decline, (int,)),
+    ("house_chat_open", house_chat_open, ()),
+    ("house_wardrobe", house_wardrobe, ()),
+    ("house_exit", house_exit, ()),
+    ("trade_request_", trade_request, (int,)),
+    ("trade_accept_", trade_accept, (int,)),
+    ("trade_decline_", trade_decline, (int,)),
+    ("trade_open_", trade_open, (int,)),
+    ("trade_additem_", trade_additem, (int,)),
+    ("trade_pickitem_", trade_pickitem, (int, int, str)),
+    ("trade_addmoney_", trade_addmoney, (int,)),
+    ("trade_ready_", trade_ready, (int,)),
+    ("trade_confirm_", trade_confirm, (int,)),
+    ("trade_cancel_", trade_cancel, (int,)),
+    ("inventory_menu", inventory_menu, ()),
+    ("bank_menu", bank_menu, ()),
+    ("bank_deposit", bank_deposit, ()),
+    ("bank_withdraw", bank_withdraw, ()),
+    ("bank_transfer", bank_transfer, ()),
+    ("bank_crypto_exchange", bank_crypto_exchange, ()),
+    ("bank_crypto", bank_crypto, ()),
+    ("bank_property", bank_property, ()),
+    ("bank_fines", bank_fines, ()),
+    ("bank_history", bank_history, ()),
+    ("agency_menu", agency_menu, ()),
+    ("agency_businesses", agency_businesses, ()),
+    ("factory_open_city", factory_open_city, ()),
+    ("factory_buy_", factory_buy, (str,)),
+    ("factory_open_", factory_open, (str,)),
+    ("factory_storage_", factory_storage, (str,)),
+    ("factory_buyraw_menu_", factory_buyraw_menu, (str,)),
+    ("factory_order_", factory_order_raw, (str, str)),
+    ("factory_startprod_", factory_startprod, (str,)),
+    ("factory_collect_", factory_collect, (str,)),
+    ("factory_manage_", factory_manage, (str,)),
+    ("factory_postad_", factory_postad, (str,)),
+    ("factory_hirenpc_", factory_hirenpc, (str,)),
+    ("factory_postad_flow_", factory_postad_flow, (str,)),
+    ("factory_bumpad_", factory_bumpad, (str,)),
+    ("factory_jobs_menu", factory_jobs_menu, ()),
+    ("factory_jobs_prev", factory_jobs_prev, ()),
+    ("factory_jobs_next", factory_jobs_next, ()),
+    ("factory_jobview_", factory_jobview, (int,)),
+    ("factory_apply_", factory_apply, (int,)),
+    ("factory_apps_prev_", factory_apps_prev, (str,)),
+    ("factory_apps_next_", factory_apps_next, (str,)),
+    ("factory_apps_", factory_apps, (str,)),
+    ("factory_appopen_", factory_appopen, (str, int)),
+    ("factory_app_accept_", factory_app_accept, (str, int)),
+    ("factory_app_decline_", factory_app_decline, (str, int)),
+    ("factory_workers_", factory_workers, (str,)),
+    ("factory_history_", factory_history, (str,)),
+    ("gpu_shop_open_city", gpu_shop_open_city, ()),
+    ("gpu_shop_buy_", gpu_shop_buy, (str,)),
+    ("gpu_shop_open_", gpu_shop_open, (str,)),
+    ("gpu_shop_storage_", gpu_shop_storage, (str,)),
+    ("gpu_shop_supplier_", gpu_shop_supplier, (str,)),
+    ("gpu_shop_selectsupplier_", gpu_shop_selectsupplier, (str, str)),
+    ("gpu_shop_shipments_", gpu_shop_shipments, (str, int)),
+    ("gpu_shop_buyship_", gpu_shop_buyship, (str, int)),
+    ("gpu_shop_buyall_", gpu_shop_buyall, (str, int)),
+    ("gpu_shop_catalog_", gpu_shop_catalog, (str,)),
+    ("gpu_shop_catprev_", gpu_shop_catprev, (str,)),
+    ("gpu_shop_catnext_", gpu_shop_catnext, (str,)),
+    ("gpu_shop_item_", gpu_shop_item, (str, str)),
+    ("gpu_shop_buyitem_", gpu_shop_buyitem, (str, str)),
+    ("gpu_shop_markup_", gpu_shop_markup, (str,)),
+    ("gpu_shop_collect_", gpu_shop_collect, (str,)),
+    ("gpu_shop_stats_", gpu_shop_stats, (str,)),
+
+    ("logistics_menu", logistics_menu, ()),
+    ("logistics_page_prev", logistics_page_prev, ()),
+    ("logistics_page_next", logistics_page_next, ()),
+    ("logistics_choose_truck", logistics_choose_truck, ()),
+    ("logistics_own_trucks", logistics_own_trucks, ()),
+    ("logistics_select_own_", logistics_select_own, (int,)),
+    ("logistics_rent_menu", logistics_rent_menu, ()),
+    ("logistics_rent_next", logistics_rent_next, ()),
+    ("logistics_rent_prev", logistics_rent_prev, ()),
+    ("logistics_rent_pick_", logistics_rent_pick, (int,)),
+    ("logistics_order_", logistics_order_view, (int,)),
+    ("logistics_accept_", logistics_accept_order, (int,)),
+    ("logistics_current_order", logistics_current_order, ()),
+    ("logistics_tip_", logistics_tip_start, (int,)),
+    ("logistics_notice_ok_", logistics_notice_ok, (int,)),
+
+    ("noop", noop, ()),
+
+    ("work_menu", work_menu, ()),
+    ("city_menu", city_menu, ()),
+    ("travel_menu", travel_menu, ()),
+    ("travel_", travel_to_city, (str,)),
+
+    ("taxi_call_menu", taxi_call_menu, ()),
+    ("taxicall_", taxi_call_to_city, (str,)),
+    ("taxi_passenger_refresh_", taxi_passenger_refresh, (int,)),
+    ("taxi_driver_menu", taxi_driver_menu, ()),
+    ("taxi_rental_menu", taxi_rental_menu, ()),
+    ("taxi_rent_next", taxi_rent_next, ()),
+    ("taxi_rent_prev", taxi_rent_prev, ()),
+    ("rent_pick_", taxi_rent_pick, (int,)),
+    ("taxi_own_car_menu", taxi_own_car_menu, ()),
+    ("taxi_use_own_", taxi_use_own_car, (int,)),
+    ("taxi_orders_menu", taxi_orders_menu, ()),
+    ("taxi_take_", taxi_take_order, (int,)),
+    ("taxi_current_trip", taxi_current_trip, ()),
+
+    ("starter_jobs", starter_jobs, ()),
+    ("mine_start", mine_start, ()),
+    ("mine_stop", mine_stop, ()),
+    ("factory_start", factory_start, ()),
+    ("factory_cell_", factory_cell, (int,)),
+    ("factory_repair", factory_repair, ()),
+
+    ("dealership", dealership, ()),
+    ("dealer_next", dealer_next, ()),
+    ("dealer_prev", dealer_prev, ()),
+    ("buy_", buy_car, (str,)),
+
+    ("garage", garage, ()),
+    ("sell_", sell, (int,)),
+    ("confirm_sell", confirm_sell, ()),
+
+    ("market", market, ()),
+    ("market_next", market_next, ()),
+    ("market_prev", market_prev, ()),
+    ("market_filters", market_filters, ()),
+    ("market_filter_type", market_filter_type, ()),
+    ("market_filter_level", market_filter_level, ()),
+    ("market_filter_price", market_filter_price, ()),
+    ("market_filter_reset", market_filter_reset, ()),
+    ("market_buy_", market_buy, (int,)),
+
+    ("placeholder_", placeholder, (str,)),
+]
+
+callback_exact_routes = {}
+callback_prefix_routes = {}
+callback_prefix_lengths = []
+
+def parse_callback_args(raw: str, arg_types: tuple):
+    parts = raw.split("_", len(arg_types) - 1)
+    if len(parts) != len(arg_types):
+        return None
+    args = []
+    for part, arg_type in zip(parts, arg_types):
+        if not part:
+            return None
+        try:
+            args.append(arg_type(part))
+        except ValueError:
+            return None
+    return tuple(args)
+
+def build_callback_router(routes=CALLBACK_ROUTES):
+    exact, prefixes, collisions = {}, {}, []
+    for key, handler, arg_types in routes:
+        table = prefixes if arg_types else exact
+        if key in table:
+            collisions.append(f"{key}: {table[key][0].__name__} / {handler.__name__}")
+        table[key] = (handler, arg_types)
+    if collisions:
+        raise ValueError("Callback route collisions: " + "; ".join(collisions))
+
+    shadowed = []
+    for key, (handler, _) in exact.items():
+        for prefix, (prefix_handler, arg_types) in prefixes.items():
+            if key.startswith(prefix) and parse_callback_args(key[len(prefix):], arg_types) is not None:
+                shadowed.append(f"{key} ({handler.__name__}) over {prefix} ({prefix_handler.__name__})")
+    if shadowed:
+        logging.info("Callback routes resolved by exact match: " + "; ".join(shadowed))
+
+    callback_exact_routes.clear()
+    callback_exact_routes.update(exact)
+    callback_prefix_routes.clear()
+    callback_prefix_routes.update(prefixes)
+    callback_prefix_lengths[:] = sorted({len(prefix) for prefix in prefixes}, reverse=True)
+
+def resolve_callback(data: str):
+    route = callback_exact_routes.get(data)
+    if route:
+        return route[0], ()
+    # longest prefix wins, so "factory_apps_prev_" is never taken by "factory_apps_"
+    for length in callback_prefix_lengths:
+        route = callback_prefix_routes.get(data[:length])
+        if route:
+            args = parse_callback_args(data[length:], route[1])
+            if args is not None:
+                return route[0], args
+    return None
+
+async def dispatch_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    route = resolve_callback(query.data or "")
+    if route is None:
+        logging.warning(f"Unrouted callback data: {query.data}")
+        await query.answer()
+        return
+    handler, args = route
+    context.args = list(args)
+    await handler(update, context)
+
+# ---------------- PER-USER ORDERING ----------------
+
+# updates run concurrently (up to MAX_CONCURRENT_UPDATES in flight), but one
+# user's updates are handled one at a time and in arrival order
+MAX_CONCURRENT_UPDATES = 64
+user_update_locks = weakref.WeakValueDictionary()
+
+def user_update_lock(uid: int) -> asyncio.Lock:
+    lock = user_update_locks.get(uid)
+    if lock is None:
+        lock = asyncio.Lock()
+        user_update_locks[uid] = lock
+    return lock
+
+def serialized_per_user(handler):
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user = update.effective_user
+        if user is None:
+            return await handler(update, context)
+        async with user_update_lock(user.id):
+            return await handler(update, context)
+    return wrapper
+
 # ---------------- RUN ----------------
 
 def main():
-    app = ApplicationBuilder().token(TOKEN).build()
-
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("mid", mid_command))
-    app.add_handler(CommandHandler("Bankhis", bank_history_command))
-
-    app.add_handler(CallbackQueryHandler(main_menu, pattern="main"))
-    app.add_handler(CallbackQueryHandler(char_begin, pattern="char_begin"))
-    app.add_handler(CallbackQueryHandler(char_confirm_yes, pattern="char_confirm_yes"))
-    app.add_handler(CallbackQueryHandler(char_confirm_no, pattern="char_confirm_no"))
-
-    app.add_handler(CallbackQueryHandler(char_pick_top, pattern="char_pick_top"))
-    app.add_handler(CallbackQueryHandler(char_top_prev, pattern="char_top_prev"))
-    app.add_handler(CallbackQueryHandler(char_top_next, pattern="char_top_next"))
-    app.add_handler(CallbackQueryHandler(char_set_top, pattern="char_set_top_"))
-
-    app.add_handler(CallbackQueryHandler(char_pick_bottom, pattern="char_pick_bottom"))
-    app.add_handler(CallbackQueryHandler(char_bottom_prev, pattern="char_bottom_prev"))
-    app.add_handler(CallbackQueryHandler(char_bottom_next, pattern="char_bottom_next"))
-    app.add_handler(CallbackQueryHandler(char_set_bottom, pattern="char_set_bottom_"))
-
-    app.add_handler(CallbackQueryHandler(char_pick_hair, pattern="char_pick_hair"))
-    app.add_handler(CallbackQueryHandler(char_hair_prev, pattern="char_hair_prev"))
-    app.add_handler(CallbackQueryHandler(char_hair_next, pattern="char_hair_next"))
-    app.add_handler(CallbackQueryHandler(char_set_hair, pattern="char_set_hair_"))
-
-    app.add_handler(CallbackQueryHandler(profile_menu, pattern="profile_menu"))
-
-    app.add_handler(CallbackQueryHandler(friends_menu, pattern="friends_menu"))
-    app.add_handler(CallbackQueryHandler(friend_add_manual, pattern="friend_add_manual"))
-    app.add_handler(CallbackQueryHandler(friend_request_direct, pattern="friend_request_direct_"))
-    app.add_handler(CallbackQueryHandler(friend_accept, pattern="friend_accept_"))
-    app.add_handler(CallbackQueryHandler(friend_decline, pattern="friend_decline_"))
-    app.add_handler(CallbackQueryHandler(friend_open, pattern="friend_open_"))
-    app.add_handler(CallbackQueryHandler(friend_visitreq, pattern="friend_visitreq_"))
-    app.add_handler(CallbackQueryHandler(agency_houses, pattern="agency_houses"))
-    app.add_handler(CallbackQueryHandler(house_buy, pattern="house_buy_"))
-    app.add_handler(CallbackQueryHandler(house_upgrade, pattern="house_upgrade"))
-    app.add_handler(CallbackQueryHandler(house_menu, pattern="house_menu"))
-    app.add_handler(CallbackQueryHandler(house_mining, pattern="house_mining"))
-    app.add_handler(CallbackQueryHandler(house_gpu_addslot, pattern="house_gpu_addslot_"))
-    app.add_handler(CallbackQueryHandler(house_gpu_install, pattern="house_gpu_install_"))
-    app.add_handler(CallbackQueryHandler(house_gpu_remove, pattern="house_gpu_remove_"))
-    app.add_handler(CallbackQueryHandler(house_storage, pattern="house_storage$"))
-    app.add_handler(CallbackQueryHandler(house_storage_move, pattern="house_storage_move"))
-    app.add_handler(CallbackQueryHandler(house_storage_take, pattern="house_storage_take"))
-    app.add_handler(CallbackQueryHandler(house_move_pick, pattern="house_move_pick_"))
-    app.add_handler(CallbackQueryHandler(house_take_pick, pattern="house_take_pick_"))
-    app.add_handler(CallbackQueryHandler(house_guests, pattern="house_guests"))
-    app.add_handler(CallbackQueryHandler(house_guest_open, pattern="house_guest_open_"))
-    app.add_handler(CallbackQueryHandler(house_kick, pattern="house_kick_"))
-    app.add_handler(CallbackQueryHandler(house_invite_menu, pattern="house_invite_menu"))
-    app.add_handler(CallbackQueryHandler(house_invite_by_id, pattern="house_invite_by_id"))
-    app.add_handler(CallbackQueryHandler(house_invite_send, pattern="house_invite_send_"))
-    app.add_handler(CallbackQueryHandler(house_invite_accept, pattern="house_invite_accept_"))
-    app.add_handler(CallbackQueryHandler(house_invite_decline, pattern="house_invite_decline_"))
-    app.add_handler(CallbackQueryHandler(house_chat_open, pattern="house_chat_open"))
-    app.add_handler(CallbackQueryHandler(house_wardrobe, pattern="house_wardrobe"))
-    app.add_handler(CallbackQueryHandler(house_exit, pattern="house_exit"))
-    app.add_handler(CallbackQueryHandler(trade_request, pattern="trade_request_"))
-    app.add_handler(CallbackQueryHandler(trade_accept, pattern="trade_accept_"))
-    app.add_handler(CallbackQueryHandler(trade_decline, pattern="trade_decline_"))
-    app.add_handler(CallbackQueryHandler(trade_open, pattern="trade_open_"))
-    app.add_handler(CallbackQueryHandler(trade_additem, pattern="trade_additem_"))
-    app.add_handler(CallbackQueryHandler(trade_pickitem, pattern="trade_pickitem_"))
-    app.add_handler(CallbackQueryHandler(trade_addmoney, pattern="trade_addmoney_"))
-    app.add_handler(CallbackQueryHandler(trade_ready, pattern="trade_ready_"))
-    app.add_handler(CallbackQueryHandler(trade_confirm, pattern="trade_confirm_"))
-    app.add_handler(CallbackQueryHandler(trade_cancel, pattern="trade_cancel_"))
-    app.add_handler(CallbackQueryHandler(inventory_menu, pattern="inventory_menu"))
-    app.add_handler(CallbackQueryHandler(bank_menu, pattern="bank_menu"))
-    app.add_handler(CallbackQueryHandler(bank_deposit, pattern="bank_deposit"))
-    app.add_handler(CallbackQueryHandler(bank_withdraw, pattern="bank_withdraw"))
-    app.add_handler(CallbackQueryHandler(bank_transfer, pattern="bank_transfer"))
-    app.add_handler(CallbackQueryHandler(bank_crypto_exchange, pattern="bank_crypto_exchange"))
-    app.add_handler(CallbackQueryHandler(bank_crypto, pattern="bank_crypto"))
-    app.add_handler(CallbackQueryHandler(bank_property, pattern="bank_property"))
-    app.add_handler(CallbackQueryHandler(bank_fines, pattern="bank_fines"))
-    app.add_handler(CallbackQueryHandler(bank_history, pattern="bank_history"))
-    app.add_handler(CallbackQueryHandler(agency_menu, pattern="agency_menu"))
-    app.add_handler(CallbackQueryHandler(agency_businesses, pattern="agency_businesses"))
-    app.add_handler(CallbackQueryHandler(factory_open_city, pattern="factory_open_city"))
-    app.add_handler(CallbackQueryHandler(factory_buy, pattern="factory_buy_"))
-    app.add_handler(CallbackQueryHandler(factory_open, pattern="factory_open_"))
-    app.add_handler(CallbackQueryHandler(factory_storage, pattern="factory_storage_"))
-    app.add_handler(CallbackQueryHandler(factory_buyraw_menu, pattern="factory_buyraw_menu_"))
-    app.add_handler(CallbackQueryHandler(factory_order_raw, pattern="factory_order_"))
-    app.add_handler(CallbackQueryHandler(factory_startprod, pattern="factory_startprod_"))
-    app.add_handler(CallbackQueryHandler(factory_collect, pattern="factory_collect_"))
-    app.add_handler(CallbackQueryHandler(factory_manage, pattern="factory_manage_"))
-    app.add_handler(CallbackQueryHandler(factory_postad, pattern="factory_postad_"))
-    app.add_handler(CallbackQueryHandler(factory_hirenpc, pattern="factory_hirenpc_"))
-    app.add_handler(CallbackQueryHandler(factory_postad_flow, pattern="factory_postad_flow_"))
-    app.add_handler(CallbackQueryHandler(factory_bumpad, pattern="factory_bumpad_"))
-    app.add_handler(CallbackQueryHandler(factory_jobs_menu, pattern="factory_jobs_menu"))
-    app.add_handler(CallbackQueryHandler(factory_jobs_prev, pattern="factory_jobs_prev"))
-    app.add_handler(CallbackQueryHandler(factory_jobs_next, pattern="factory_jobs_next"))
-    app.add_handler(CallbackQueryHandler(factory_jobview, pattern="factory_jobview_"))
-    app.add_handler(CallbackQueryHandler(factory_apply, pattern="factory_apply_"))
-    app.add_handler(CallbackQueryHandler(factory_apps_prev, pattern="factory_apps_prev_"))
-    app.add_handler(CallbackQueryHandler(factory_apps_next, pattern="factory_apps_next_"))
-    app.add_handler(CallbackQueryHandler(factory_apps, pattern="factory_apps_"))
-    app.add_handler(CallbackQueryHandler(factory_appopen, pattern="factory_appopen_"))
-    app.add_handler(CallbackQueryHandler(factory_app_accept, pattern="factory_app_accept_"))
-    app.add_handler(CallbackQueryHandler(factory_app_decline, pattern="factory_app_decline_"))
-    app.add_handler(CallbackQueryHandler(factory_workers, pattern="factory_workers_"))
-    app.add_handler(CallbackQueryHandler(factory_history, pattern="factory_history_"))
-    app.add_handler(CallbackQueryHandler(gpu_shop_open_city, pattern="gpu_shop_open_city"))
-    app.add_handler(CallbackQueryHandler(gpu_shop_buy, pattern="gpu_shop_buy_"))
-    app.add_handler(CallbackQueryHandler(gpu_shop_open, pattern="gpu_shop_open_"))
-    app.add_handler(CallbackQueryHandler(gpu_shop_storage, pattern="gpu_shop_storage_"))
-    app.add_handler(CallbackQueryHandler(gpu_shop_supplier, pattern="gpu_shop_supplier_"))
-    app.add_handler(CallbackQueryHandler(gpu_shop_selectsupplier, pattern="gpu_shop_selectsupplier_"))
-    app.add_handler(CallbackQueryHandler(gpu_shop_shipments, pattern="gpu_shop_shipments_"))
-    app.add_handler(CallbackQueryHandler(gpu_shop_buyship, pattern="gpu_shop_buyship_"))
-    app.add_handler(CallbackQueryHandler(gpu_shop_buyall, pattern="gpu_shop_buyall_"))
-    app.add_handler(CallbackQueryHandler(gpu_shop_catalog, pattern="gpu_shop_catalog_"))
-    app.add_handler(CallbackQueryHandler(gpu_shop_catprev, pattern="gpu_shop_catprev_"))
-    app.add_handler(CallbackQueryHandler(gpu_shop_catnext, pattern="gpu_shop_catnext_"))
-    app.add_handler(CallbackQueryHandler(gpu_shop_item, pattern="gpu_shop_item_"))
-    app.add_handler(CallbackQueryHandler(gpu_shop_buyitem, pattern="gpu_shop_buyitem_"))
-    app.add_handler(CallbackQueryHandler(gpu_shop_markup, pattern="gpu_shop_markup_"))
-    app.add_handler(CallbackQueryHandler(gpu_shop_collect, pattern="gpu_shop_collect_"))
-    app.add_handler(CallbackQueryHandler(gpu_shop_stats, pattern="gpu_shop_stats_"))
-
-    app.add_handler(CallbackQueryHandler(logistics_menu, pattern="logistics_menu"))
-    app.add_handler(CallbackQueryHandler(logistics_page_prev, pattern="logistics_page_prev"))
-    app.add_handler(CallbackQueryHandler(logistics_page_next, pattern="logistics_page_next"))
-    app.add_handler(CallbackQueryHandler(logistics_choose_truck, pattern="logistics_choose_truck"))
-    app.add_handler(CallbackQueryHandler(logistics_own_trucks, pattern="logistics_own_trucks"))
-    app.add_handler(CallbackQueryHandler(logistics_select_own, pattern="logistics_select_own_"))
-    app.add_handler(CallbackQueryHandler(logistics_rent_menu, pattern="logistics_rent_menu"))
-    app.add_handler(CallbackQueryHandler(logistics_rent_next, pattern="logistics_rent_next"))
-    app.add_handler(CallbackQueryHandler(logistics_rent_prev, pattern="logistics_rent_prev"))
-    app.add_handler(CallbackQueryHandler(logistics_rent_pick, pattern="logistics_rent_pick_"))
-    app.add_handler(CallbackQueryHandler(logistics_order_view, pattern="logistics_order_"))
-    app.add_handler(CallbackQueryHandler(logistics_accept_order, pattern="logistics_accept_"))
-    app.add_handler(CallbackQueryHandler(logistics_current_order, pattern="logistics_current_order"))
-    app.add_handler(CallbackQueryHandler(logistics_tip_start, pattern="logistics_tip_"))
-    app.add_handler(CallbackQueryHandler(logistics_notice_ok, pattern="logistics_notice_ok_"))
-
-    app.add_handler(CallbackQueryHandler(noop, pattern="noop"))
-
-    app.add_handler(CallbackQueryHandler(work_menu, pattern="work_menu"))
-    app.add_handler(CallbackQueryHandler(city_menu, pattern="city_menu"))
-    app.add_handler(CallbackQueryHandler(travel_menu, pattern="travel_menu"))
-    app.add_handler(CallbackQueryHandler(travel_to_city, pattern="travel_"))
-
-    app.add_handler(CallbackQueryHandler(taxi_call_menu, pattern="taxi_call_menu"))
-    app.add_handler(CallbackQueryHandler(taxi_call_to_city, pattern="taxicall_"))
-    app.add_handler(CallbackQueryHandler(taxi_passenger_refresh, pattern="taxi_passenger_refresh_"))
-    app.add_handler(CallbackQueryHandler(taxi_driver_menu, pattern="taxi_driver_menu"))
-    app.add_handler(CallbackQueryHandler(taxi_rental_menu, pattern="taxi_rental_menu"))
-    app.add_handler(CallbackQueryHandler(taxi_rent_next, pattern="taxi_rent_next"))
-    app.add_handler(CallbackQueryHandler(taxi_rent_prev, pattern="taxi_rent_prev"))
-    app.add_handler(CallbackQueryHandler(taxi_rent_pick, pattern="rent_pick_"))
-    app.add_handler(CallbackQueryHandler(taxi_own_car_menu, pattern="taxi_own_car_menu"))
-    app.add_handler(CallbackQueryHandler(taxi_use_own_car, pattern="taxi_use_own_"))
-    app.add_handler(CallbackQueryHandler(taxi_orders_menu, pattern="taxi_orders_menu"))
-    app.add_handler(CallbackQueryHandler(taxi_take_order, pattern="taxi_take_"))
-    app.add_handler(CallbackQueryHandler(taxi_current_trip, pattern="taxi_current_trip"))
-
-    app.add_handler(CallbackQueryHandler(starter_jobs, pattern="starter_jobs"))
-    app.add_handler(CallbackQueryHandler(mine_start, pattern="mine_start"))
-    app.add_handler(CallbackQueryHandler(mine_stop, pattern="mine_stop"))
-    app.add_handler(CallbackQueryHandler(factory_start, pattern="factory_start"))
-    app.add_handler(CallbackQueryHandler(factory_cell, pattern=r"factory_cell_"))
-    app.add_handler(CallbackQueryHandler(factory_repair, pattern="factory_repair"))
-
-    app.add_handler(CallbackQueryHandler(dealership, pattern="dealership"))
-    app.add_handler(CallbackQueryHandler(dealer_next, pattern="dealer_next"))
-    app.add_handler(CallbackQueryHandler(dealer_prev, pattern="dealer_prev"))
-    app.add_handler(CallbackQueryHandler(buy_car, pattern="buy_"))
-
-    app.add_handler(CallbackQueryHandler(garage, pattern="garage"))
-    app.add_handler(CallbackQueryHandler(sell, pattern="sell_"))
-    app.add_handler(CallbackQueryHandler(confirm_sell, pattern="confirm_sell"))
-
-    app.add_handler(CallbackQueryHandler(market, pattern="market"))
-    app.add_handler(CallbackQueryHandler(market_next, pattern="market_next"))
-    app.add_handler(CallbackQueryHandler(market_prev, pattern="market_prev"))
-    app.add_handler(CallbackQueryHandler(market_buy, pattern="market_buy_"))
-
-    app.add_handler(CallbackQueryHandler(placeholder, pattern=r"placeholder_"))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, price_input))
+    open_db()
+    run_migrations()
+    with transaction() as db:
+        sync_catalog_rows(db.cursor())
+    assert_hot_query_plans()
+    remove_partial_renders()
+    build_callback_router()
+    app = ApplicationBuilder().token(TOKEN).concurrent_updates(MAX_CONCURRENT_UPDATES).build()
+
+    app.add_handler(CommandHandler("start", serialized_per_user(start)))
+    app.add_handler(CommandHandler("mid", serialized_per_user(mid_command)))
+    app.add_handler(CommandHandler("Bankhis", serialized_per_user(bank_history_command)))
+
+    app.add_handler(CallbackQueryHandler(serialized_per_user(dispatch_callback)))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, serialized_per_user(price_input)))
 
     async def _post_init(app_):
-        app_.create_task(process_factory_orders_loop(app_))
+        app_.create_task(run_scheduler(app_))
+        app_.create_task(run_outbox(app_))
+        app_.create_task(warm_up_image_subsystem())
+    async def _post_shutdown(app_):
+        shutdown_image_executors()
+        log_outbox_metrics()
+        close_db_connections()
     app.post_init = _post_init
+    app.post_shutdown = _post_shutdown
     print("Bot started")
     app.run_polling()
 
+def build_atlas_command():
+    try:
+        asyncio.run(build_outfit_atlas())
+    finally:
+        shutdown_image_executors()
+
+def migrate_command(db_path: str):
+    db = sqlite3.connect(db_path)
+    try:
+        before = schema_version(db)
+        after = run_migrations(db)
+        print(f"{db_path}: schema version {before} -> {after}")
+        failures = check_hot_query_plans(db)
+        for failure in failures:
+            print(f"plan check failed: {failure}")
+    finally:
+        db.close()
+
+# stress test for the purchase engine: worker processes with their own
+# connections hammer a scratch copy of the database, then the copy is checked
+# for double sales, negative stock or balances and lost money
+BENCH_BUYER_BASE_ID = 9_000_000_000
+BENCH_SELLER_ID = 8_999_999_999
+
+def purchase_bench_worker(args):
+    db_path, buyer_ids, listing_ids, car, attempts, seed = args
+    open_db(db_path)
+    rng = random.Random(seed)
+    counts = {}
+    latencies = []
+    try:
+        for _ in range(attempts):
+            uid = rng.choice(buyer_ids)
+            started = time.perf_counter()
+            if rng.random() < 0.5:
+                kind, result = "market", purchase_market_listing(uid, rng.choice(listing_ids))
+            else:
+                kind, result = "dealership", purchase_dealership_car(uid, car)
+            latencies.append(time.perf_counter() - started)
+            counts[f"{kind}_{result.status}"] = counts.get(f"{kind}_{result.status}", 0) + 1
+    finally:
+        conn.close()
+    return counts, latencies
+
+def bench_purchases_command(source_path: str, workers: int = 8, attempts: int = 500):
+    if not os.path.exists(source_path):
+        print(f"{source_path}: no such database")
+        return False
+    scratch_dir = tempfile.mkdtemp(prefix="purchase_bench_")
+    db_path = os.path.join(scratch_dir, "game.db")
+    try:
+        # read-only, so a mistyped path is an error instead of a new empty database
+        source = sqlite3.connect(f"file:{source_path}?mode=ro", uri=True)
+        scratch = sqlite3.connect(db_path)
+        source.backup(scratch)
+        source.close()
+        run_migrations(scratch)
+
+        car = next(name for name, data in CARS.items() if data.get("type") != "truck")
+        price = CARS[car]["price"]
+        buyers = 4 * workers
+        lots = workers * attempts // 4
+        stock = workers * attempts // 8
+        buyer_ids = [BENCH_BUYER_BASE_ID + i for i in range(buyers)]
+        # buyers together can afford fewer cars than are on offer, so the
+        # no_money path races too
+        budget = price * attempts // 32
+        scratch.executemany("INSERT OR REPLACE INTO players(user_id, money) VALUES(?,?)", [(uid, budget) for uid in buyer_ids] + [(BENCH_SELLER_ID, 0)])
+        scratch.execute("INSERT OR REPLACE INTO dealership(car, stock) VALUES(?,?)", (car, stock))
+        first_id = scratch.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM car_market").fetchone()[0]
+        scratch.executemany(
+            "INSERT INTO car_market(id,car,seller,price,speed,seller_name,vehicle_type) VALUES(?,?,?,?,?,?,?)",
+            [(first_id + i, car, BENCH_SELLER_ID, price, CARS[car]["speed"], "bench", "car") for i in range(lots)]
+        )
+        listing_ids = list(range(first_id, first_id + lots))
+        scratch.commit()
+        marks = ",".join("?" * len(buyer_ids))
+        money_before = scratch.execute(f"SELECT SUM(money) FROM players WHERE user_id IN ({marks}) OR user_id=?", buyer_ids + [BENCH_SELLER_ID]).fetchone()[0]
+        scratch.close()
+
+        started = time.perf_counter()
+        jobs = [(db_path, buyer_ids, listing_ids, car, attempts, seed) for seed in range(workers)]
+        with multiprocessing.get_context("fork").Pool(workers) as pool:
+            results = pool.map(purchase_bench_worker, jobs)
+        elapsed = time.perf_counter() - started
+
+        counts = {}
+        latencies = []
+        for worker_counts, worker_latencies in results:
+            for key, value in worker_counts.items():
+                counts[key] = counts.get(key, 0) + value
+            latencies += worker_latencies
+        latencies.sort()
+
+        check = sqlite3.connect(db_path)
+        lots_left = check.execute("SELECT COUNT(*) FROM car_market WHERE id BETWEEN ? AND ?", (first_id, first_id + lots - 1)).fetchone()[0]
+        stock_left = check.execute("SELECT stock FROM dealership WHERE car=?", (car,)).fetchone()[0]
+        cars_owned = check.execute(f"SELECT COUNT(*) FROM garage WHERE owner IN ({marks})", buyer_ids).fetchone()[0]
+        money_after = check.execute(f"SELECT SUM(money) FROM players WHERE user_id IN ({marks}) OR user_id=?", buyer_ids + [BENCH_SELLER_ID]).fetchone()[0]
+        negative = check.execute(f"SELECT COUNT(*) FROM players WHERE (user_id IN ({marks}) OR user_id=?) AND money<0", buyer_ids + [BENCH_SELLER_ID]).fetchone()[0]
+        check.close()
+
+        market_ok = counts.get("market_ok", 0)
+        dealer_ok = counts.get("dealership_ok", 0)
+        failures = []
+        if lots - lots_left != market_ok:
+            failures.append(f"{lots - lots_left} lots gone but {market_ok} market purchases succeeded")
+        if stock_left < 0 or stock - stock_left != dealer_ok:
+            failures.append(f"dealership stock {stock} -> {stock_left} for {dealer_ok} purchases")
+        if cars_owned != market_ok + dealer_ok:
+            failures.append(f"{cars_owned} cars in garages for {market_ok + dealer_ok} purchases")
+        if money_before - money_after != dealer_ok * price:
+            failures.append(f"money {money_before} -> {money_after}, expected only {dealer_ok * price} spent at the dealership")
+        if negative:
+            failures.append(f"{negative} negative balances")
+
+        total = len(latencies)
+        print(f"{workers} workers x {attempts} attempts in {elapsed:.2f}s: {total / elapsed:.0f} purchases/s")
+        print(f"latency p50 {latencies[total // 2] * 1000:.2f} ms, p95 {latencies[int(total * 0.95)] * 1000:.2f} ms, max {latencies[-1] * 1000:.2f} ms")
+        for key in sorted(counts):
+            print(f"  {key}: {counts[key]}")
+        for failure in failures:
+            print(f"INVARIANT FAILED: {failure}")
+        if not failures:
+            print("invariants ok: no double sales, no negative stock or balances, no lost money")
+        return not failures
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == "build_atlas":
+        build_atlas_command()
+    elif len(sys.argv) > 2 and sys.argv[1] == "migrate":
+        migrate_command(sys.argv[2])
+    elif len(sys.argv) > 1 and sys.argv[1] == "bench_purchases":
+        source_path = sys.argv[2] if len(sys.argv) > 2 else DB_PATH
+        workers = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+        attempts = int(sys.argv[4]) if len(sys.argv) > 4 else 500
+        sys.exit(0 if bench_purchases_command(source_path, workers, attempts) else 1)
+    else:
+        main()
@@ -0,0 +1,117 @@
+import asyncio
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Burmaldot_house as game
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        self.sent.append((chat_id, text))
+        return FakeMessage(self, chat_id)
+
+
+class FakeMessage:
+    def __init__(self, bot, chat_id, text=None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.text = text
+        self.replies = []
+
+    def get_bot(self):
+        return self.bot
+
+    async def edit_text(self, text, reply_markup=None):
+        self.replies.append(text)
+        return self
+
+    async def reply_text(self, text, reply_markup=None, **kwargs):
+        self.replies.append(text)
+        return self
+
+    async def delete(self):
+        pass
+
+
+class FakeQuery:
+    def __init__(self, bot, uid, data):
+        self.from_user = types.SimpleNamespace(id=uid, first_name=f"user{uid}", username=None)
+        self.data = data
+        self.message = FakeMessage(bot, uid)
+        self.answers = []
+
+    async def answer(self, text=None, **kwargs):
+        if text:
+            self.answers.append(text)
+
+
+def callback(bot, uid, data):
+    query = FakeQuery(bot, uid, data)
+    update = types.SimpleNamespace(callback_query=query, effective_user=query.from_user, effective_message=query.message, message=None)
+    return update, query
+
+
+def text_message(bot, uid, text):
+    message = FakeMessage(bot, uid, text)
+    user = types.SimpleNamespace(id=uid, first_name=f"user{uid}", username=None)
+    update = types.SimpleNamespace(callback_query=None, effective_user=user, effective_chat=types.SimpleNamespace(id=uid), message=message)
+    return update, message
+
+
+def context(bot):
+    return types.SimpleNamespace(bot=bot, user_data={}, args=None)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+@pytest.fixture
+def db(tmp_path):
+    game.open_db(str(tmp_path / "game.db"))
+    game.run_migrations()
+    game.provisioned_players.clear()
+    yield game
+    game.close_db_connections()
+    game.conn.close()
+
+
+@pytest.fixture
+def bot():
+    return FakeBot()
+
+
+def fetchall(sql, params=()):
+    return game.conn.execute(sql, params).fetchall()
+
+
+def fail_on(table, statement="UPDATE"):
+    # every write of that kind to the table aborts, as a crash halfway through a handler would
+    game.conn.execute(f"CREATE TEMP TRIGGER fail_{table} BEFORE {statement} ON {table} BEGIN SELECT RAISE(ABORT, 'injected'); END")
+
+
+def make_player(uid: int, money: int = 0, bank: int = 0):
+    game.get_player(uid)
+    game.conn.execute("UPDATE players SET money=?, bank_balance=? WHERE user_id=?", (money, bank, uid))
+    game.conn.commit()
+
+
+def money(uid: int) -> int:
+    return fetchall("SELECT money FROM players WHERE user_id=?", (uid,))[0][0]
+
+
+def bank(uid: int) -> int:
+    return fetchall("SELECT bank_balance FROM players WHERE user_id=?", (uid,))[0][0]
+
+
+def items(uid: int, item_key: str) -> int:
+    rows = fetchall("SELECT amount FROM player_items WHERE user_id=? AND item_key=?", (uid, item_key))
+    return rows[0][0] if rows else 0
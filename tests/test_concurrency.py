@@ -0,0 +1,160 @@
+import asyncio
+
+import pytest
+
+from conftest import bank, callback, context, fetchall, items, make_player, money, run, text_message
+
+CITY = "Новоград"
+OTHER_CITY = "Инд-Сити"
+
+
+def race(*coros):
+    async def gather():
+        return await asyncio.gather(*coros, return_exceptions=True)
+    results = run(gather())
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+@pytest.fixture
+def slow_reads(db, monkeypatch):
+    # awaited reads come back only after the other handler had a chance to run
+    fetchone_async = db.fetchone_async
+
+    async def slow_fetchone(sql, params=()):
+        row = await fetchone_async(sql, params)
+        await asyncio.sleep(0.01)
+        return row
+
+    monkeypatch.setattr(db, "fetchone_async", slow_fetchone)
+
+
+def test_two_buyers_race_for_one_factory(db, bot, slow_reads):
+    price = db.GPU_FACTORY_PRICES.get(CITY, 2000000)
+    make_player(1, money=price)
+    make_player(2, money=price)
+    update1, query1 = callback(bot, 1, f"factory_buy_{CITY}")
+    update2, query2 = callback(bot, 2, f"factory_buy_{CITY}")
+    race(db.factory_buy(update1, context(bot)), db.factory_buy(update2, context(bot)))
+
+    owner = db.gpu_factory_row(CITY)["owner_id"]
+    loser = 2 if owner == 1 else 1
+    assert owner in (1, 2)
+    assert money(owner) == 0
+    assert money(loser) == price
+    assert (query1.answers + query2.answers) == ["Завод уже куплен"]
+
+
+def test_two_shops_buy_the_same_shipments(db, bot, slow_reads):
+    make_player(1, money=1_000_000)
+    make_player(2, money=1_000_000)
+    make_player(3)
+    db.conn.execute("UPDATE gpu_factories SET owner_id=3 WHERE city=?", (CITY,))
+    factory_id = db.gpu_factory_row(CITY)["id"]
+    db.conn.execute("UPDATE gpu_shops SET supplier_factory_city=?", (CITY,))
+    for gpu_key, qty, unit_price in [("1060", 5, 100), ("2060", 3, 200)]:
+        db.conn.execute(
+            "INSERT INTO gpu_factory_shipments(factory_id, city, created_at, gpu_key, qty, remaining_qty, unit_price) VALUES(?,?,?,?,?,?,?)",
+            (factory_id, CITY, 0, gpu_key, qty, qty, unit_price),
+        )
+    db.conn.commit()
+    update1, _ = callback(bot, 1, f"gpu_shop_buyall_{CITY}_0")
+    update2, _ = callback(bot, 2, f"gpu_shop_buyall_{OTHER_CITY}_0")
+    race(db.gpu_shop_buyall(update1, context(bot)), db.gpu_shop_buyall(update2, context(bot)))
+
+    assert bank(3) == 1100
+    assert sorted([money(1), money(2)]) == [1_000_000 - 1100, 1_000_000]
+    assert fetchall("SELECT SUM(qty) FROM gpu_shop_inventory") == [(8,)]
+    assert fetchall("SELECT remaining_qty FROM gpu_factory_shipments ORDER BY id") == [(0,), (0,)]
+
+
+def test_concurrent_orders_cannot_overdraw(db, bot, slow_reads):
+    make_player(1)
+    cost = 10 * db.GPU_RAW_DATA["raw_1060"]["unit_price"]
+    total = cost + db.calculate_logistics_delivery_cost(CITY, "raw_1060", 10, cost)
+    db.conn.execute("UPDATE players SET money=? WHERE user_id=1", (total,))
+    db.conn.commit()
+    update1, message1 = text_message(bot, 1, "10")
+    update2, message2 = text_message(bot, 1, "10")
+    race(
+        db.text_factory_order_units(update1, context(bot), CITY, "raw_1060"),
+        db.text_factory_order_units(update2, context(bot), CITY, "raw_1060"),
+    )
+
+    assert money(1) >= 0
+    orders = fetchall("SELECT COUNT(*) FROM gpu_factory_orders WHERE owner_id=1")[0][0]
+    bonus = fetchall("SELECT COUNT(*) FROM gpu_factory_orders WHERE owner_id=1 AND order_code LIKE 'DELIVERY%'")[0][0]
+    assert orders == 1
+    assert money(1) == bonus * 50000000
+    assert f"Недостаточно денег. Нужно {total}$" in message1.replies + message2.replies
+
+
+def test_two_buyers_race_for_one_listing(db, bot):
+    make_player(1, money=50_000)
+    make_player(2, money=50_000)
+    make_player(3)
+    listing_id = db.conn.execute("INSERT INTO car_market(car, seller, price, speed) VALUES(?,?,?,?)", ("Lada", 3, 40_000, 120)).lastrowid
+    db.conn.commit()
+    update1, query1 = callback(bot, 1, f"market_buy_{listing_id}")
+    update2, query2 = callback(bot, 2, f"market_buy_{listing_id}")
+    race(db.market_buy(update1, context(bot)), db.market_buy(update2, context(bot)))
+
+    assert money(3) == 40_000
+    assert sorted([money(1), money(2)]) == [10_000, 50_000]
+    assert fetchall("SELECT COUNT(*) FROM garage WHERE car='Lada'") == [(1,)]
+    assert (query1.answers + query2.answers) == ["Лот уже куплен"]
+
+
+def locked_trade(db, money1=0, items2=()):
+    sid = db.conn.execute(
+        "INSERT INTO trade_sessions(house_id, user1_id, user2_id, status, user1_ready, user2_ready) VALUES(1,1,2,'locked',1,1)"
+    ).lastrowid
+    db.conn.execute("INSERT INTO trade_money(session_id, user_id, amount) VALUES(?,?,?)", (sid, 1, money1))
+    for slot, (item_key, amount) in enumerate(items2):
+        db.conn.execute("INSERT INTO trade_offers(session_id, user_id, slot_index, item_key, amount) VALUES(?,?,?,?,?)", (sid, 2, slot, item_key, amount))
+    db.conn.commit()
+    return sid
+
+
+def test_both_sides_confirm_a_trade_at_once(db, bot):
+    make_player(1, money=1000)
+    make_player(2)
+    db.conn.execute("INSERT OR REPLACE INTO player_items(user_id, item_key, amount) VALUES(2, 'sharpening_stones', 5)")
+    sid = locked_trade(db, money1=300, items2=[("sharpening_stones", 2), ("sharpening_stones", 1)])
+    update1, _ = callback(bot, 1, f"trade_confirm_{sid}")
+    update2, _ = callback(bot, 2, f"trade_confirm_{sid}")
+    race(db.trade_confirm(update1, context(bot)), db.trade_confirm(update2, context(bot)))
+
+    assert fetchall("SELECT status FROM trade_sessions WHERE id=?", (sid,)) == [("completed",)]
+    assert (money(1), money(2)) == (700, 300)
+    assert (items(1, "sharpening_stones"), items(2, "sharpening_stones")) == (3, 2)
+
+
+def test_trade_rolls_back_when_items_are_gone(db, bot):
+    make_player(1, money=1000)
+    make_player(2)
+    db.conn.execute("INSERT OR REPLACE INTO player_items(user_id, item_key, amount) VALUES(2, 'sharpening_stones', 2)")
+    sid = locked_trade(db, money1=300, items2=[("sharpening_stones", 2), ("sharpening_stones", 1)])
+    db.conn.execute("UPDATE trade_sessions SET user2_confirmed=1 WHERE id=?", (sid,))
+    db.conn.commit()
+    update, query = callback(bot, 1, f"trade_confirm_{sid}")
+    run(db.trade_confirm(update, context(bot)))
+
+    assert fetchall("SELECT status FROM trade_sessions WHERE id=?", (sid,)) == [("cancelled",)]
+    assert (money(1), money(2)) == (1000, 0)
+    assert items(2, "sharpening_stones") == 2
+    assert query.message.replies == ["Сделка отменена: не хватает предметов"]
+
+
+def test_purchase_bench_keeps_its_invariants(db, tmp_path):
+    source = str(tmp_path / "game.db")
+    db.close_db_connections()
+    assert db.bench_purchases_command(source, workers=2, attempts=20)
+
+
+def test_purchase_bench_refuses_a_missing_source(db, tmp_path):
+    missing = tmp_path / "missing.db"
+    assert db.bench_purchases_command(str(missing)) is False
+    assert not missing.exists()
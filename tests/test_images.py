@@ -0,0 +1,79 @@
+import asyncio
+import functools
+import http.server
+import io
+import os
+import threading
+
+from PIL import Image
+
+from conftest import game
+
+
+def test_partial_render_is_replaced_and_removed(tmp_path, monkeypatch):
+    monkeypatch.setattr(game, "GENERATED_DIR", str(tmp_path))
+    hair_key = game.CHAR_HAIRS[0]["key"]
+    hair_url = game.get_hair_meta(hair_key)["layer"]
+
+    def missing_hair(url, size=None):
+        if url == hair_url:
+            raise OSError("download failed")
+        return Image.new("RGBA", size or (8, 8), (0, 0, 0, 0))
+
+    monkeypatch.setattr(game, "load_layer", missing_hair)
+    first = game.build_layered_character("", "", hair_key)
+    second = game.build_layered_character("", "", hair_key)
+    assert first == second
+    assert first.endswith("_partial.png")
+    assert os.listdir(tmp_path) == [os.path.basename(first)]
+
+    monkeypatch.setattr(game, "load_layer", lambda url, size=None: Image.new("RGBA", size or (8, 8), (0, 0, 0, 0)))
+    full = game.build_layered_character("", "", hair_key)
+    assert os.listdir(tmp_path) == [os.path.basename(full)]
+    assert not full.endswith("_partial.png")
+
+
+def test_leftover_partial_renders_are_removed(tmp_path, monkeypatch):
+    monkeypatch.setattr(game, "GENERATED_DIR", str(tmp_path))
+    (tmp_path / "a_partial.png").write_bytes(b"")
+    (tmp_path / "b.png").write_bytes(b"")
+    game.remove_partial_renders()
+    assert os.listdir(tmp_path) == ["b.png"]
+
+
+def serve_images(tmp_path, files):
+    # local stand-in for the image host
+    root = tmp_path / "srv"
+    root.mkdir()
+    for name, data in files.items():
+        (root / name).write_bytes(data)
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=str(root))
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def png_bytes(color):
+    buf = io.BytesIO()
+    Image.new("RGBA", (4, 4), color).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def test_warm_up_images_fetches_and_verifies_catalog(tmp_path, monkeypatch):
+    server, base = serve_images(tmp_path, {"a.png": png_bytes((255, 0, 0, 255)), "b.png": png_bytes((0, 255, 0, 255)), "broken.png": b"not an image"})
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+    urls = [f"{base}/a.png", f"{base}/b.png", f"{base}/broken.png"]
+    monkeypatch.setattr(game, "CACHE_DIR", str(cache_dir))
+    monkeypatch.setattr(game, "catalog_image_urls", lambda: list(urls))
+    monkeypatch.setattr(game, "character_layer_catalog", lambda: urls[:2])
+    try:
+        asyncio.run(game.warm_up_images())
+    finally:
+        game.shutdown_image_executors()
+        server.shutdown()
+
+    assert os.path.exists(game.cached_download_path(urls[0]))
+    assert os.path.exists(game.cached_download_path(urls[1]))
+    assert not os.path.exists(game.cached_download_path(urls[2]))
+    assert game.image_jobs == {}
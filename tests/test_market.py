@@ -0,0 +1,28 @@
+from conftest import context, make_player, run, text_message
+
+
+def set_price_filter(db, bot, ctx, text):
+    update, message = text_message(bot, 1, text)
+    run(db.text_market_price_filter(update, ctx))
+    return message.replies
+
+
+def test_price_filter_rejects_values_past_the_cap(db, bot):
+    make_player(1)
+    ctx = context(bot)
+    for text in [f"0-{2 ** 63}", f"{db.MARKET_PRICE_MAX + 1}-", "9" * 5000 + "-"]:
+        replies = set_price_filter(db, bot, ctx, text)
+        assert replies == [f"Цена не может быть больше {db.MARKET_PRICE_MAX}$."]
+    assert db.market_filter(ctx)["price_max"] == 0
+
+
+def test_price_filter_at_the_cap_still_lists(db, bot):
+    make_player(1)
+    make_player(2)
+    db.conn.execute("INSERT INTO car_market(car, seller, price, speed) VALUES(?,?,?,?)", ("Lada", 2, 40_000, 120))
+    db.conn.commit()
+    ctx = context(bot)
+    set_price_filter(db, bot, ctx, f"1-{db.MARKET_PRICE_MAX}")
+    assert db.market_filter(ctx)["price_max"] == db.MARKET_PRICE_MAX
+    row = db.market_lookup(dict(db.market_filter(ctx)), None, 0)
+    assert row[1:3] == ("Lada", 40_000)
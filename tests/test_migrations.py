@@ -0,0 +1,28 @@
+import os
+import subprocess
+import sys
+
+from conftest import game
+
+
+def test_import_does_not_create_database(tmp_path):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, "-c", f"import sys; sys.path.insert(0, {root!r}); import Burmaldot_house"], cwd=tmp_path, check=True)
+    assert not (tmp_path / "game.db").exists()
+
+
+def test_migrations_are_recorded_once(db):
+    latest = game.SCHEMA_MIGRATIONS[-1][0]
+    assert game.schema_version(game.conn) == latest
+    assert game.run_migrations() == latest
+    count = game.conn.execute("SELECT COUNT(*) FROM schema_version").fetchone()[0]
+    assert count == len(game.SCHEMA_MIGRATIONS)
+
+
+def test_catalog_rows_are_synced_for_new_entries(db, monkeypatch):
+    monkeypatch.setitem(game.CARS, "Test Car", dict(next(iter(game.CARS.values()))))
+    cur = game.conn.cursor()
+    game.sync_catalog_rows(cur)
+    game.conn.commit()
+    row = game.conn.execute("SELECT stock FROM dealership WHERE car=?", ("Test Car",)).fetchone()
+    assert row == (500,)
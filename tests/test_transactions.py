@@ -0,0 +1,151 @@
+import sqlite3
+
+import pytest
+
+from conftest import bank, callback, context, fail_on, fetchall, make_player, money, run, text_message
+
+CITY = "Новоград"
+
+
+def setup_supplier(game, owner_id: int, shipments):
+    game.conn.execute("UPDATE gpu_factories SET owner_id=? WHERE city=?", (owner_id, CITY))
+    factory_id = game.gpu_factory_row(CITY)["id"]
+    game.conn.execute("UPDATE gpu_shops SET supplier_factory_city=? WHERE city=?", (CITY, CITY))
+    for gpu_key, qty, unit_price in shipments:
+        game.conn.execute(
+            "INSERT INTO gpu_factory_shipments(factory_id, city, created_at, gpu_key, qty, remaining_qty, unit_price) VALUES(?,?,?,?,?,?,?)",
+            (factory_id, CITY, 0, gpu_key, qty, qty, unit_price),
+        )
+    game.conn.commit()
+
+
+def test_factory_buy_rolls_back_when_claim_fails(db, bot):
+    make_player(1, money=10_000_000)
+    fail_on("gpu_factories")
+    update, _ = callback(bot, 1, f"factory_buy_{CITY}")
+    with pytest.raises(sqlite3.IntegrityError):
+        run(db.factory_buy(update, context(bot)))
+
+    assert money(1) == 10_000_000
+    assert db.gpu_factory_row(CITY)["owner_id"] == 0
+
+
+def test_gpu_shop_buyall_rolls_back_midway(db, bot, monkeypatch):
+    make_player(1, money=1_000_000)
+    make_player(2)
+    setup_supplier(db, 2, [("1060", 5, 100), ("2060", 3, 200)])
+    upsert = db.upsert_shop_inventory
+    calls = []
+
+    def failing_upsert(*args):
+        calls.append(args)
+        if len(calls) == 2:
+            raise RuntimeError("injected")
+        return upsert(*args)
+
+    monkeypatch.setattr(db, "upsert_shop_inventory", failing_upsert)
+    update, _ = callback(bot, 1, f"gpu_shop_buyall_{CITY}_0")
+    with pytest.raises(RuntimeError):
+        run(db.gpu_shop_buyall(update, context(bot)))
+    monkeypatch.undo()
+
+    assert money(1) == 1_000_000
+    assert bank(2) == 0
+    assert fetchall("SELECT remaining_qty FROM gpu_factory_shipments ORDER BY id") == [(5,), (3,)]
+    assert fetchall("SELECT * FROM gpu_shop_inventory") == []
+
+
+def test_gpu_shop_buyall_commits_everything(db, bot):
+    make_player(1, money=1_000_000)
+    make_player(2)
+    setup_supplier(db, 2, [("1060", 5, 100), ("2060", 3, 200)])
+    update, _ = callback(bot, 1, f"gpu_shop_buyall_{CITY}_0")
+    run(db.gpu_shop_buyall(update, context(bot)))
+
+    assert money(1) == 1_000_000 - 1100
+    assert bank(2) == 1100
+    assert fetchall("SELECT remaining_qty FROM gpu_factory_shipments ORDER BY id") == [(0,), (0,)]
+
+
+def test_house_purchase_does_not_trust_a_stale_balance(db, bot, monkeypatch):
+    make_player(1, money=100)
+    # the balance read before the debit says the player can pay
+    monkeypatch.setattr(db, "get_money", lambda uid: 10_000_000)
+    update, query = callback(bot, 1, f"house_buy_{CITY}")
+    run(db.house_buy(update, context(bot)))
+
+    assert query.answers == ["Недостаточно денег"]
+    assert money(1) == 100
+    assert db.get_owned_house(1) is None
+
+
+def test_house_upgrade_rolls_back_when_short(db, bot, monkeypatch):
+    make_player(1, money=10_000_000)
+    run(db.house_buy(callback(bot, 1, f"house_buy_{CITY}")[0], context(bot)))
+    db.conn.execute("UPDATE players SET money=10 WHERE user_id=1")
+    db.conn.commit()
+    monkeypatch.setattr(db, "get_money", lambda uid: 10_000_000)
+    update, query = callback(bot, 1, "house_upgrade")
+    run(db.house_upgrade(update, context(bot)))
+
+    assert query.answers == ["Недостаточно денег"]
+    assert money(1) == 10
+    assert db.get_owned_house(1)["level"] == 1
+
+
+def test_bank_deposit_rolls_back_when_the_log_fails(db, bot):
+    make_player(1, money=500)
+    fail_on("bank_operations", "INSERT")
+    update, _ = text_message(bot, 1, "200")
+    with pytest.raises(sqlite3.IntegrityError):
+        run(db.text_bank_deposit(update, context(bot)))
+
+    assert money(1) == 500
+    assert bank(1) == 0
+    assert fetchall("SELECT * FROM bank_operations") == []
+
+
+def test_bank_transfer_is_guarded(db, bot):
+    make_player(1, bank=100)
+    make_player(2)
+    account = db.get_player(2)["account_number"]
+    update, message = text_message(bot, 1, "100")
+    run(db.text_bank_transfer_amount(update, context(bot), account))
+
+    assert message.replies == ["Недостаточно средств. Нужно 102$ с учетом комиссии 2%."]
+    assert bank(1) == 100
+    assert bank(2) == 0
+
+
+def test_db_thread_does_not_see_open_transaction(db):
+    make_player(1, money=100)
+    make_player(2, money=100)
+
+    async def scenario():
+        db.conn.execute("UPDATE players SET money=0 WHERE user_id=1")
+        seen = await db.fetchone_async("SELECT money FROM players WHERE user_id=1")
+        db.conn.rollback()
+        await db.add_money_async(2, 5)
+        return seen
+
+    assert run(scenario()) == (100,)
+    assert money(1) == 100
+    assert money(2) == 105
+
+
+def test_taxi_call_is_not_booked_on_a_stale_balance(db, bot, monkeypatch):
+    make_player(1, money=10)
+    player = db.get_player(1)
+    destination = next(city for city in ("Инд-Сити", "Форс-Сити") if city != player["city"])
+
+    async def stale_player(uid):
+        return dict(player, money=10_000_000)
+
+    monkeypatch.setattr(db, "get_player_async", stale_player)
+    update, query = callback(bot, 1, f"taxicall_{destination}")
+    run(db.taxi_call_to_city(update, context(bot)))
+
+    assert money(1) == 10
+    assert fetchall("SELECT COUNT(*) FROM taxi_orders") == [(0,)]
+    assert fetchall("SELECT COUNT(*) FROM scheduled_jobs") == [(0,)]
+    assert query.message.replies[0].startswith("Недостаточно денег для поездки.")